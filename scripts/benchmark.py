@@ -0,0 +1,558 @@
+#!/usr/bin/env python3
+# Benchmarks the extraction and conversion stages on deterministic synthetic inputs, so that changes can be compared
+# without downloading any data: arXiv archives of gzipped papers with .tex sources and PNG/JPEG/PDF/EPS figures, PMC
+# packages with .nxml files (served over a local HTTP server for the end-to-end run) and shards to convert. The fixtures
+# only depend on --seed, --num_papers and --num_packages. Every stage runs in a fresh process, so that its peak RSS can
+# be measured. Results can be saved and compared against a baseline, e.g.
+#
+#   python scripts/benchmark.py --output baseline.json
+#   python scripts/benchmark.py --baseline baseline.json  # exits with status 1 on regressions
+from argparse import ArgumentParser
+import csv
+import gzip
+from functools import partial
+from glob import glob
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from json import dump, load
+from multiprocessing import get_context
+from os import makedirs
+from os.path import abspath, basename, dirname, getsize, isfile, join, splitext
+from random import Random
+from resource import RUSAGE_CHILDREN, RUSAGE_SELF, getrusage
+from shutil import copy, rmtree
+import sys
+import tarfile
+from tempfile import mkdtemp
+from threading import Thread
+from time import perf_counter
+
+from PIL import Image, ImageDraw
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.append(join(ROOT_DIR, "src", "process"))
+sys.path.append(join(ROOT_DIR, "src", "postprocess"))
+import arxiv
+from convert_to_img2dataset import process_tar_file
+from figures import process_image
+import pmc
+from shards import add_bytes_to_tar
+
+
+FIXTURE_VERSION = 1  # increase on every change of the fixtures, so that results are only compared on equal inputs
+WORDS = ("model", "image", "training", "loss", "network", "results", "dataset", "baseline", "accuracy", "layer",
+         "attention", "figure", "shows", "the", "of", "a", "with", "for", "and", "our", "method", "compared", "to",
+         "distribution", "samples", "error", "rate", "over", "epochs", "left", "right", "top", "bottom", "curve",
+         "ablation", "performance", "between", "different", "settings", "higher", "lower", "is", "are", "on", "in")
+FIGURE_KINDS = (("png", 0.35), ("jpg", 0.35), ("pdf", 0.2), ("eps", 0.1))
+PAPERS_PER_ARCHIVE = 50
+SAMPLES_PER_SHARD = 100
+
+
+def words(rng, n):
+    return " ".join(rng.choice(WORDS) for _ in range(n))
+
+
+def tar_bytes(members):
+    tar_buffer = BytesIO()
+    with tarfile.open(fileobj=tar_buffer, mode="w") as tar:
+        for name, file_bytes in members:
+            add_bytes_to_tar(tar, name, file_bytes)  # with mtime 0, so the output is deterministic
+    return tar_buffer.getvalue()
+
+
+def raster_figure(rng, width, height):
+    gradient = Image.linear_gradient("L").resize((width, height))
+    img = Image.merge("RGB", (gradient, gradient.rotate(180), Image.new("L", (width, height), rng.randrange(256))))
+    draw = ImageDraw.Draw(img)
+    for _ in range(rng.randint(5, 40)):
+        x0, y0 = rng.randrange(width), rng.randrange(height)
+        box = [x0, y0, x0 + rng.randrange(1, width // 2 + 2), y0 + rng.randrange(1, height // 2 + 2)]
+        color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+        shape = rng.choice((draw.rectangle, draw.ellipse, draw.line))
+        if shape == draw.line:
+            shape(box, fill=color, width=rng.randint(1, 5))
+        else:
+            shape(box, fill=color, outline=(0, 0, 0))
+    return img
+
+
+def encode_raster_figure(rng, kind):
+    img = raster_figure(rng, rng.randint(200, 2400), rng.randint(200, 1800))
+    figure_buffer = BytesIO()
+    if kind == "jpg":
+        img.save(figure_buffer, format="JPEG", quality=rng.randint(70, 95))
+    else:
+        if rng.random() < 0.3:
+            img = img.quantize(256)
+        img.save(figure_buffer, format="PNG")
+    return figure_buffer.getvalue()
+
+
+def vector_drawing(rng, width, height, fill, rect, stroke, line):
+    # Operators of a random plot in PDF or PostScript syntax
+    commands = []
+    for _ in range(rng.randint(10, 60)):
+        color = f"{rng.random():.3f} {rng.random():.3f} {rng.random():.3f}"
+        x, y = rng.uniform(0, width), rng.uniform(0, height)
+        if rng.random() < 0.5:
+            commands.append(f"{color} {fill} {x:.1f} {y:.1f} {rng.uniform(1, width / 3):.1f} {rng.uniform(1, height / 3):.1f} {rect}")
+        else:
+            commands.append(f"{color} {stroke} {x:.1f} {y:.1f} {line[0]} {rng.uniform(0, width):.1f} {rng.uniform(0, height):.1f} {line[1]}")
+    return "\n".join(commands) + "\n"
+
+
+def pdf_figure(rng):
+    width, height = rng.randint(150, 600), rng.randint(100, 450)
+    content = vector_drawing(rng, width, height, "rg", "re f", "RG", ("m", "l S")).encode("ascii")
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width} {height}] /Contents 4 0 R >>".encode("ascii"),
+        b"<< /Length %d >>\nstream\n" % len(content) + content + b"endstream",
+    ]
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for i, pdf_object in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n" % i + pdf_object + b"\nendobj\n"
+    xref_offset = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_offset)
+    return pdf
+
+
+def eps_figure(rng):
+    width, height = rng.randint(150, 600), rng.randint(100, 450)
+    drawing = vector_drawing(rng, width, height, "setrgbcolor", "rectfill", "setrgbcolor newpath", ("moveto", "lineto stroke"))
+    return f"%!PS-Adobe-3.0 EPSF-3.0\n%%BoundingBox: 0 0 {width} {height}\n%%EndComments\n{drawing}showpage\n%%EOF\n".encode("ascii")
+
+
+def figure_bytes(rng, kind):
+    if kind == "pdf":
+        return pdf_figure(rng)
+    if kind == "eps":
+        return eps_figure(rng)
+    return encode_raster_figure(rng, kind)
+
+
+def tex_figure(rng, graphics, caption, label):
+    lines = ["\\begin{figure}[t]", "\\centering"]
+    lines += [f"\\includegraphics[width={rng.choice(('0.8', '0.48', ''))}\\linewidth]{{{graphic}}}" for graphic in graphics]
+    if caption is not None:
+        lines.append(f"\\caption{{{caption}}}")
+    lines += [f"\\label{{fig:{label}}}", "\\end{figure}"]
+    return "\n".join(lines)
+
+
+def tex_caption(rng):
+    parts = [words(rng, rng.randint(4, 20)).capitalize()]
+    if rng.random() < 0.5:
+        parts.append(f"$\\mathcal{{L}}_{{{rng.randint(1, 9)}}} = x^{rng.randint(2, 4)}$")
+    if rng.random() < 0.5:
+        parts.append(f"\\textbf{{{words(rng, 2)}}} {words(rng, rng.randint(2, 10))}")
+    return " ".join(parts) + "."
+
+
+def tex_source(rng, figures):
+    # figures are (graphics, caption) tuples, placed between sections of text, math and lists
+    body = ["\\documentclass{article}", "\\usepackage{graphicx}", "\\newcommand{\\R}{\\mathbb{R}}", "\\begin{document}"]
+    for i, (graphics, caption) in enumerate(figures):
+        body.append(f"\\section{{{words(rng, 3)}}}")
+        body += [words(rng, rng.randint(50, 200)) + f" $x_{i} \\in \\R^{{{rng.randint(2, 512)}}}$ % {words(rng, 3)}" for _ in range(rng.randint(1, 4))]
+        if rng.random() < 0.3:
+            body += ["\\begin{equation}", f"y = \\sum_{{i=1}}^{{{rng.randint(2, 9)}}} w_i x_i", "\\end{equation}"]
+        if rng.random() < 0.3:
+            body += ["\\begin{itemize}", *(f"\\item {words(rng, 8)}" for _ in range(3)), "\\end{itemize}"]
+        body.append(tex_figure(rng, graphics, caption, i))
+    body.append("\\end{document}")
+    return "\n".join(body).encode("utf-8")
+
+
+def paper_figures(rng):
+    # Returns the source members of the figures of a paper and their (graphics, caption) tuples in the .tex source
+    members = []
+    figures = []
+    for i in range(rng.randint(1, 6)):
+        graphics = []
+        for j in range(2 if rng.random() < 0.1 else 1):  # figures with several graphics are skipped by the extractor
+            kind = rng.choices([kind for kind, _ in FIGURE_KINDS], [weight for _, weight in FIGURE_KINDS])[0]
+            path = f"figures/fig{i}{'abc'[j]}.{kind}"
+            members.append((path, figure_bytes(rng, kind)))
+            graphics.append(path if rng.random() < 0.7 else splitext(path)[0])
+        figures.append((graphics, tex_caption(rng) if rng.random() < 0.85 else None))
+    return members, figures
+
+
+def paper_bytes(rng):
+    if rng.random() < 0.1:
+        return gzip.compress(tex_source(rng, []), mtime=0)  # single source file papers are skipped
+    members, figures = paper_figures(rng)
+    return gzip.compress(tar_bytes([("main.tex", tex_source(rng, figures)), *members]), mtime=0)
+
+
+def nxml_source(rng, paper_id, figure_ids):
+    figures = "\n".join(f'<fig id="F{i}" position="float"><label>Figure {i}</label><caption><p>{words(rng, rng.randint(5, 40))}</p></caption><graphic xlink:href="{figure_id}"/></fig>' for i, figure_id in enumerate(figure_ids, 1))
+    paragraphs = "\n".join(f"<p>{words(rng, rng.randint(50, 200))}</p>" for _ in range(rng.randint(3, 12)))
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<article xmlns:xlink="http://www.w3.org/1999/xlink" article-type="research-article">
+<front><article-meta><article-id pub-id-type="pmc">{paper_id}</article-id><title-group><article-title>{words(rng, 8)}</article-title></title-group></article-meta></front>
+<body><sec><title>{words(rng, 3)}</title>
+{paragraphs}
+{figures}
+</sec></body>
+</article>
+""".encode("utf-8")
+
+
+def package_bytes(rng, paper_id):
+    figure_ids = [f"fig{i}" for i in range(rng.randint(1, 8))]
+    members = [(f"{paper_id}/{figure_id}.jpg", encode_raster_figure(rng, "jpg")) for figure_id in figure_ids]
+    captioned_ids = [figure_id for figure_id in figure_ids if rng.random() < 0.9]
+    members.append((f"{paper_id}/{paper_id}.nxml", nxml_source(rng, paper_id, captioned_ids)))
+    members.append((f"{paper_id}/{paper_id}.pdf", rng.randbytes(rng.randint(50_000, 500_000))))  # ignored by the extractor
+    return gzip.compress(tar_bytes(members), mtime=0)
+
+
+def generate_fixtures(fixture_dir, seed, num_papers, num_packages):
+    rng = Random(seed)
+    arxiv_dir = join(fixture_dir, "arxiv")
+    makedirs(arxiv_dir)
+    for archive_index, start in enumerate(range(0, num_papers, PAPERS_PER_ARCHIVE)):
+        papers = [(f"2001/2001.{i:05d}.gz", paper_bytes(rng)) for i in range(start, min(start + PAPERS_PER_ARCHIVE, num_papers))]
+        with open(join(arxiv_dir, f"arXiv_src_2001_{archive_index + 1:03d}.tar"), "wb") as archive_file:
+            archive_file.write(tar_bytes(papers))
+
+    pmc_dir = join(fixture_dir, "pmc")
+    makedirs(pmc_dir)
+    with open(join(pmc_dir, "oa_file_list.csv"), "w", encoding="utf-8", newline="") as file_list_file:
+        writer = csv.writer(file_list_file)
+        writer.writerow(["File", "Article Citation", "Accession ID", "Last Updated (YYYY-MM-DD HH:MM:SS)", "PMID", "License"])
+        for i in range(num_packages):
+            paper_id = f"PMC{i:07d}"
+            package_path = f"oa_package/{i % 100:02d}/{i // 100 % 100:02d}/{paper_id}.tar.gz"
+            makedirs(join(pmc_dir, dirname(package_path)), exist_ok=True)
+            with open(join(pmc_dir, package_path), "wb") as package_file:
+                package_file.write(package_bytes(rng, paper_id))
+            writer.writerow([package_path, words(rng, 5), paper_id, "2023-01-01 00:00:00", str(i), "CC BY"])
+
+    shard_dir = join(fixture_dir, "shards")
+    makedirs(shard_dir)
+    samples = []
+    for i in range(2 * num_papers):
+        name = f"2001.{i // 4:05d}-fig{i % 4}"
+        samples.append((f"{name}.jpg", encode_raster_figure(rng, "jpg")))
+        samples.append((f"{name}.txt", words(rng, rng.randint(5, 40)).encode("utf-8")))
+    for shard_index, start in enumerate(range(0, len(samples), 2 * SAMPLES_PER_SHARD)):
+        with open(join(shard_dir, f"{shard_index:08d}.tar"), "wb") as shard_file:
+            shard_file.write(tar_bytes(samples[start:start + 2 * SAMPLES_PER_SHARD]))
+
+
+def prepare_fixtures(fixture_dir, seed, num_papers, num_packages):
+    # Fixtures of an earlier run are reused if they were generated with the same parameters
+    manifest = {"version": FIXTURE_VERSION, "seed": seed, "num_papers": num_papers, "num_packages": num_packages}
+    manifest_path = join(fixture_dir, "fixture.json")
+    if isfile(manifest_path):
+        with open(manifest_path) as manifest_file:
+            if load(manifest_file) == manifest:
+                return manifest
+    rmtree(fixture_dir, ignore_errors=True)
+    print(f"Generating fixtures in {fixture_dir}")
+    generate_fixtures(fixture_dir, seed, num_papers, num_packages)
+    with open(manifest_path, "w") as manifest_file:
+        dump(manifest, manifest_file)
+    return manifest
+
+
+def read_papers(fixture_dir):
+    papers = []
+    for archive_path in sorted(glob(join(fixture_dir, "arxiv", "*.tar"))):
+        with tarfile.open(archive_path) as archive:
+            papers += [(splitext(basename(tar_info.name))[0], archive.extractfile(tar_info).read()) for tar_info in archive]
+    return papers
+
+
+def read_packages(fixture_dir):
+    package_paths = sorted(glob(join(fixture_dir, "pmc", "oa_package", "*", "*", "*.tar.gz")))
+    packages = []
+    for package_path in package_paths:
+        with open(package_path, "rb") as package_file:
+            packages.append((basename(package_path)[:-len(".tar.gz")], package_file.read()))
+    return packages
+
+
+def count_output_images(output_dir):
+    num_images = 0
+    for tar_path in glob(join(output_dir, "*.tar")):
+        with tarfile.open(tar_path) as tar:
+            num_images += sum(1 for tar_info in tar if tar_info.name.endswith((".jpg", ".webp")))
+    return num_images
+
+
+# Every stage is set up from the fixtures outside of the measurement and returns a function that runs the measured work
+# and returns its counts: the number of items (papers, packages or samples), figures and input bytes.
+
+def setup_tex(fixture_dir, work_dir):
+    sources = []
+    for _, paper in read_papers(fixture_dir):
+        if not tarfile.is_tarfile(BytesIO(paper)):
+            continue
+        with tarfile.open(fileobj=BytesIO(paper), mode="r:gz") as paper_tar:
+            members = {tar_info.name: paper_tar.extractfile(tar_info).read() for tar_info in paper_tar}
+        graphics = [name for name in members if name.endswith(arxiv.ACCEPTED_IMG_EXTENSIONS)]
+        sources += [(tex_bytes, graphics) for name, tex_bytes in members.items() if name.endswith(".tex")]
+
+    def run():
+        num_captions = sum(len(arxiv.process_tex_file(tex_bytes, graphics)) for tex_bytes, graphics in sources)
+        return {"items": len(sources), "figures": num_captions, "bytes": sum(len(tex_bytes) for tex_bytes, _ in sources)}
+    return run
+
+
+def setup_figures(fixture_dir, work_dir):
+    figures = []
+    for _, paper in read_papers(fixture_dir):
+        if tarfile.is_tarfile(BytesIO(paper)):
+            with tarfile.open(fileobj=BytesIO(paper), mode="r:gz") as paper_tar:
+                figures += [(tar_info.name, paper_tar.extractfile(tar_info).read()) for tar_info in paper_tar if tar_info.name.startswith("figures/")]
+
+    def run():
+        for image_path, image_bytes in figures:
+            process_image(image_bytes, image_path)
+        return {"items": len(figures), "figures": len(figures), "bytes": sum(len(image_bytes) for _, image_bytes in figures)}
+    return run
+
+
+def setup_arxiv_papers(fixture_dir, work_dir):
+    papers = read_papers(fixture_dir)
+
+    def run():
+        num_figures = 0
+        for arxiv_id, paper in papers:
+            members = arxiv.process_paper(arxiv_id, BytesIO(paper), render_timeout=0)
+            num_figures += sum(1 for name, _, _ in members if not name.endswith(".txt"))
+        return {"items": len(papers), "figures": num_figures, "bytes": sum(len(paper) for _, paper in papers)}
+    return run
+
+
+def setup_pmc_xml(fixture_dir, work_dir):
+    sources = [pmc.read_package(BytesIO(package)) for _, package in read_packages(fixture_dir)]
+
+    def run():
+        num_captions = sum(len(pmc.extract_caption_per_figure_from_xml(BytesIO(xml_bytes), image_files.keys())) for xml_bytes, image_files in sources)
+        return {"items": len(sources), "figures": num_captions, "bytes": sum(len(xml_bytes) for xml_bytes, _ in sources)}
+    return run
+
+
+def setup_pmc_packages(fixture_dir, work_dir):
+    packages = read_packages(fixture_dir)
+
+    def run():
+        num_figures = 0
+        for paper_id, package in packages:
+            members = pmc.extract_figures_and_captions_from_archive(BytesIO(package), paper_id)
+            num_figures += sum(1 for name, _, _ in members if not name.endswith(".txt"))
+        return {"items": len(packages), "figures": num_figures, "bytes": sum(len(package) for _, package in packages)}
+    return run
+
+
+def setup_convert(fixture_dir, work_dir):
+    # Shards are converted in place, so copies are converted
+    shard_paths = [copy(shard_path, work_dir) for shard_path in sorted(glob(join(fixture_dir, "shards", "*.tar")))]
+    num_bytes = sum(getsize(shard_path) for shard_path in shard_paths)
+
+    def run():
+        num_samples = sum(len(process_tar_file(shard_path)) for shard_path in shard_paths)
+        return {"items": num_samples, "figures": num_samples, "bytes": num_bytes}
+    return run
+
+
+def setup_arxiv_end_to_end(fixture_dir, work_dir):
+    input_dir = join(fixture_dir, "arxiv")
+    output_dir = join(work_dir, "arxiv")
+    num_papers = len(read_papers(fixture_dir))
+    num_bytes = sum(getsize(archive_path) for archive_path in glob(join(input_dir, "*.tar")))
+
+    def run():
+        arxiv.main(input_dir, output_dir)
+        return {"items": num_papers, "figures": count_output_images(output_dir), "bytes": num_bytes}
+    return run
+
+
+class QuietHTTPRequestHandler(SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the PMC FTP server
+
+    def log_message(self, format, *args):
+        pass
+
+
+def setup_pmc_end_to_end(fixture_dir, work_dir):
+    pmc_dir = join(fixture_dir, "pmc")
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(QuietHTTPRequestHandler, directory=pmc_dir))
+    Thread(target=server.serve_forever, daemon=True).start()
+    output_dir = join(work_dir, "pmc")
+    packages = read_packages(fixture_dir)
+    num_packages = len(packages)
+    num_bytes = sum(len(package) for _, package in packages)
+    del packages  # not held in memory during the measurement
+
+    def run():
+        pmc.main(output_dir, join(pmc_dir, "oa_file_list.csv"), join(work_dir, "package_index.tsv"), f"http://127.0.0.1:{server.server_address[1]}/")
+        return {"items": num_packages, "figures": count_output_images(output_dir), "bytes": num_bytes}
+    return run
+
+
+STAGES = {
+    "tex": ("papers", setup_tex),
+    "figures": ("figures", setup_figures),
+    "arxiv_papers": ("papers", setup_arxiv_papers),
+    "pmc_xml": ("packages", setup_pmc_xml),
+    "pmc_packages": ("packages", setup_pmc_packages),
+    "convert": ("samples", setup_convert),
+    "arxiv_end_to_end": ("papers", setup_arxiv_end_to_end),
+    "pmc_end_to_end": ("packages", setup_pmc_end_to_end),
+}
+
+
+def reset_peak_rss():
+    # Resets the peak RSS (VmHWM) of the process to its current RSS. Returns False if this is not supported (Linux only).
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs_file:
+            clear_refs_file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    with open("/proc/self/status") as status_file:
+        return next(int(line.split()[1]) for line in status_file if line.startswith("VmHWM:")) / 1024
+
+
+def run_stage(stage, fixture_dir, work_dir, connection):
+    try:
+        run = STAGES[stage][1](fixture_dir, work_dir)
+        # The peak RSS only covers the measured work (and the inputs the setup keeps in memory) where it can be reset,
+        # and includes the setup otherwise
+        peak_rss_resettable = reset_peak_rss()
+        start_time = perf_counter()
+        counts = run()
+        seconds = perf_counter() - start_time
+        # The children only include processes that were reaped, e.g. renderers. The workers of the extraction scripts
+        # are started from a fork server (see worker_pool.py), which only exits with the stage process, so their peak
+        # RSS is not measured (it can be bounded with --max_worker_rss).
+        rss_mb = peak_rss_mb() if peak_rss_resettable else getrusage(RUSAGE_SELF).ru_maxrss / 1024
+        connection.send({**counts, "seconds": seconds, "peak_rss_mb": rss_mb, "peak_rss_includes_setup": not peak_rss_resettable, "children_peak_rss_mb": getrusage(RUSAGE_CHILDREN).ru_maxrss / 1024})
+    except Exception as e:
+        connection.send({"error": f"{type(e).__name__}: {e}"})
+
+
+def measure_stage(stage, fixture_dir, repeat):
+    # Runs a stage repeat times, each in a fresh process and working directory. The fastest run is reported, together
+    # with the highest peak RSS of all runs.
+    context = get_context("spawn")
+    runs = []
+    for _ in range(repeat):
+        work_dir = mkdtemp(prefix=f"benchmark-{stage}-")
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=run_stage, args=(stage, fixture_dir, work_dir, sender))
+        process.start()
+        sender.close()
+        try:
+            result = receiver.recv()
+        except EOFError:
+            result = None  # the process died, e.g. killed by the OOM killer
+        process.join()
+        if result is None:
+            result = {"error": f"process exited with code {process.exitcode}"}
+        rmtree(work_dir, ignore_errors=True)
+        if "error" in result:
+            raise RuntimeError(result["error"])
+        runs.append(result)
+    result = min(runs, key=lambda run: run["seconds"])
+    seconds = result["seconds"]
+    return {
+        "unit": STAGES[stage][0],
+        **{key: result[key] for key in ("items", "figures", "bytes", "seconds")},
+        "items_per_second": result["items"] / seconds,
+        "figures_per_second": result["figures"] / seconds,
+        "mb_per_second": result["bytes"] / 1024 ** 2 / seconds,
+        "peak_rss_mb": max(run["peak_rss_mb"] for run in runs),
+        "peak_rss_includes_setup": any(run["peak_rss_includes_setup"] for run in runs),
+        "children_peak_rss_mb": max(run["children_peak_rss_mb"] for run in runs),
+    }
+
+
+def print_result(stage, result):
+    setup_note = ", including the setup" if result["peak_rss_includes_setup"] else ""
+    print(f"{stage}: {result['items']} {result['unit']} in {result['seconds']:.2f}s, {result['items_per_second']:.1f} {result['unit']}/s, {result['figures_per_second']:.1f} figures/s, {result['mb_per_second']:.2f} MB/s, peak RSS {result['peak_rss_mb']:.0f} MB{setup_note} (reaped children {result['children_peak_rss_mb']:.0f} MB)")
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    # Returns the regressions: stages whose throughput dropped or whose peak RSS grew by more than tolerance, and stages
+    # of the baseline that failed or were not run
+    if results["fixture"] != baseline["fixture"]:
+        print(f"Warning: the baseline was measured on different fixtures ({baseline['fixture']})")
+    regressions = []
+    for stage in baseline["stages"]:
+        if stage in results["failed_stages"]:
+            print(f"{stage}: failed ({results['failed_stages'][stage]}) REGRESSION")
+            regressions.append((stage, "failed"))
+        elif stage not in results["stages"]:
+            print(f"{stage}: not run REGRESSION")
+            regressions.append((stage, "missing"))
+    for stage, result in results["stages"].items():
+        reference = baseline["stages"].get(stage)
+        if reference is None:
+            continue
+        for metric, higher_is_better in (("items_per_second", True), ("figures_per_second", True), ("peak_rss_mb", False)):
+            if not reference[metric]:
+                continue
+            change = result[metric] / reference[metric] - 1
+            regressed = -change > tolerance if higher_is_better else change > tolerance
+            print(f"{stage} {metric}: {reference[metric]:.2f} -> {result[metric]:.2f} ({change:+.1%}){' REGRESSION' if regressed else ''}")
+            if regressed:
+                regressions.append((stage, metric))
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark the extraction and conversion stages on deterministic synthetic fixtures")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=list(STAGES), help="Stages to run")
+    parser.add_argument("--fixture_dir", type=str, default="data/benchmark/fixtures", help="Directory the fixtures are generated in, and reused from if they match the parameters")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the fixtures")
+    parser.add_argument("--num_papers", type=int, default=200, help="Number of arXiv papers")
+    parser.add_argument("--num_packages", type=int, default=200, help="Number of PMC packages")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs per stage, the fastest of which is reported")
+    parser.add_argument("-o", "--output", type=str, default=None, help="JSON file to save the results to, e.g. to use them as a baseline")
+    parser.add_argument("-b", "--baseline", type=str, default=None, help="JSON file of earlier results to compare to")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Relative change of throughput or peak RSS that is reported as a regression")
+    args = parser.parse_args()
+
+    fixture_dir = abspath(args.fixture_dir)
+    fixture = prepare_fixtures(fixture_dir, args.seed, args.num_papers, args.num_packages)
+    results = {"fixture": fixture, "python": sys.version, "stages": {}, "failed_stages": {}}
+    for stage in args.stages:
+        try:
+            results["stages"][stage] = measure_stage(stage, fixture_dir, args.repeat)
+        except Exception as e:
+            print(f"Failed benchmarking stage {stage}, error message:")
+            print(e)
+            results["failed_stages"][stage] = str(e)
+            continue
+        print_result(stage, results["stages"][stage])
+    if args.output is not None:
+        makedirs(dirname(abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as output_file:
+            dump(results, output_file, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            baseline = load(baseline_file)
+        if compare_to_baseline(results, baseline, args.tolerance):
+            sys.exit(1)
+    elif results["failed_stages"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+import argparse
+from collections import Counter
+from functools import partial
+from glob import glob
+from io import BytesIO
+from json import dump, loads
+from mmap import ACCESS_READ, mmap
+from multiprocessing import Pool
+from os.path import basename, isfile, join, splitext
+from struct import unpack
+import tarfile
+
+from PIL import Image
+import pyarrow.parquet as pq
+
+
+PERCENTILES = (1, 5, 25, 50, 75, 95, 99)
+HISTOGRAMS = ("caption_length", "image_width", "image_height")
+IMAGE_EXTENSIONS = (".jpg", ".webp")
+HEADER_BYTES = 64 * 1024  # read from indexed shards to find the image dimensions
+
+
+def empty_stats():
+    # Every partial result consists of counters only, so that results of shards can be merged by adding them
+    return {"counts": Counter(), "caption_length": Counter(), "image_bytes": Counter(), "image_width": Counter(), "image_height": Counter(), "paper_figures": Counter()}
+
+
+def merge_stats(total, partial):
+    for name, counter in partial.items():
+        total[name].update(counter)
+    return total
+
+
+def paper_id_from_name(name):
+    return splitext(basename(name))[0].split("-")[0]
+
+
+def add_caption(stats, text):
+    stats["counts"]["captions"] += 1
+    stats["counts"]["caption_characters"] += len(text)
+    stats["caption_length"][len(text)] += 1
+
+
+def add_image_size(stats, size):
+    stats["counts"]["images"] += 1
+    stats["counts"]["image_bytes"] += size
+    stats["image_bytes"][size.bit_length()] += 1  # power of two buckets
+
+
+def webp_dimensions(header):
+    # Pillow decodes the whole file to open a WebP image, so the dimensions are read from its first chunk instead
+    if header[8:12] != b"WEBP" or len(header) < 30:
+        return None
+    chunk = header[12:16]
+    if chunk == b"VP8 ":
+        width, height = unpack("<HH", header[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b"VP8L":
+        bits = unpack("<I", header[21:25])[0]
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X":
+        return int.from_bytes(header[24:27], "little") + 1, int.from_bytes(header[27:30], "little") + 1
+    return None
+
+
+def image_dimensions(image_bytes):
+    # image_bytes may be a prefix of the image, which is enough if it contains its header
+    if image_bytes[:4] == b"RIFF":
+        return webp_dimensions(image_bytes)
+    try:
+        with Image.open(BytesIO(image_bytes)) as image:  # only parses the header
+            return image.size
+    except Exception:
+        return None
+
+
+def add_image_dimensions(stats, dimensions):
+    if dimensions is None:
+        stats["counts"]["unreadable_images"] += 1
+        return
+    width, height = dimensions
+    stats["image_width"][width] += 1
+    stats["image_height"][height] += 1
+
+
+def add_image(stats, image_bytes):
+    add_image_size(stats, len(image_bytes))
+    add_image_dimensions(stats, image_dimensions(image_bytes))
+
+
+def tar_stats(tar_path):
+    # Reads the shard once, sequentially
+    stats = empty_stats()
+    stats["counts"]["shards"] += 1
+    samples = {}
+    with tarfile.open(tar_path, "r|") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            stats["counts"]["members"] += 1
+            stem, ext = splitext(member.name)
+            sample = samples.setdefault(stem, {"paper_id": paper_id_from_name(member.name)})
+            data = tar.extractfile(member).read()
+            if ext in IMAGE_EXTENSIONS:
+                add_image(stats, data)
+                sample["image"] = True
+            elif ext == ".txt":
+                add_caption(stats, data.decode("utf-8"))
+                sample["txt"] = True
+            elif ext == ".json":
+                # Samples of converted shards are keyed by position, the paper id is only contained in their metadata
+                sample["paper_id"] = loads(data).get("paper_id", sample["paper_id"])
+    for sample in samples.values():
+        if sample.get("image") and sample.get("txt"):
+            stats["counts"]["samples"] += 1
+            stats["paper_figures"][sample["paper_id"]] += 1
+        elif sample.get("image"):
+            stats["counts"]["orphaned_images"] += 1
+        elif sample.get("txt"):
+            stats["counts"]["orphaned_txt"] += 1
+    return stats
+
+
+def parquet_stats(tar_path, parquet_path):
+    # Uses the img2dataset metadata and the member index of a converted shard instead of reading it sequentially. Image
+    # sizes are taken from the index, and image dimensions from the headers of the images at their indexed offsets.
+    stats = empty_stats()
+    stats["counts"]["shards"] += 1
+    table = pq.read_table(parquet_path, columns=["text", "paper_id"])
+    for text in table.column("text").to_pylist():
+        add_caption(stats, text)
+    stats["counts"]["samples"] += table.num_rows
+    stats["paper_figures"].update(table.column("paper_id").to_pylist())
+    index = pq.read_table(tar_path + ".idx", columns=["name", "offset", "size"])
+    stats["counts"]["members"] += index.num_rows
+    with open(tar_path, "rb") as tar_file, mmap(tar_file.fileno(), 0, access=ACCESS_READ) as tar_mmap:
+        for name, offset, size in zip(*(index.column(column).to_pylist() for column in ("name", "offset", "size"))):
+            if name.endswith(IMAGE_EXTENSIONS):
+                add_image_size(stats, size)
+                # Only the header is copied out of the mapping, unless it is preceded by large metadata segments
+                dimensions = image_dimensions(tar_mmap[offset:offset + min(size, HEADER_BYTES)])
+                if dimensions is None and size > HEADER_BYTES:
+                    dimensions = image_dimensions(tar_mmap[offset:offset + size])
+                add_image_dimensions(stats, dimensions)
+    return stats
+
+
+def shard_stats(tar_path, use_metadata=True):
+    parquet_path = splitext(tar_path)[0] + ".parquet"
+    try:
+        if use_metadata and isfile(parquet_path) and isfile(tar_path + ".idx"):
+            return parquet_stats(tar_path, parquet_path)
+        return tar_stats(tar_path)
+    except Exception as e:
+        print(f"Reading {tar_path} failed, error message:")
+        print(e)
+        stats = empty_stats()
+        stats["counts"]["failed_shards"] += 1
+        return stats
+
+
+def percentiles(histogram, ranks=PERCENTILES):
+    total = sum(histogram.values())
+    result = {}
+    if total == 0:
+        return result
+    values = sorted(histogram)
+    seen = 0
+    i = 0
+    for value in values:
+        seen += histogram[value]
+        while i < len(ranks) and seen >= ranks[i] / 100 * total:
+            result[f"p{ranks[i]}"] = value
+            i += 1
+    return result
+
+
+def summarize(stats):
+    counts = stats["counts"]
+    summary = {"counts": dict(counts)}
+    if counts["captions"]:
+        summary["mean_caption_length"] = counts["caption_characters"] / counts["captions"]
+    if counts["images"]:
+        summary["mean_image_bytes"] = counts["image_bytes"] / counts["images"]
+    for name in HISTOGRAMS:
+        summary[f"{name}_percentiles"] = percentiles(stats[name])
+    summary["caption_length_histogram"] = dict(sorted(stats["caption_length"].items()))
+    summary["image_bytes_histogram"] = {f"<{2 ** bucket}": count for bucket, count in sorted(stats["image_bytes"].items())}
+    figures_per_paper = Counter(stats["paper_figures"].values())
+    summary["papers"] = len(stats["paper_figures"])
+    summary["figures_per_paper_percentiles"] = percentiles(figures_per_paper)
+    summary["figures_per_paper_histogram"] = dict(sorted(figures_per_paper.items()))
+    return summary
+
+
+def dataset_stats(directory, processes=None, use_metadata=True):
+    tar_paths = sorted(glob(join(directory, "**", "*.tar"), recursive=True))
+    total = empty_stats()
+    with Pool(processes=processes) as pool:
+        for shard in pool.imap_unordered(partial(shard_stats, use_metadata=use_metadata), tar_paths):
+            merge_stats(total, shard)
+    return summarize(total)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calculate statistics of a dataset of tar files in a single pass.")
+    parser.add_argument("directory", help="The directory containing the tar files.")
+    parser.add_argument("-p", "--processes", type=int, default=None, help="Number of shards read in parallel.")
+    parser.add_argument("--no_metadata", action="store_true", help="Always read the tar files sequentially, even if img2dataset metadata and a member index exist.")
+    parser.add_argument("--output", help="Path of a JSON file to write the statistics to.")
+    args = parser.parse_args()
+
+    summary = dataset_stats(args.directory, args.processes, not args.no_metadata)
+    counts = summary["counts"]
+    print(f"Shards: {counts.get('shards', 0)} ({counts.get('failed_shards', 0)} failed)")
+    print(f"Samples: {counts.get('samples', 0)} from {summary['papers']} papers")
+    print(f"Images: {counts.get('images', 0)}, captions: {counts.get('captions', 0)}")
+    print(f"Orphaned images: {counts.get('orphaned_images', 0)}, orphaned .txt: {counts.get('orphaned_txt', 0)}")
+    if "mean_caption_length" in summary:
+        print(f"Average caption length: {summary['mean_caption_length']:.2f} characters, percentiles: {summary['caption_length_percentiles']}")
+    if "mean_image_bytes" in summary:
+        print(f"Average image size: {summary['mean_image_bytes']:.0f} bytes, percentiles of width: {summary['image_width_percentiles']}, height: {summary['image_height_percentiles']}")
+    print(f"Figures per paper percentiles: {summary['figures_per_paper_percentiles']}")
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            dump(summary, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
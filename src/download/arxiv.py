@@ -1,14 +1,21 @@
 #!/usr/bin/env python
 from argparse import ArgumentParser
-from glob import glob
+from concurrent.futures import ThreadPoolExecutor, wait
 from hashlib import md5
-from os import makedirs
-from os.path import dirname, exists, getsize, isfile, join
-from tarfile import is_tarfile
+from os import makedirs, remove, replace
+from os.path import abspath, basename, dirname, exists, getsize, isfile, join
+import sys
+from threading import Condition, Lock
 import xml.etree.ElementTree as ET
 
 from boto3 import client
 
+sys.path.append(join(dirname(dirname(abspath(__file__))), "process"))
+from partitions import add_partition_arguments, check_partition_arguments, in_partition
+
+
+LEDGER_FILENAME = "download_ledger.tsv"
+
 
 def md5sum(file_path):
     file_hash = md5()
@@ -22,55 +29,170 @@ def verify_integrity(file_path, original_md5sum):
     return md5sum(file_path) == original_md5sum
 
 
-def directory_size(dir_path):
-    return sum(getsize(f) for f in glob(join(dir_path, "**/*"), recursive=True))
+def download_file_from_bucket(s3, bucket_name, object_name, file_path):
+    s3.download_file(bucket_name, object_name, file_path, ExtraArgs={"RequestPayer": "requester"})
 
 
-def download_file_from_bucket(bucket_name, object_name, file_path):
-    s3 = client("s3")
-    s3.download_file(bucket_name, object_name, file_path, ExtraArgs={"RequestPayer": "requester"})
+def download_verified_file_from_bucket(s3, bucket_name, object_name, file_path, original_md5sum, chunk_size=1024 ** 2):
+    # Streams the object to a partial file while computing its MD5 sum, and only moves it to file_path if it matches
+    partial_file_path = file_path + ".partial"
+    file_hash = md5()
+    body = s3.get_object(Bucket=bucket_name, Key=object_name, RequestPayer="requester")["Body"]
+    with open(partial_file_path, "wb") as f:
+        for chunk in body.iter_chunks(chunk_size):
+            file_hash.update(chunk)
+            f.write(chunk)
+    if file_hash.hexdigest() != original_md5sum:
+        remove(partial_file_path)
+        return False
+    replace(partial_file_path, file_path)
+    return True
+
+
+class DownloadLedger:
+    # Append-only record of the verified downloads and their sizes, so that resuming a download and enforcing the
+    # maximum download size do not need to scan or hash the already downloaded files
+    def __init__(self, ledger_path):
+        self.ledger_path = ledger_path
+        self.lock = Lock()
+        self.files = {}
+        if isfile(ledger_path):
+            with open(ledger_path, encoding="utf-8") as ledger_file:
+                for line in ledger_file:
+                    fields = line.rstrip("\n").split("\t")
+                    if line.endswith("\n") and len(fields) == 3:
+                        self.files[fields[0]] = int(fields[1])
+
+    @property
+    def size(self):
+        return sum(self.files.values())
+
+    def __contains__(self, filename):
+        return filename in self.files
 
+    def record(self, filename, size, md5_sum):
+        with self.lock:
+            with open(self.ledger_path, "a", encoding="utf-8") as ledger_file:
+                ledger_file.write(f"{filename}\t{size}\t{md5_sum}\n")
+            self.files[filename] = size
 
-def get_manifest(bucket_name, manifest_path="data/download/src/arXiv_src_manifest.xml", manifest_key="src/arXiv_src_manifest.xml"):
+
+class DiskBudget:
+    # Limits the bytes of downloaded files that are on disk at the same time. acquire() blocks until enough bytes are
+    # released by the consumer of the downloads, unless nothing is acquired (so a single file may exceed the budget).
+    def __init__(self, budget):
+        self.budget = budget
+        self.used = 0
+        self.condition = Condition()
+
+    def acquire(self, size, block=True):
+        with self.condition:
+            while block and self.used > 0 and self.used + size > self.budget:
+                self.condition.wait()
+            self.used += size
+
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+class DownloadSize:
+    # Size of the downloaded files and the files being downloaded, shared by the download threads. The size of a file is
+    # reserved before it is downloaded and released again if the download fails, so that failed files do not count
+    # against the maximum download size.
+    def __init__(self, size, max_size):
+        self.size = size
+        self.max_size = max_size
+        self.lock = Lock()
+
+    def reserve(self, size):
+        with self.lock:
+            if self.size + size >= self.max_size:
+                return False
+            self.size += size
+            return True
+
+    def release(self, size):
+        with self.lock:
+            self.size -= size
+
+
+def get_manifest(s3, bucket_name, manifest_path="data/download/src/arXiv_src_manifest.xml", manifest_key="src/arXiv_src_manifest.xml"):
     if not exists(manifest_path):
         makedirs(dirname(manifest_path), exist_ok=True)
-        download_file_from_bucket(bucket_name, manifest_key, manifest_path)
+        download_file_from_bucket(s3, bucket_name, manifest_key, manifest_path)
     return ET.parse(manifest_path).getroot()
 
 
-def download_arxiv_tars(bucket_name="arxiv", start_item="2001.00001", end_item="2012.15864", max_size=100, output_dir="data/download"):
-    max_size_byte = max_size * 1024 ** 3
-    downloaded_size = directory_size(output_dir)
-    print(f"Already downloaded {downloaded_size} bytes")
-    manifest = get_manifest(bucket_name, join(output_dir, "src/arXiv_src_manifest.xml"))
+def download_manifest_file(s3, bucket_name, filename, file_path, size, md5_sum, ledger, on_downloaded=None, disk_budget=None, download_size=None):
+    if isfile(file_path) and getsize(file_path) == size and verify_integrity(file_path, md5_sum):
+        ledger.record(filename, size, md5_sum)  # downloaded before the ledger existed
+    else:
+        print(f"Downloading {filename}")
+        makedirs(dirname(file_path), exist_ok=True)
+        try:
+            success = download_verified_file_from_bucket(s3, bucket_name, filename, file_path, md5_sum)
+        except Exception as e:
+            print(f"Downloading {filename} failed, error message:")
+            print(e)
+            success = False
+        if not success:
+            print(f"Downloading {filename} not successful.")
+            if disk_budget is not None:
+                disk_budget.release(size)
+            if download_size is not None:
+                download_size.release(size)
+            return
+        ledger.record(filename, size, md5_sum)
+    if on_downloaded is not None:
+        on_downloaded(file_path, size)
+
+
+def download_arxiv_tars(bucket_name="arxiv", start_item="2001.00001", end_item="2012.15864", max_size=100, output_dir="data/download", num_workers=8, endpoint_url=None, on_downloaded=None, disk_budget=None, num_partitions=1, partition_index=0):
+    # on_downloaded(file_path, size) is called for every verified file. Verified files that were downloaded by an earlier
+    # run are passed as well if they are still on disk. If disk_budget is given, every file is acquired from it before
+    # it is downloaded, and it is up to the consumer to release it. With num_partitions > 1, only the archives of
+    # partition_index are downloaded (see partitions.py).
+    makedirs(output_dir, exist_ok=True)
+    s3 = client("s3", endpoint_url=endpoint_url)  # clients are thread safe
+    ledger = DownloadLedger(join(output_dir, LEDGER_FILENAME))
+    download_size = DownloadSize(ledger.size, max_size * 1024 ** 3)
+    print(f"Already downloaded {ledger.size} bytes")
+    manifest = get_manifest(s3, bucket_name, join(output_dir, "src/arXiv_src_manifest.xml"))
     start_item_found = False
     end_item_found = False
-    for file_element in manifest.findall("file"):
-        first_item = file_element.find("first_item").text
-        if first_item == start_item:
-            start_item_found = True
-        last_item = file_element.find("last_item").text
-        if last_item == end_item:
-            end_item_found = True
-        if first_item == start_item:
-        if start_item_found and not end_item_found:
-            filename = file_element.find("filename").text
-            print(f"Downloading {filename}")
-            size = int(file_element.find("size").text)
-            if downloaded_size + size >= max_size_byte:
-                print(f"Max size of {max_size} GB reached, stopping.") 
-                break
-            file_path = join(output_dir, filename)
-            if isfile(file_path) and is_tarfile(file_path):
-                continue
-            makedirs(dirname(file_path), exist_ok=True)
-            md5_sum = file_element.find("md5sum").text
-            download_file_from_bucket(bucket_name, filename, file_path)
-            success = verify_integrity(file_path, md5_sum)
-            if not success:
-                print(f"Downloading {filename} not successful.")
-                continue
-            downloaded_size += size
+    futures = []
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for file_element in manifest.findall("file"):
+            first_item = file_element.find("first_item").text
+            if first_item == start_item:
+                start_item_found = True
+            last_item = file_element.find("last_item").text
+            if last_item == end_item:
+                end_item_found = True
+            if start_item_found and not end_item_found:
+                filename = file_element.find("filename").text
+                if not in_partition(basename(filename), num_partitions, partition_index):
+                    continue
+                file_path = join(output_dir, filename)
+                size = int(file_element.find("size").text)
+                if filename in ledger:
+                    if on_downloaded is not None and isfile(file_path):
+                        if disk_budget is not None:
+                            disk_budget.acquire(size, block=False)  # already on disk
+                        on_downloaded(file_path, size)
+                    continue
+                if not download_size.reserve(size):
+                    # Downloads that are still running may fail and release their size
+                    wait(futures)
+                    if not download_size.reserve(size):
+                        print(f"Max size of {max_size} GB reached, stopping.")
+                        break
+                md5_sum = file_element.find("md5sum").text
+                if disk_budget is not None:
+                    disk_budget.acquire(size)
+                futures.append(executor.submit(download_manifest_file, s3, bucket_name, filename, file_path, size, md5_sum, ledger, on_downloaded, disk_budget, download_size))
 
 
 if __name__ == "__main__":
@@ -79,5 +201,9 @@ if __name__ == "__main__":
     parser.add_argument("-s", "--start_item", default="astro-ph0001001")
     parser.add_argument("-e", "--end_item", default="2012.15864")
     parser.add_argument("-o", "--output_dir", default="data/download/arxiv")
+    parser.add_argument("-n", "--num_workers", default=8, type=int, help="Number of concurrent downloads")
+    parser.add_argument("--endpoint_url", default=None, help="S3 endpoint URL, e.g. of a local S3 stand-in")
+    add_partition_arguments(parser)
     args = parser.parse_args()
-    download_arxiv_tars(max_size=args.max_size, start_item=args.start_item)
+    check_partition_arguments(parser, args)
+    download_arxiv_tars(max_size=args.max_size, start_item=args.start_item, end_item=args.end_item, output_dir=args.output_dir, num_workers=args.num_workers, endpoint_url=args.endpoint_url, num_partitions=args.num_partitions, partition_index=args.partition_index)
@@ -1,54 +1,94 @@
 #!/usr/bin/env python3
 import argparse
+from functools import partial
+from multiprocessing import Pool
 import os
 import tarfile
 import jsonlines
+import pyarrow as pa
+import pyarrow.parquet as pq
 
-def extract_info_from_tar(tar_file, output_file, use_archive_filename):
-    with tarfile.open(tar_file, 'r') as archive, jsonlines.open(output_file, mode='a') as writer:
-        entries = archive.getnames()
+FIGURE_TYPE = pa.struct([("image_filename", pa.string()), ("caption", pa.string())])
+
+
+def extract_info_from_tar(tar_file, use_archive_filename):
+    # Pairs the members in a single pass over the headers, only the captions are read
+    with tarfile.open(tar_file, 'r') as archive:
         papers_data = {}
-        
-        for entry in entries:
-            if entry.endswith('.jpg'):
+        figures = {}  # caption filename -> figure of an image whose caption was not read yet
+        captions = {}  # caption filename -> caption whose image was not seen yet
+
+        for member in archive:
+            entry = member.name
+            if entry.endswith(('.jpg', '.webp')):
                 image_filename_parts = entry.split("-")
                 paper_id = image_filename_parts[0]
-                image_filename = "-".join(image_filename_parts[1:])
-                caption_filename = entry.replace('.jpg', '.txt')
-                if caption_filename in entries:
-                    with archive.extractfile(caption_filename) as caption_file:
-                        caption = caption_file.read().decode('utf-8').strip()
-                    if paper_id not in papers_data:
-                        papers_data[paper_id] = {"paper_id": paper_id, "figures": []}
-                        if use_archive_filename:
-                           papers_data[paper_id].update({"archive_filename": os.path.basename(tar_file)})
-                    papers_data[paper_id]["figures"].append({
-                        "image_filename": image_filename,
-                        "caption": caption
-                    })
-        if papers_data:
-             writer.write_all(papers_data.values())
-
-def extract_dataset_metadata(input_dir, output_file, use_archive_filename):
+                caption_filename = os.path.splitext(entry)[0] + '.txt'
+                if paper_id not in papers_data:
+                    papers_data[paper_id] = {"paper_id": paper_id, "figures": []}
+                    if use_archive_filename:
+                        papers_data[paper_id].update({"archive_filename": os.path.basename(tar_file)})
+                figure = {"image_filename": "-".join(image_filename_parts[1:]), "caption": captions.pop(caption_filename, None)}
+                papers_data[paper_id]["figures"].append(figure)
+                if figure["caption"] is None:
+                    figures[caption_filename] = figure
+            elif entry.endswith('.txt'):
+                with archive.extractfile(member) as caption_file:
+                    caption = caption_file.read().decode('utf-8').strip()
+                if entry in figures:
+                    figures.pop(entry)["caption"] = caption
+                else:
+                    captions[entry] = caption
+
+    # Images without caption are skipped
+    for paper in papers_data.values():
+        paper["figures"] = [figure for figure in paper["figures"] if figure["caption"] is not None]
+    return [paper for paper in papers_data.values() if paper["figures"]]
+
+
+def parquet_schema(use_archive_filename):
+    fields = [("paper_id", pa.string())]
+    if use_archive_filename:
+        fields.append(("archive_filename", pa.string()))
+    fields.append(("figures", pa.list_(FIGURE_TYPE)))
+    return pa.schema(fields)
+
+
+def extract_dataset_metadata(input_dir, output_file, use_archive_filename, output_format="jsonl", processes=None):
     if os.path.isfile(output_file):
-       os.remove(output_file)
-    for tar_file in os.listdir(input_dir):
-        if tar_file.endswith('.tar'):
-            tar_path = os.path.join(input_dir, tar_file)
-            extract_info_from_tar(tar_path, output_file, use_archive_filename)
+        os.remove(output_file)
+    tar_paths = sorted(os.path.join(input_dir, tar_file) for tar_file in os.listdir(input_dir) if tar_file.endswith('.tar'))
+    if output_format == "parquet":
+        schema = parquet_schema(use_archive_filename)
+        writer = pq.ParquetWriter(output_file, schema)
+    else:
+        writer = jsonlines.open(output_file, mode='w')
+    # Shards are processed in parallel, but written in order, one row group per shard
+    with Pool(processes=processes) as pool, writer:
+        for papers_data in pool.imap(partial(extract_info_from_tar, use_archive_filename=use_archive_filename), tar_paths):
+            if not papers_data:
+                continue
+            if output_format == "parquet":
+                writer.write_table(pa.Table.from_pylist(papers_data, schema=schema))
+            else:
+                writer.write_all(papers_data)
+
 
 def main():
-    parser = argparse.ArgumentParser(description="Process tar files and generate JSONL output")
+    parser = argparse.ArgumentParser(description="Process tar files and generate JSONL or Parquet output")
     parser.add_argument("input_dir", help="Directory containing tar files")
-    parser.add_argument("output_file", help="Output JSONL file")
+    parser.add_argument("output_file", help="Output JSONL or Parquet file")
     parser.add_argument("-n", "--use_archive_filename", action="store_true")
-    
+    parser.add_argument("-f", "--format", choices=["jsonl", "parquet"], default=None, help="Output format, by default inferred from the extension of the output file")
+    parser.add_argument("-p", "--processes", type=int, default=None, help="Number of tar files processed in parallel")
+
     args = parser.parse_args()
-    
+
     input_dir = args.input_dir
     output_file = args.output_file
-    
-    extract_dataset_metadata(input_dir, output_file, args.use_archive_filename)
+    output_format = args.format or ("parquet" if output_file.endswith(".parquet") else "jsonl")
+
+    extract_dataset_metadata(input_dir, output_file, args.use_archive_filename, output_format, args.processes)
 
 if __name__ == "__main__":
     main()
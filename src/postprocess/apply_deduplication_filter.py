@@ -1,28 +1,73 @@
 #!/usr/bin/env python3
 from argparse import ArgumentParser
 from glob import glob
-from os.path import join
+from os import remove
+from os.path import getsize, join
 
 import numpy as np
-import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+
+UID_DTYPE = np.dtype("u8,u8")
+HEX_VALUES = np.full(256, 255, dtype=np.uint64)
+HEX_VALUES[np.frombuffer(b"0123456789", dtype=np.uint8)] = np.arange(10)
+HEX_VALUES[np.frombuffer(b"abcdef", dtype=np.uint8)] = np.arange(10, 16)
+HEX_VALUES[np.frombuffer(b"ABCDEF", dtype=np.uint8)] = np.arange(10, 16)
+NIBBLE_SHIFTS = np.arange(60, -1, -4, dtype=np.uint64)
+
+
+def decode_uids(uids):
+    # Decodes the first 32 hex characters of every uid of a string array into two 64 bit integers, without creating
+    # Python objects for the uids
+    uids = pc.cast(uids, pa.large_string())
+    if uids.null_count:
+        raise ValueError("uid column contains nulls")
+    _, offsets_buffer, data_buffer = uids.buffers()
+    offsets = np.frombuffer(offsets_buffer, dtype=np.int64)[uids.offset:uids.offset + len(uids) + 1]
+    if np.any(np.diff(offsets) < 32):
+        raise ValueError("uids need to consist of at least 32 hex characters")
+    data = np.frombuffer(data_buffer, dtype=np.uint8) if data_buffer is not None else np.empty(0, dtype=np.uint8)
+    nibbles = HEX_VALUES[data[offsets[:-1, None] + np.arange(32)]]
+    if np.any(nibbles == 255):
+        raise ValueError("uids need to consist of hex characters")
+    processed_uids = np.empty(len(uids), dtype=UID_DTYPE)
+    processed_uids["f0"] = np.bitwise_or.reduce(nibbles[:, :16] << NIBBLE_SHIFTS, axis=1)
+    processed_uids["f1"] = np.bitwise_or.reduce(nibbles[:, 16:] << NIBBLE_SHIFTS, axis=1)
+    return processed_uids
 
 
 def load_uids_with_duplicate_score(metadata_dir, out_filename, key="dedup-isc-ft-v107-score", threshold=0.604169):
-    uids = []
-    for parquet_file in glob(join(metadata_dir, "*.parquet")):
-        df = pd.read_parquet(parquet_file, columns=["uid", key])
-        uids += df[df[key] <= threshold]["uid"].values.tolist()
-    processed_uids = np.array([(int(uid[:16], 16), int(uid[16:32], 16)) for uid in uids], np.dtype("u8,u8"))
-    processed_uids.sort()
-    np.save(out_filename, processed_uids)
-    
+    # The threshold filter is applied while scanning the Parquet files (in parallel), and the decoded uids of every
+    # batch are appended to a temporary file, which is sorted in place as a memory map
+    if not out_filename.endswith(".npy"):
+        out_filename += ".npy"  # like np.save
+    dataset = ds.dataset(sorted(glob(join(metadata_dir, "*.parquet"))), format="parquet")
+    scanner = dataset.scanner(columns=["uid"], filter=pc.field(key) <= threshold, use_threads=True)
+    unsorted_filename = out_filename + ".unsorted"
+    with open(unsorted_filename, "wb") as unsorted_file:
+        for batch in scanner.to_batches():
+            if batch.num_rows > 0:
+                decode_uids(batch.column("uid")).tofile(unsorted_file)
+    num_uids = getsize(unsorted_filename) // UID_DTYPE.itemsize
+    if num_uids == 0:
+        np.save(out_filename, np.empty(0, dtype=UID_DTYPE))
+    else:
+        processed_uids = np.lib.format.open_memmap(out_filename, mode="w+", dtype=UID_DTYPE, shape=(num_uids,))
+        processed_uids[:] = np.memmap(unsorted_filename, dtype=UID_DTYPE, mode="r")
+        processed_uids.sort()
+        processed_uids.flush()
+        del processed_uids
+    remove(unsorted_filename)
+
 
 def main():
     parser = ArgumentParser()
     parser.add_argument("metadata_dir", help="Directory containing the metadata parquet files of a img2dataset-style dataset.")
     parser.add_argument("out_filename", help="Name of the file to write the output to (consistingi of the uids of samples with a duplication score below the threshold).")
     parser.add_argument("-k", "--key", help="The column name used in the metadata parquet file(s) to identify the duplication score.", default="dedup-isc-ft-v107-score")
-    parser.add_argument("-t", "--threshold", help="The treshold value used to classify a sample as duplicate.", default=0.604169)
+    parser.add_argument("-t", "--threshold", type=float, help="The treshold value used to classify a sample as duplicate.", default=0.604169)
     args = parser.parse_args()
     load_uids_with_duplicate_score(args.metadata_dir, args.out_filename, key=args.key, threshold=args.threshold)
 
@@ -1,104 +1,113 @@
 #!/usr/bin/env python3
 from argparse import ArgumentParser
 from glob import glob
-from io import BytesIO
-from json import dump, dumps
+from json import dumps
+from multiprocessing import Pool
 import os
-from os.path import basename, join, splitext
+from os import cpu_count
+from os.path import abspath, basename, dirname, join, splitext
+import sys
 import tarfile
-from uuid import uuid4
 
-import pyarrow as pa
-import pyarrow.parquet as pq
+sys.path.append(join(dirname(dirname(abspath(__file__))), "process"))
+from img2dataset_format import sample_metadata, sample_uid, write_shard_metadata
+from phash import hash_image_bytes
+from shard_index import IMAGE_ATTRIBUTE_TYPES, IMAGE_EXTENSIONS, ShardIndexBuilder, StaleIndexError, index_path, read_index, replace_shard
+from shards import add_bytes_to_tar
+
+
+def iter_samples(tar):
+    # Pairs the image (.jpg or .webp) and .txt members of a sample in a single sequential pass. Only samples whose other
+    # member has not been read yet are kept in memory, which are few since the members of a sample are written next to
+    # each other.
+    pending = {}
+    for member in tar:
+        stem, ext = splitext(member.name)
+        if ext not in (*IMAGE_EXTENSIONS, ".txt"):
+            continue
+        kind = "txt" if ext == ".txt" else "image"
+        data = tar.extractfile(member).read()
+        other = pending.pop((stem, "image" if kind == "txt" else "txt"), None)
+        if other is None:
+            pending[stem, kind] = (member.name, data)
+        elif kind == "image":
+            yield member.name, data, other[1]
+        else:
+            yield other[0], other[1], data
+
+
+def read_image_attributes(tar_file):
+    # Image attributes of the members of a shard from its member index
+    if not os.path.isfile(index_path(tar_file)):
+        return {}
+    try:
+        index = read_index(tar_file, ["name", *IMAGE_ATTRIBUTE_TYPES])
+    except StaleIndexError as e:
+        print(e)
+        return {}
+    return {row.pop("name"): row for row in index.to_pylist()}
+
+
+def image_attributes(attributes, image_name, image_data):
+    attributes = {column: attributes.get(image_name, {}).get(column) for column in IMAGE_ATTRIBUTE_TYPES}
+    if attributes["phash"] is None:
+        try:
+            attributes["phash"] = hash_image_bytes(image_data)  # shards written before the hashes were indexed
+        except Exception as e:
+            print(f"Could not hash image {image_name}, error message:")
+            print(e)
+    return attributes
 
 
 def process_tar_file(tar_file):
     tar_base_name = os.path.splitext(os.path.basename(tar_file))[0]
+    metadata = []
+    # TODO: could save all metadata listed in https://github.com/rom1504/img2dataset/blob/main/README.md
 
-    with tarfile.open(tar_file, 'r') as tar:
-        member_names = tar.getnames()
-        jpg_members = [member for member in tar.getmembers() if member.name.endswith('.jpg') and splitext(member.name)[0] + ".txt" in member_names]
-        jpg_members.sort(key=lambda x: x.name)
-        metadata = {"uid": [], "key": [], "text": [], "paper_id": [], "original_image_filename": []}
-        # TODO: could save all metadata listed in https://github.com/rom1504/img2dataset/blob/main/README.md
+    # Write the updated members to a temporary file, which replaces the original .tar file once it is complete
+    partial_tar_file = tar_file + ".partial"
+    index = ShardIndexBuilder()
+    source_attributes = read_image_attributes(tar_file)
 
-        # Create a new in-memory tar file for the updated members
-        new_tar_data = BytesIO()
-        new_tar = tarfile.open(fileobj=new_tar_data, mode='w')
+    def add_member(name, file_bytes, attributes=None):
+        index.add(name, add_bytes_to_tar(new_tar, name, file_bytes), len(file_bytes), attributes)
 
-        for i, member in enumerate(jpg_members):
+    with tarfile.open(tar_file, 'r') as tar, tarfile.open(partial_tar_file, 'w') as new_tar:
+        for i, (image_name, image_data, txt_data) in enumerate(iter_samples(tar)):
             new_basename = f"{tar_base_name}{i:06d}"
-            new_jpg_name = new_basename + ".jpg"
-            new_txt_name = new_basename + ".txt"
-
-            # Extract and rename .jpg and .txt members
-            jpg_data = tar.extractfile(member).read()
-            new_tarinfo = tarfile.TarInfo(new_jpg_name)
-            new_tarinfo.size = len(jpg_data)
-            new_tar.addfile(new_tarinfo, BytesIO(jpg_data))
-
-            txt_member = tar.getmember(os.path.splitext(member.name)[0] + ".txt")
-            txt_data = tar.extractfile(txt_member).read()
-            new_tarinfo = tarfile.TarInfo(new_txt_name)
-            new_tarinfo.size = len(txt_data)
-            new_tar.addfile(new_tarinfo, BytesIO(txt_data))
-
-            metadata_member = {
-                "uid": uuid4().hex,
-                "key": new_basename,
-                "text": txt_data.decode("utf-8"),
-                "paper_id": splitext(basename(member.name))[0].split("-")[0],
-                "original_image_filename": "-".join(basename(member.name).split("-")[1:]),
-            }
-
-            json_tarinfo = tarfile.TarInfo(new_basename + ".json")
-            json_bytes = dumps(metadata_member).encode("utf-8")
-            json_tarinfo.size = len(json_bytes)
-            new_tar.addfile(json_tarinfo, BytesIO(json_bytes))
-
-            # Add metadata
-            metadata["uid"].append(metadata_member["uid"])
-            metadata["key"].append(metadata_member["key"])
-            metadata["text"].append(metadata_member["text"])
-            metadata["paper_id"].append(metadata_member["paper_id"])
-            metadata["original_image_filename"].append(metadata_member["original_image_filename"])
-
-        new_tar.close()
-
-    # Replace the original .tar file with the new in-memory tar data
-    with open(tar_file, 'wb') as new_tar_file:
-        new_tar_file.write(new_tar_data.getvalue())
-
-    return metadata
+            attributes = image_attributes(source_attributes, image_name, image_data)
+            add_member(new_basename + splitext(image_name)[1], image_data, attributes)
+            add_member(new_basename + ".txt", txt_data)
 
+            # The uid only depends on the name of the sample, so that it is the same if the shards are created again
+            metadata_member = sample_metadata(sample_uid(splitext(basename(image_name))[0]), new_basename, image_name, txt_data.decode("utf-8"), attributes)
+            add_member(new_basename + ".json", dumps(metadata_member).encode("utf-8"))
+            metadata.append(metadata_member)
+    index.write(tar_file, partial_tar_file)
+    replace_shard(partial_tar_file, tar_file)
 
-def save_metadata_to_parquet(tar_filename, metadata):
-    base_name = os.path.splitext(tar_filename)[0]
-    parquet_filename = base_name + ".parquet"
-    table = pa.Table.from_pydict(metadata)
-    pq.write_table(table, parquet_filename)
+    return metadata
 
 
-def save_stats_json(tar_filename, count):
-    stats_json_filename = splitext(tar_filename)[0] + "_stats.json"
-    stats_json = {"count": count, "successes": count}
-    with open(stats_json_filename, "w") as stats_json_file:
-        dump(stats_json, stats_json_file)
+def convert_shard(tar_filename):
+    metadata = process_tar_file(tar_filename)
+    write_shard_metadata(tar_filename, metadata)
+    return tar_filename
 
 
 def main():
     parser = ArgumentParser()
     parser.add_argument("input_directory", help="Directory containing .tar files")
+    parser.add_argument("-p", "--processes", type=int, default=cpu_count(), help="Number of shards converted in parallel")
 
     args = parser.parse_args()
 
     input_directory = args.input_directory
 
-    # Process all .tar files in the directory
-    for tar_filename in sorted(glob(join(input_directory, "*.tar"))):
-        metadata = process_tar_file(tar_filename)
-        save_metadata_to_parquet(tar_filename, metadata)
-        save_stats_json(tar_filename, len(next(iter(metadata.values()))))
+    # Process all .tar files in the directory. The keys of a shard only depend on its filename.
+    with Pool(processes=args.processes) as pool:
+        for tar_filename in pool.imap_unordered(convert_shard, sorted(glob(join(input_directory, "*.tar")))):
+            print(f"Converted {tar_filename}")
 
 if __name__ == "__main__":
     main()
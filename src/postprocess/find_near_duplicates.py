@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser
+from glob import glob
+from os.path import abspath, dirname, join
+import sys
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+sys.path.append(join(dirname(dirname(abspath(__file__))), "process"))
+from phash import hamming_distances
+
+
+def load_hashes(metadata_dirs):
+    # Reads the uids and perceptual hashes of the img2dataset metadata of one or more datasets
+    parquet_files = sorted(parquet_file for metadata_dir in metadata_dirs for parquet_file in glob(join(metadata_dir, "*.parquet")))
+    table = ds.dataset(parquet_files, format="parquet").to_table(columns=["uid", "phash"], filter=pc.field("phash").is_valid(), use_threads=True)
+    return table.column("uid"), table.column("phash").to_numpy()
+
+
+def pairs_to_first(ids, groups):
+    # Pairs every entry with the first entry of its group
+    order = np.argsort(groups, kind="stable")
+    sorted_groups = groups[order]
+    starts = np.r_[True, sorted_groups[1:] != sorted_groups[:-1]]
+    first_positions = np.maximum.accumulate(np.where(starts, np.arange(len(order)), 0))
+    return ids[order[first_positions[~starts]]], ids[order[~starts]]
+
+
+def find_roots(parents, entries):
+    # Roots of the entries in the forest of components, whose paths are compressed to point to them directly
+    roots = parents[entries]
+    while True:
+        next_roots = parents[roots]
+        if np.array_equal(next_roots, roots):
+            break
+        roots = next_roots
+    parents[entries] = roots
+    return roots
+
+
+def link_pairs(parents, first, second, firsts, seconds):
+    # Merges the components of the pairs. Only the pairs that merge two components are kept, so at most one pair less
+    # than there are entries is kept in total, however often a pair is found.
+    while len(first):
+        first_roots = find_roots(parents, first)
+        second_roots = find_roots(parents, second)
+        apart = first_roots != second_roots
+        first, second = first[apart], second[apart]
+        high = np.maximum(first_roots[apart], second_roots[apart])
+        low = np.minimum(first_roots[apart], second_roots[apart])
+        # Every root is linked to the smallest root it is paired with. The links point to smaller roots, so they can not
+        # form cycles, and every link merges two components.
+        order = np.lexsort((low, high))
+        linked = order[np.r_[True, high[order][1:] != high[order][:-1]]] if len(order) else order
+        parents[high[linked]] = low[linked]
+        firsts.append(first[linked])
+        seconds.append(second[linked])
+        unlinked = np.ones(len(first), dtype=bool)
+        unlinked[linked] = False
+        first, second = first[unlinked], second[unlinked]
+
+
+def mixed_groups(parents, ids, groups):
+    # Whether the group of every entry contains entries of more than one component. Pairs within a component can not
+    # change the components, so only such groups need to be searched.
+    unique_groups, inverse = np.unique(groups, return_inverse=True)
+    roots = find_roots(parents, ids)
+    low = np.full(len(unique_groups), len(parents))
+    high = np.full(len(unique_groups), -1)
+    np.minimum.at(low, inverse, roots)
+    np.maximum.at(high, inverse, roots)
+    return (low != high)[inverse]
+
+
+def search_buckets(hashes, parents, ids, values, groups, width, max_distance, num_bands, max_bucket_size, firsts, seconds):
+    # Links the components of the pairs within max_distance among the entries ids of the same group. values are the
+    # width bits of their hashes that are not yet known to be identical within their group, and are distinct within a
+    # group.
+    if len(ids) < 2:
+        return
+    if width <= max_distance:
+        link_pairs(parents, *pairs_to_first(ids, groups), firsts, seconds)  # all entries of a group are within max_distance
+        return
+    num_bands = min(num_bands, width)
+    band_bits = width // num_bands
+    band_shifts = [band * band_bits for band in range(num_bands)]
+    band_keys = [(values >> np.uint64(shift)) & np.uint64((1 << (band_bits if band < num_bands - 1 else width - shift)) - 1) for band, shift in enumerate(band_shifts)]
+    # If a band is identical within a group, all pairs of the group are in the same bucket of that band, so the group is
+    # only searched in the first such band
+    group_order = np.argsort(groups, kind="stable")
+    group_starts = np.flatnonzero(np.r_[True, groups[group_order][1:] != groups[group_order][:-1]])
+    only_band = np.full(len(group_starts), -1)
+    for band in reversed(range(num_bands)):
+        keys = band_keys[band][group_order]
+        only_band[np.minimum.reduceat(keys, group_starts) == np.maximum.reduceat(keys, group_starts)] = band
+    only_band = only_band[np.searchsorted(groups[group_order][group_starts], groups)]
+    for band, shift in enumerate(band_shifts):
+        searched = (only_band == -1) | (only_band == band)
+        if band > 0:
+            searched[searched] = mixed_groups(parents, ids[searched], groups[searched])  # groups merged by earlier bands
+        if not searched.any():
+            continue
+        band_ids, band_values, band_groups, keys = ids[searched], values[searched], groups[searched], band_keys[band][searched]
+        order = np.lexsort((band_values, keys, band_groups))
+        sorted_groups = band_groups[order]
+        sorted_keys = keys[order]
+        buckets = np.cumsum(np.r_[True, (sorted_groups[1:] != sorted_groups[:-1]) | (sorted_keys[1:] != sorted_keys[:-1])]) - 1
+        large = np.bincount(buckets)[buckets] > max_bucket_size
+        for offset in range(1, max_bucket_size):
+            same_bucket = (buckets[:-offset] == buckets[offset:]) & ~large[offset:]
+            if not same_bucket.any():
+                break
+            first = band_ids[order[:-offset][same_bucket]]
+            second = band_ids[order[offset:][same_bucket]]
+            apart = find_roots(parents, first) != find_roots(parents, second)
+            first, second = first[apart], second[apart]
+            close = hamming_distances(hashes[first], hashes[second]) <= max_distance
+            link_pairs(parents, first[close], second[close], firsts, seconds)
+        large[large] = mixed_groups(parents, band_ids[order[large]], buckets[large])
+        if large.any():
+            # Larger buckets are searched again on the remaining bits, with the band_bits lowest bits of the band
+            # removed from the values. Any higher bits of the last band are identical within a bucket.
+            large_values = band_values[order[large]]
+            high_values = large_values >> np.uint64(shift + band_bits) if shift + band_bits < 64 else np.zeros_like(large_values)
+            remaining_values = (high_values << np.uint64(shift)) | (large_values & np.uint64((1 << shift) - 1))
+            search_buckets(hashes, parents, band_ids[order[large]], remaining_values, buckets[large], width - band_bits, max_distance, num_bands, max_bucket_size, firsts, seconds)
+
+
+def find_near_duplicate_pairs(hashes, max_distance=4, num_bands=None, max_bucket_size=64):
+    # Multi-index hashing: the hashes are split into num_bands bands. If two hashes differ in at most max_distance bits
+    # and num_bands > max_distance, at least one of their bands is identical, so only hashes in the same bucket of some
+    # band need to be compared. Every band is sorted by (band, hash), and the entries of buckets of at most
+    # max_bucket_size entries are compared with all following entries of their bucket, one offset at a time. Larger
+    # buckets are split into bands of their remaining bits in the same way, which keeps the search exact however many
+    # hashes share a bucket. The components of the pairs found so far are kept in a union-find forest: pairs within a
+    # component are not compared, and buckets within a single component are not searched further. Identical hashes
+    # are linked to the first of them and only searched once. Returns a spanning forest of the pairs within
+    # max_distance, i.e. fewer pairs than hashes, whose connected components are those of all such pairs.
+    num_bands = num_bands or max_distance + 1
+    parents = np.arange(len(hashes))
+    firsts = [np.zeros(0, dtype=np.int64)]
+    seconds = [np.zeros(0, dtype=np.int64)]
+    order = np.argsort(hashes, kind="stable")
+    sorted_hashes = hashes[order]
+    unique = np.r_[True, sorted_hashes[1:] != sorted_hashes[:-1]]
+    link_pairs(parents, *pairs_to_first(order, np.cumsum(unique)), firsts, seconds)
+    representatives = order[unique]
+    search_buckets(hashes, parents, representatives, hashes[representatives], np.zeros(len(representatives), dtype=np.int64), 64, max_distance, num_bands, max_bucket_size, firsts, seconds)
+    return np.concatenate(firsts), np.concatenate(seconds)
+
+
+def cluster_pairs(num_entries, firsts, seconds):
+    # Connected components of the pairs, labeled by their smallest entry, using label propagation with pointer jumping
+    labels = np.arange(num_entries)
+    while True:
+        smaller = np.minimum(labels[firsts], labels[seconds])
+        previous = labels.copy()
+        np.minimum.at(labels, firsts, smaller)
+        np.minimum.at(labels, seconds, smaller)
+        labels = labels[labels]
+        if np.array_equal(labels, previous):
+            return labels
+
+
+def find_near_duplicates(metadata_dirs, output_file, max_distance=4, num_bands=None, max_bucket_size=64):
+    uids, hashes = load_hashes(metadata_dirs)
+    print(f"Loaded {len(hashes)} hashes")
+    firsts, seconds = find_near_duplicate_pairs(hashes, max_distance, num_bands, max_bucket_size)
+    labels = cluster_pairs(len(hashes), firsts, seconds)
+    cluster_sizes = np.bincount(labels, minlength=len(labels))
+    duplicates = np.flatnonzero(cluster_sizes[labels] > 1)
+    # Every entry of a cluster is listed with the uid of the first entry of the cluster, which can be kept
+    table = pa.table({
+        "uid": uids.take(pa.array(duplicates)),
+        "cluster": uids.take(pa.array(labels[duplicates])),
+        "cluster_size": pa.array(cluster_sizes[labels[duplicates]]),
+    })
+    pq.write_table(table, output_file)
+    num_clusters = np.count_nonzero(cluster_sizes > 1)
+    print(f"Found {num_clusters} clusters containing {len(duplicates)} near-duplicate images, {len(duplicates) - num_clusters} of which can be removed")
+
+
+def main():
+    parser = ArgumentParser(description="Find clusters of near-duplicate images using the perceptual hashes in the img2dataset metadata.")
+    parser.add_argument("metadata_dirs", nargs="+", help="Directories containing the metadata parquet files of img2dataset-style datasets, e.g. data/processed/arxiv data/processed/pmc")
+    parser.add_argument("-o", "--output_file", required=True, help="Parquet file to write the duplicate clusters to, with the columns uid, cluster (uid of the first image of the cluster) and cluster_size")
+    parser.add_argument("-d", "--max_distance", type=int, default=4, help="Maximum Hamming distance of the hashes of near-duplicate images")
+    parser.add_argument("-b", "--num_bands", type=int, default=None, help="Number of bands the hashes are split into. Defaults to max_distance + 1, which finds all pairs within max_distance. Fewer bands are faster, but may miss pairs.")
+    parser.add_argument("--max_bucket_size", type=int, default=64, help="Maximum number of entries of a bucket that are compared with each other. Larger buckets are split on further bits.")
+    args = parser.parse_args()
+    find_near_duplicates(args.metadata_dirs, args.output_file, args.max_distance, args.num_bands, args.max_bucket_size)
+
+
+if __name__ == "__main__":
+    main()
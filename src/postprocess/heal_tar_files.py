@@ -1,62 +1,130 @@
-import os
-from glob import iglob
+#!/usr/bin/env python3
 import argparse
-from shutil import move
-import io
+from glob import glob
+from json import dump
+from multiprocessing import Pool
+import os
+from os.path import splitext
 import tarfile
 
 
-def list_unreadable_tar_files(directory):
-    unreadable_tar_files = []
-
-    # Iterate through files in the directory
-    for file_path in iglob(os.path.join(directory, "*.tar")):
-       try:
-           # Attempt to open the tar file
-           with tarfile.open(file_path, 'r') as tar_file:
-               tar_file.getmembers()
-       except tarfile.ReadError:
-           # Handle the exception if the tar file is unreadable
-           unreadable_tar_files.append(file_path)
-
-    return unreadable_tar_files
-
-
-def extract_and_compress_files(tar_filenames):
-    for tar_filename in tar_filenames:
-        # Extract the tar file
-        with tarfile.open(tar_filename, 'r') as tar:
-            # Create a new tar file to store the compressed files
-            output_tar_filename = f"{os.path.splitext(tar_filename)[0]}_compressed.tar"
-            with tarfile.open(output_tar_filename, 'w') as output_tar:
-                while True:
-                    try:
-                        member = tar.next()
-                        if member is None:
-                            break
-                        # Extract the file
-                        file_content = tar.extractfile(member).read()
-                    except tarfile.ReadError:
-                        break
-                    # Create a new member with the same name in the output tar file
-                    new_member = tarfile.TarInfo(name=member.name)
-                    new_member.size = len(file_content)
-                    # Compress and add the file to the output tar
-                    output_tar.addfile(new_member, fileobj=io.BytesIO(file_content))
-            move(output_tar_filename, tar_filename)
-
-        print(f"Files from {tar_filename} extracted and compressed to {output_tar_filename}")
+BLOCKSIZE = tarfile.BLOCKSIZE
+END_OF_ARCHIVE = tarfile.NUL * 2 * BLOCKSIZE
+
+
+def parse_pax_path(pax_bytes):
+    # Records of pax extended headers have the form "<length> <keyword>=<value>\n"
+    pos = 0
+    while pos < len(pax_bytes):
+        length_end = pax_bytes.find(b" ", pos)
+        if length_end < 0:
+            break
+        length = int(pax_bytes[pos:length_end])
+        keyword, _, value = pax_bytes[length_end + 1:pos + length - 1].partition(b"=")
+        if keyword == b"path":
+            return value.decode("utf-8", "surrogateescape")
+        pos += length
+    return None
+
+
+def scan_tar_file(tar_path):
+    # Walks the 512 byte member headers without reading member data. Returns the names of the complete members, the
+    # offset after the last complete member and whether the archive is properly terminated after it.
+    names = []
+    valid_end = 0
+    terminated = False
+    with open(tar_path, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        offset = 0
+        extended_name = None
+        while True:
+            f.seek(offset)
+            header = f.read(BLOCKSIZE)
+            if len(header) < BLOCKSIZE:
+                break
+            if header == tarfile.NUL * BLOCKSIZE:
+                terminated = True
+                break
+            try:
+                info = tarfile.TarInfo.frombuf(header, tarfile.ENCODING, "surrogateescape")
+            except tarfile.HeaderError:
+                break
+            data_end = offset + BLOCKSIZE + -(-info.size // BLOCKSIZE) * BLOCKSIZE
+            if data_end > file_size:
+                break
+            if info.type in (tarfile.GNUTYPE_LONGNAME, tarfile.XHDTYPE):
+                # Extended headers belong to the next member, which is only complete if that member is
+                extended_data = f.read(info.size)
+                if info.type == tarfile.GNUTYPE_LONGNAME:
+                    extended_name = extended_data.rstrip(tarfile.NUL).decode(tarfile.ENCODING, "surrogateescape")
+                else:
+                    extended_name = parse_pax_path(extended_data) or extended_name
+            elif info.type not in (tarfile.GNUTYPE_LONGLINK, tarfile.XGLTYPE):
+                names.append(extended_name or info.name)
+                extended_name = None
+                valid_end = data_end
+            offset = data_end
+    return names, valid_end, terminated and offset == valid_end
+
+
+def repair_tar_file(tar_path, valid_end):
+    # Drops everything after the last complete member and terminates the archive in place, without copying any data.
+    # A member index of the tar file would now list dropped members, so it is removed.
+    with open(tar_path, "r+b") as f:
+        f.truncate(valid_end)
+        f.seek(valid_end)
+        f.write(END_OF_ARCHIVE)
+    if os.path.isfile(tar_path + ".idx"):
+        os.remove(tar_path + ".idx")
+
+
+def find_unpaired_members(names, extensions=(".jpg", ".txt")):
+    stems = {ext: {splitext(name)[0] for name in names if name.endswith(ext)} for ext in extensions}
+    all_stems = set.union(*stems.values())
+    return sorted(stem + ext for ext in extensions for stem in all_stems - stems[ext])
+
+
+def heal_tar_file(tar_path, repair=True, check_pairs=False):
+    result = {"path": tar_path}
+    try:
+        names, valid_end, complete = scan_tar_file(tar_path)
+    except OSError as e:
+        return {**result, "status": "unreadable", "error": str(e)}
+    result["members"] = len(names)
+    if complete:
+        result["status"] = "ok"
+    else:
+        result["status"] = "repaired" if repair else "broken"
+        result["dropped_bytes"] = os.path.getsize(tar_path) - valid_end
+        if repair:
+            repair_tar_file(tar_path, valid_end)
+    if check_pairs:
+        result["unpaired_members"] = find_unpaired_members(names)
+    return result
+
+
+def heal_tar_files(directory, repair=True, check_pairs=False, processes=None):
+    tar_paths = sorted(glob(os.path.join(directory, "*.tar")))
+    with Pool(processes=processes) as pool:
+        return pool.starmap(heal_tar_file, ((tar_path, repair, check_pairs) for tar_path in tar_paths))
 
 
 def main():
-    parser = argparse.ArgumentParser(description="List unreadable tar files in a directory.")
+    parser = argparse.ArgumentParser(description="Find and repair truncated tar files in a directory.")
     parser.add_argument("directory", help="The directory to search for tar files.")
+    parser.add_argument("--dry_run", action="store_true", help="Only report broken tar files, do not repair them.")
+    parser.add_argument("--check_pairs", action="store_true", help="Also report .jpg members without .txt member and vice versa.")
+    parser.add_argument("--report", help="Path of a JSON file to write the report to.")
+    parser.add_argument("-p", "--processes", type=int, default=None, help="Number of tar files validated in parallel.")
     args = parser.parse_args()
 
-    unreadable_files = list_unreadable_tar_files(args.directory)
-    for unreadable_file in unreadable_files:
-        print(unreadable_file)
-    extract_and_compress_files(unreadable_files)
+    results = heal_tar_files(args.directory, not args.dry_run, args.check_pairs, args.processes)
+    for result in results:
+        if result["status"] != "ok" or result.get("unpaired_members"):
+            print(f"{result['path']}: {result['status']}, {len(result.get('unpaired_members', []))} unpaired members")
+    if args.report is not None:
+        with open(args.report, "w") as report_file:
+            dump(results, report_file, indent=2)
 
 
 if __name__ == "__main__":
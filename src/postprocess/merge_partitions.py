@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# Merges the outputs of the partitions of a multi-node run (see src/process/partitions.py) into their parent output
+# directory. The shards of every partition are renamed, not copied, to the next sequential shard names of the output
+# directory, in the order of the partitions and their manifests. Shards that are not sequentially numbered (the tar
+# files per archive of arxiv.py without --img2dataset_output) keep their names, which are unique across partitions.
+# Every rename is appended to merge_log.tsv. The journals of the partitions are kept, so that a node can process new
+# inputs of its partition later, and the output of that run can be merged again. Shards converted with
+# convert_to_img2dataset.py are keyed by their shard name, so they are converted after merging.
+from argparse import ArgumentParser
+from glob import glob
+from os import replace
+from os.path import abspath, basename, dirname, isdir, isfile, join, splitext
+import re
+import sys
+
+sys.path.append(join(dirname(dirname(abspath(__file__))), "process"))
+from partitions import read_manifest, write_manifest
+from shard_index import index_path
+from shards import SHARD_NAME_PATTERN, next_shard_index, read_completed_items
+
+
+PARTITION_DIR_PATTERN = re.compile(r"^partition-(\d{5})-of-(\d{5})$")
+JOURNAL_FILENAMES = ("completed_papers.txt", "completed_packages.txt")  # see arxiv.py and pmc.py
+MERGE_LOG_FILENAME = "merge_log.tsv"
+
+
+def find_partitions(output_dir):
+    # Maps the index of every partition directory to its path and number of partitions
+    partitions = {}
+    for path in sorted(glob(join(output_dir, "partition-*-of-*"))):
+        match = PARTITION_DIR_PATTERN.match(basename(path))
+        if match and isdir(path):
+            partitions[int(match.group(1))] = (path, int(match.group(2)))
+    return partitions
+
+
+def check_partitions(partitions, allow_incomplete=False):
+    # Returns the partitions that can be merged, which are the ones that have a manifest, i.e. whose run finished
+    num_partitions = {n for _, n in partitions.values()}
+    if len(num_partitions) > 1:
+        raise ValueError(f"Found partitions of runs with different numbers of partitions: {sorted(num_partitions)}")
+    complete = {}
+    for partition_index, (path, n) in sorted(partitions.items()):
+        manifest = read_manifest(path)
+        if manifest is None:
+            continue
+        if (manifest["num_partitions"], manifest["partition_index"]) != (n, partition_index):
+            raise ValueError(f"Manifest of {path} is of partition {manifest['partition_index']} of {manifest['num_partitions']}")
+        complete[partition_index] = (path, manifest)
+    missing = sorted(set(range(num_partitions.pop() if num_partitions else 0)) - complete.keys())
+    if missing and not allow_incomplete:
+        raise ValueError(f"Partitions {missing} are missing or have not finished")
+    return complete
+
+
+def sidecar_paths(tar_path):
+    base_name = splitext(tar_path)[0]
+    return (index_path(tar_path), base_name + ".parquet", base_name + "_stats.json")
+
+
+def move_shard(tar_path, new_tar_path):
+    # The sidecar files are moved first, so that an interrupted merge never leaves a moved shard without them. If it is
+    # interrupted before the tar file is moved, the next merge moves the shard to the same name again.
+    for sidecar_path, new_sidecar_path in zip(sidecar_paths(tar_path), sidecar_paths(new_tar_path)):
+        if isfile(sidecar_path):
+            replace(sidecar_path, new_sidecar_path)
+    replace(tar_path, new_tar_path)
+
+
+def merge_journals(output_dir, partition_dirs):
+    # Rewrites the journals of the output directory as the union of their items and the items of the partitions
+    for journal_filename in JOURNAL_FILENAMES:
+        journal_paths = [join(path, journal_filename) for path in partition_dirs if isfile(join(path, journal_filename))]
+        if not journal_paths:
+            continue
+        journal_path = join(output_dir, journal_filename)
+        items = read_completed_items(journal_path)
+        for partition_journal_path in journal_paths:
+            items |= read_completed_items(partition_journal_path)
+        with open(journal_path + ".partial", "w", encoding="utf-8") as journal_file:
+            journal_file.writelines(f"{item}\n" for item in sorted(items))
+        replace(journal_path + ".partial", journal_path)
+
+
+def merge_partitions(output_dir, allow_incomplete=False):
+    partitions = check_partitions(find_partitions(output_dir), allow_incomplete)
+    shard_index = next_shard_index(output_dir)
+    merged_shards = 0
+    merged_samples = 0
+    with open(join(output_dir, MERGE_LOG_FILENAME), "a", encoding="utf-8") as merge_log:
+        for partition_index, (path, manifest) in sorted(partitions.items()):
+            for shard in manifest["shards"]:
+                tar_path = join(path, shard["name"])
+                if not isfile(tar_path):
+                    continue  # moved by an interrupted merge
+                if SHARD_NAME_PATTERN.match(shard["name"]):
+                    new_name = f"{shard_index:08d}.tar"
+                    shard_index += 1
+                else:
+                    new_name = shard["name"]
+                    if isfile(join(output_dir, new_name)):
+                        raise FileExistsError(f"{new_name} of {path} already exists in {output_dir}")
+                move_shard(tar_path, join(output_dir, new_name))
+                merge_log.write(f"{new_name}\t{basename(path)}\t{shard['name']}\t{shard['samples']}\n")
+                merge_log.flush()
+                merged_shards += 1
+                merged_samples += shard["samples"]
+            # The moved shards are removed from the manifest of the partition, so that a later merge only moves the
+            # shards of a later run of its node
+            write_manifest(path, manifest["num_partitions"], partition_index)
+    merge_journals(output_dir, [path for path, _ in partitions.values()])
+    manifest = write_manifest(output_dir)
+    print(f"Merged {merged_shards} shards with {merged_samples} samples from {len(partitions)} partitions")
+    print(f"{output_dir} contains {len(manifest['shards'])} shards with {manifest['num_samples']} samples")
+
+
+def main():
+    parser = ArgumentParser(description="Renumbers the shards of the partitions of a multi-node run into their output directory")
+    parser.add_argument("output_dir", help="Output directory of the run, containing the partition-<index>-of-<num_partitions> directories")
+    parser.add_argument("--allow_incomplete", action="store_true", help="Merge the finished partitions even if others are missing or have not finished")
+
+    args = parser.parse_args()
+    try:
+        merge_partitions(args.output_dir, args.allow_incomplete)
+    except (ValueError, FileExistsError) as e:
+        print("Merging the partitions failed, error message:")
+        print(e)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,5 +3,8 @@ count=0
 for file in "$1"/*.tar; do
     new_name=$(printf "%08d.tar" "$count")
     mv "$file" "$1/$new_name"
+    if [ -f "$file.idx" ]; then
+        mv "$file.idx" "$1/$new_name.idx"
+    fi
     ((count++))
 done
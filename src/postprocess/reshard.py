@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser
+from glob import glob
+from json import loads
+from multiprocessing import Pool, Value
+from multiprocessing.util import Finalize
+from os import cpu_count, makedirs
+from os.path import abspath, dirname, join, splitext
+import sys
+import tarfile
+
+import numpy as np
+
+from apply_deduplication_filter import UID_DTYPE
+
+sys.path.append(join(dirname(dirname(abspath(__file__))), "process"))
+from img2dataset_format import write_shard_metadata
+from shard_index import IMAGE_ATTRIBUTE_TYPES, IMAGE_EXTENSIONS
+from shards import ShardWriter, next_shard_index, read_completed_items, remove_partial_shards
+
+
+JOURNAL_FILENAME = "resharded_samples.txt"
+
+
+def iter_sample_members(tar):
+    # Groups the members of a sample, which are written next to each other, into a dict mapping extensions to bytes
+    key = None
+    members = {}
+    for member in tar:
+        if not member.isfile():
+            continue
+        stem, ext = splitext(member.name)
+        if stem != key and members:
+            yield key, members
+            members = {}
+        key = stem
+        members[ext] = tar.extractfile(member).read()
+    if members:
+        yield key, members
+
+
+def contains_uid(uids, uid):
+    value = np.array((int(uid[:16], 16), int(uid[16:32], 16)), dtype=UID_DTYPE)
+    i = np.searchsorted(uids, value)
+    return i < len(uids) and uids[i] == value
+
+
+uids = None
+completed_samples = None
+shard_writer = None
+
+
+def init_worker(uids_filename, output_dir, shard_size, shard_counter, completed):
+    global uids, completed_samples, shard_writer
+    uids = np.load(uids_filename, mmap_mode="r")
+    completed_samples = completed
+    shard_writer = ShardWriter(output_dir, shard_size, shard_counter, join(output_dir, JOURNAL_FILENAME), on_finalize=write_shard_metadata)
+    Finalize(shard_writer, shard_writer.close, exitpriority=10)  # finalize the last shard when the pool is closed
+
+
+def reshard_tar_file(tar_path):
+    # Streams an input shard and writes the samples whose uid is contained in the sorted uid array
+    num_samples = 0
+    num_kept = 0
+    try:
+        with tarfile.open(tar_path, "r|") as tar:
+            for key, members in iter_sample_members(tar):
+                num_samples += 1
+                if key in completed_samples or ".json" not in members:
+                    continue
+                metadata = loads(members[".json"])
+                if not contains_uid(uids, metadata["uid"]):
+                    continue
+                attributes = {column: metadata.get(column) for column in IMAGE_ATTRIBUTE_TYPES}
+                shard_writer.write(key, [(key + ext, data, attributes if ext in IMAGE_EXTENSIONS else None) for ext, data in members.items()], [metadata])
+                num_kept += 1
+    except Exception as e:
+        print(f"Failed resharding {tar_path}, error message:")
+        print(e)
+    return tar_path, num_samples, num_kept
+
+
+def main():
+    parser = ArgumentParser(description="Keep the samples of an img2dataset-style dataset whose uids are contained in a sorted uid array and write them to new shards.")
+    parser.add_argument("-i", "--input_dir", required=True, help="Directory containing the input .tar files")
+    parser.add_argument("-o", "--output_dir", required=True, help="Directory to write the new shards to")
+    parser.add_argument("-s", "--subset_file", required=True, help="Sorted .npy file of u8,u8 uids, e.g. written by apply_deduplication_filter.py")
+    parser.add_argument("--shard_size", type=int, default=512, help="Target size of the new shards in MB")
+    parser.add_argument("-p", "--processes", type=int, default=cpu_count(), help="Number of input shards processed in parallel")
+    args = parser.parse_args()
+
+    makedirs(args.output_dir, exist_ok=True)
+    remove_partial_shards(args.output_dir, join(args.output_dir, JOURNAL_FILENAME))  # completes journaled shards, the samples of the others are written again
+    completed = read_completed_items(join(args.output_dir, JOURNAL_FILENAME))
+    shard_counter = Value("q", next_shard_index(args.output_dir))
+    total_samples = 0
+    total_kept = 0
+    with Pool(processes=args.processes, initializer=init_worker, initargs=(args.subset_file, args.output_dir, args.shard_size * 1024 ** 2, shard_counter, completed)) as pool:
+        for tar_path, num_samples, num_kept in pool.imap_unordered(reshard_tar_file, sorted(glob(join(args.input_dir, "*.tar")))):
+            print(f"{tar_path}: kept {num_kept} of {num_samples} samples")
+            total_samples += num_samples
+            total_kept += num_kept
+        pool.close()
+        pool.join()
+    print(f"Kept {total_kept} of {total_samples} samples")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,42 +1,165 @@
 #!/usr/bin/env python
 
 from argparse import ArgumentParser
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 from glob import iglob
 from io import BytesIO
-from multiprocessing import Process, Pool
+from multiprocessing import Value
 from os import cpu_count, makedirs
 from os.path import basename, isfile, join, splitext
 import re
-from subprocess import Popen
 import tarfile
-from tempfile import NamedTemporaryFile
 
 from PIL import Image, UnidentifiedImageError
 from TexSoup import TexSoup
 from TexSoup.tokens import MATH_ENV_NAMES
-from pdf2image import convert_from_bytes
 from pylatexenc.latex2text import LatexNodes2Text
 
+from figure_cache import FigureCache, get_figure_cache, process_figure
+from figures import DEFAULT_ENCODING, DEFAULT_LIMITS, FigureTooLargeError, add_encoding_arguments, add_limit_arguments, check_figure_limits, encoding_from_args, figure_params, image_extension, limits_from_args, process_image, unique_stems
+from renderer import get_renderer
+from shard_index import complete_partial_indexes
+from img2dataset_format import to_img2dataset_members, write_shard_metadata
+from partitions import add_partition_arguments, check_partition_arguments, in_partition, partition_dir, write_manifest
+from metrics import ItemLog, MetricsWriter, add_metrics_arguments, logged_item, timed
+from shards import JournaledTarWriter, ShardWriter, next_shard_index, read_completed_items, remove_partial_shards
+from worker_pool import WorkerPool, add_worker_arguments
 
+
+JOURNAL_FILENAME = "completed_papers.txt"  # with img2dataset_output
 ACCEPTED_IMG_EXTENSIONS = (".jpg", ".jpeg", ".gif", ".png", ".pdf", ".eps", ".ps")
 
 
-def extract_includegraphics_with_captions(tex_source, graphics, accepted_img_extensions=ACCEPTED_IMG_EXTENSIONS, blacklist_terms=["\\href", "\\url", "\\email"]):
-    graphics_wo_ext = [splitext(g)[0] for g in graphics]
-    tex_source = re.sub(r'.*\\newcommand.*\n', '', tex_source)  # TODO: handle user defined commmands better
-    tex_source = re.sub(r'\\caption[\s\t\n]*{', r'\\caption{', tex_source)
+SKIPPED_TEX_ENV_NAMES = MATH_ENV_NAMES + ("$","$$", "itemize", "enumerate")
+TEX_TOKEN_PATTERN = re.compile(r"\\(begin|end)\s*\{([^{}]*)\}|\\(includegraphics|caption)(?![a-zA-Z@*])|\\.|[{}%]", re.DOTALL)
+TEX_BRACE_PATTERN = re.compile(r"\\.|[{}\]]", re.DOTALL)
+TEX_OPTIONAL_ARG_PATTERN = re.compile(r"\s*\[")
+TEX_REQUIRED_ARG_PATTERN = re.compile(r"\s*\{")
+TEX_COMMENT_PATTERN = re.compile(r"(?<!\\)%")
+
+
+def find_closing_bracket(tex_source, pos, closing_bracket="}"):
+    depth = 0
+    for match in TEX_BRACE_PATTERN.finditer(tex_source, pos):
+        token = match.group(0)
+        if token == "{":
+            depth += 1
+        elif token == "}":
+            if depth == 0:
+                return match.start() if closing_bracket == "}" else None
+            depth -= 1
+        elif token == closing_bracket and depth == 0:
+            return match.start()
+    return None
+
+
+def parse_tex_command_args(tex_source, pos):
+    # Returns the last required argument of a command (\cmd[optional]{required}) and the position after it, or
+    # False as argument if the command has none. Returns (None, pos) if the arguments are not balanced.
+    match = TEX_OPTIONAL_ARG_PATTERN.match(tex_source, pos)
+    if match is not None:
+        end = find_closing_bracket(tex_source, match.end(), "]")
+        if end is None:
+            return None, pos
+        pos = end + 1
+    match = TEX_REQUIRED_ARG_PATTERN.match(tex_source, pos)
+    if match is None:
+        return False, pos
+    end = find_closing_bracket(tex_source, match.end())
+    if end is None or TEX_COMMENT_PATTERN.search(tex_source, match.end(), end) is not None:
+        return None, pos
+    return tex_source[match.end():end], end + 1
+
+
+def scan_includegraphics_with_captions(tex_source):
+    # Linear-time alternative to parse_includegraphics_with_captions, which only tracks environments, brace depth,
+    # \includegraphics and \caption. The parent of a graphic is its innermost enclosing environment, and the starred
+    # \includegraphics* and \caption* are other commands, as in TexSoup.
+    # Returns None if the source is ambiguous to scan (e.g. unbalanced or graphics nested in command arguments).
+    def new_env(name, depth):
+        return {"name": name, "depth": depth, "graphics": [], "num_graphics": 0, "caption": None}
+
+    env_stack = [new_env(None, 0)]
+    figures = []
+    depth = 0
+    pos = 0
+    while (match := TEX_TOKEN_PATTERN.search(tex_source, pos)) is not None:
+        pos = match.end()
+        token = match.group(0)
+        if token == "%":
+            line_end = tex_source.find("\n", pos)
+            pos = len(tex_source) if line_end < 0 else line_end + 1
+        elif token == "{":
+            depth += 1
+        elif token == "}":
+            depth -= 1
+            if depth < env_stack[-1]["depth"]:
+                return None
+        elif match.group(1) == "begin":
+            name = match.group(2).strip()
+            if name in SKIPPED_TEX_ENV_NAMES:
+                end_match = re.compile(r"\\end\s*\{\s*%s\s*\}" % re.escape(name)).search(tex_source, pos)
+                if end_match is None:
+                    return None
+                pos = end_match.end()
+                continue
+            env_stack.append(new_env(name, depth))
+        elif match.group(1) == "end":
+            env = env_stack.pop()
+            if env["name"] != match.group(2).strip() or env["depth"] != depth or len(env_stack) == 0:
+                return None
+            figures += [(graphic, env["caption"]) for graphic in env["graphics"] if env["num_graphics"] == 1]
+        elif match.group(3) == "includegraphics":
+            graphic, pos = parse_tex_command_args(tex_source, pos)
+            if graphic is None or depth != env_stack[-1]["depth"]:
+                return None  # the parent of the graphic is a command or group, not an environment
+            if graphic is not False:
+                if "\\" in graphic:
+                    return None
+                env_stack[-1]["graphics"].append(graphic)
+            for env in env_stack:
+                env["num_graphics"] += 1
+        elif match.group(3) == "caption":
+            caption, pos = parse_tex_command_args(tex_source, pos)
+            if caption is None or (caption and "\\includegraphics" in caption):
+                return None
+            for env in env_stack:
+                if env["caption"] is None:
+                    env["caption"] = caption
+    if len(env_stack) != 1 or depth != 0:
+        return None
+    root = env_stack[0]
+    figures += [(graphic, root["caption"]) for graphic in root["graphics"] if root["num_graphics"] == 1]
+    return [(graphic, caption) for graphic, caption in figures if caption is not None and caption is not False]
+
+
+def parse_includegraphics_with_captions(tex_source):
     try:
-        soup = TexSoup(tex_source, tolerance=1, skip_envs=MATH_ENV_NAMES + ("$","$$", "itemize", "enumerate"))
+        soup = TexSoup(tex_source, tolerance=1, skip_envs=SKIPPED_TEX_ENV_NAMES)
     except Exception as e:
         print("Failed parsing tex source, error message:")
         print(e)
-        return {}
-    graphic_nodes = soup.find_all("includegraphics")
-    captions = {}
-    for graphic_node in graphic_nodes:
+        return []
+    figures = []
+    for graphic_node in soup.find_all("includegraphics"):
         if len(graphic_node.contents) < 1:
             continue
-        graphic_url = graphic_node.text[-1]  # get \includegraphics[...]{URL}
+        graphic_url = str(graphic_node.text[-1])  # get \includegraphics[...]{URL}, as str since TexText is not hashable
+        figure = graphic_node.parent
+        if len(figure.find_all("includegraphics")) > 1:  # skip figures containing multiple graphics
+            continue
+        caption_node = figure.find("caption")
+        if caption_node is None or len(caption_node.args) <= 0:
+            continue
+        figures.append((graphic_url, str(caption_node.args[-1].string)))
+    return figures
+
+
+def match_captions_to_graphics(figures, graphics, accepted_img_extensions=ACCEPTED_IMG_EXTENSIONS, blacklist_terms=["\\href", "\\url", "\\email"], stats=None):
+    graphics_wo_ext = [splitext(g)[0] for g in graphics]
+    captions = {}
+    for graphic_url, caption in figures:
         if graphic_url.endswith(accepted_img_extensions):
             if graphic_url not in graphics:
                 continue
@@ -44,102 +167,285 @@ def extract_includegraphics_with_captions(tex_source, graphics, accepted_img_ext
             if graphic_url not in graphics_wo_ext:
                 continue
             graphic_url = graphics[graphics_wo_ext.index(graphic_url)]
-        figure = graphic_node.parent
-        if len(figure.find_all("includegraphics")) > 1:  # skip figures containing multiple graphics
-            continue
-        caption_node = figure.find("caption")
-        if caption_node is None or len(caption_node.args) <= 0:
-            continue
-        caption = caption_node.args[-1].string
         if any(term in caption for term in blacklist_terms):
             continue
-        caption = LatexNodes2Text().latex_to_text(caption)  # tex macros to unicode chars
+        with timed(stats, "latex_to_text"):
+            caption = LatexNodes2Text().latex_to_text(caption)  # tex macros to unicode chars
         caption = " ".join(caption.split())  # sanitize new lines, tabs etc to single white spaces
         captions[graphic_url] = caption
     return captions
 
 
-def process_tex_file(tex_source, graphics_filenames):
+def report_caption_differences(captions, reference_captions):
+    for graphic_url in sorted(captions.keys() | reference_captions.keys()):
+        caption = captions.get(graphic_url)
+        reference_caption = reference_captions.get(graphic_url)
+        if caption != reference_caption:
+            print(f"Caption mismatch for graphic {graphic_url}: scanner {caption!r}, TexSoup {reference_caption!r}")
+
+
+def extract_includegraphics_with_captions(tex_source, graphics, accepted_img_extensions=ACCEPTED_IMG_EXTENSIONS, blacklist_terms=["\\href", "\\url", "\\email"], parity_check=False, stats=None):
+    tex_source = re.sub(r'.*\\newcommand.*\n', '', tex_source)  # TODO: handle user defined commmands better
+    tex_source = re.sub(r'\\caption[\s\t\n]*{', r'\\caption{', tex_source)
+    with timed(stats, "tex_scan"):
+        figures = scan_includegraphics_with_captions(tex_source)
+    if figures is None:  # fall back to a full parse if the scan is ambiguous
+        with timed(stats, "tex_parse"):
+            figures = parse_includegraphics_with_captions(tex_source)
+        return match_captions_to_graphics(figures, graphics, accepted_img_extensions, blacklist_terms, stats)
+    captions = match_captions_to_graphics(figures, graphics, accepted_img_extensions, blacklist_terms, stats)
+    if parity_check:
+        reference_captions = match_captions_to_graphics(parse_includegraphics_with_captions(tex_source), graphics, accepted_img_extensions, blacklist_terms)
+        report_caption_differences(captions, reference_captions)
+    return captions
+
+
+def process_tex_file(tex_source, graphics_filenames, parity_check=False, stats=None):
     tex_source = tex_source.decode("ISO-8859-1")
-    captions = extract_includegraphics_with_captions(tex_source, graphics_filenames)
+    captions = extract_includegraphics_with_captions(tex_source, graphics_filenames, parity_check=parity_check, stats=stats)
     return captions
 
 
-def process_paper(arxiv_id, paper_fileobj, output_tar, resize_images=True, max_size=512, accepted_img_extensions=ACCEPTED_IMG_EXTENSIONS):
+def process_paper(arxiv_id, paper_fileobj, resize_images=True, max_size=512, accepted_img_extensions=ACCEPTED_IMG_EXTENSIONS, parity_check=False, render_timeout=60, figure_cache_dir=None, figure_cache_size=None, encoding=DEFAULT_ENCODING, limits=DEFAULT_LIMITS, item_log=None, stats=None):
+    # Figures exceeding limits are skipped, larger ones without being read. stats counts the figures and skipped figures and times the stages (see metrics.py). Figures that exceed the
+    # thresholds of item_log are logged.
+    stats = stats if stats is not None else Counter()
+    members = []  # (name, bytes, image attributes) tuples of the output tar members
     if not tarfile.is_tarfile(paper_fileobj):
-        return  # Non-tar (i.e. single source file) papers are unlikely to contain graphics, so skip
+        stats["skipped_papers_not_tar"] += 1
+        return members  # Non-tar (i.e. single source file) papers are unlikely to contain graphics, so skip
     with tarfile.open(fileobj=paper_fileobj, mode="r:gz") as input_tar:
         image_filenames = []
         image_members = []
         tex_members = []
-        for tar_info in input_tar:
-            if tar_info.name.endswith(".tex"):
-                tex_members.append(tar_info)
-            if tar_info.name.endswith(accepted_img_extensions):
-                image_members.append(tar_info)
-                image_filenames.append(tar_info.name)
+        with timed(stats, "paper_decompress"):
+            for tar_info in input_tar:
+                if tar_info.name.endswith(".tex"):
+                    tex_members.append(tar_info)
+                if tar_info.name.endswith(accepted_img_extensions):
+                    image_members.append(tar_info)
+                    image_filenames.append(tar_info.name)
         if len(image_filenames) < 1:
-            return
+            stats["skipped_papers_no_images"] += 1
+            return members
+        renderer = get_renderer(render_timeout) if render_timeout else None
+        cache = get_figure_cache(figure_cache_dir, figure_cache_size) if figure_cache_dir is not None else None
         captions = {}
         for tar_info in tex_members:
-            tex_file = input_tar.extractfile(tar_info)
-            captions.update(process_tex_file(tex_file.read(), image_filenames))  # TODO: join captions of the same graphic if multiple are found
+            with timed(stats, "paper_decompress"):
+                tex_bytes = input_tar.extractfile(tar_info).read()
+            captions.update(process_tex_file(tex_bytes, image_filenames, parity_check, stats))  # TODO: join captions of the same graphic if multiple are found
+        out_stems = unique_stems([image_member.name for image_member in image_members])
         for tar_info in image_members:
             image_path = tar_info.name
-            image_out_path = f"{arxiv_id}-{splitext(basename(image_path))[0]}.jpg"
+            image_out_path = f"{arxiv_id}-{out_stems[image_path]}{image_extension(encoding)}"
             caption_out_path = splitext(image_out_path)[0] + ".txt"
             caption = captions.get(image_path)
             if caption is None:
+                stats["skipped_figures_no_caption"] += 1
                 continue
-            image_file = input_tar.extractfile(tar_info)
-            if image_path.endswith((".eps", ".ps")):  # EPS files need to be extracted to disk
-                image_file_disk = NamedTemporaryFile()
-                image_file_disk.write(image_file.read())
-                image_file_disk.seek(0)
-                image_file = image_file_disk
-            with image_file:
-                image_file_out = BytesIO()
-                try:
-                    img = convert_from_bytes(image_file.read())[0] if image_path.endswith(".pdf") else Image.open(image_file)
-                except (Image.DecompressionBombError, OSError, UnidentifiedImageError) as e:
-                    print(f"Could not load image {image_path}, error message:")
-                    print(e)
-                    continue
-                if resize_images:
-                    img.thumbnail((max_size, max_size))
-                if img.mode in ("RGBA", "P"):
-                    img = img.convert("RGB")
-                img.save(image_file_out, format="JPEG")
-            figure_info = tarfile.TarInfo(image_out_path)
-            figure_info.size = image_file_out.getbuffer().nbytes
-            image_file_out.seek(0)
-            output_tar.addfile(figure_info, fileobj=image_file_out)
-            caption_bytes = caption.encode("utf-8")
-            caption_info = tarfile.TarInfo(caption_out_path)
-            caption_info.size = len(caption_bytes)
-            output_tar.addfile(caption_info, fileobj=BytesIO(caption_bytes))
-    return captions
+            try:
+                if limits["max_bytes"] is not None and tar_info.size > limits["max_bytes"]:
+                    raise FigureTooLargeError(f"Figure has {tar_info.size} bytes, more than {limits['max_bytes']}")
+                with timed(stats, "paper_decompress"):
+                    with input_tar.extractfile(tar_info) as image_file:
+                        image_bytes = image_file.read()
+                with logged_item(item_log, "figure", f"{arxiv_id}/{image_path}"):
+                    image_out_bytes, attributes, cached = process_figure(image_bytes, figure_params(resize_images, max_size, encoding), lambda image_bytes: process_image(image_bytes, image_path, resize_images, max_size, encoding, renderer, stats, limits), cache, lambda image_bytes: check_figure_limits(image_bytes, image_path, resize_images, max_size, limits, renderer))
+            except FigureTooLargeError as e:
+                stats["skipped_figures_too_large"] += 1
+                if item_log is not None:
+                    item_log.log("figure", f"{arxiv_id}/{image_path}", error=f"{type(e).__name__}: {e}")
+                continue
+            except (Image.DecompressionBombError, OSError, UnidentifiedImageError) as e:
+                print(f"Could not load image {image_path}, error message:")
+                print(e)
+                stats["skipped_figures_load_error"] += 1
+                if item_log is not None:
+                    item_log.log("figure", f"{arxiv_id}/{image_path}", error=f"{type(e).__name__}: {e}")
+                continue
+            if cached:
+                stats["cached_figures"] += 1
+            stats["figures"] += 1
+            stats["bytes_out"] += len(image_out_bytes)
+            members.append((image_out_path, image_out_bytes, attributes))
+            members.append((caption_out_path, caption.encode("utf-8"), None))
+    return members
+
+
+def process_paper_bytes(arxiv_id, paper_bytes, **paper_kwargs):
+    stats = Counter({"papers": 1, "bytes_in": len(paper_bytes)})
+    with timed(stats, "paper"), logged_item(paper_kwargs.get("item_log"), "paper", arxiv_id):
+        members = process_paper(arxiv_id, BytesIO(paper_bytes), stats=stats, **paper_kwargs)
+    return members, stats
 
 
-def process_archive(archive_filepath, output_filepath, resize_images=True, max_size=512):
-    with tarfile.open(archive_filepath, mode="r") as input_tar, tarfile.open(output_filepath, mode="w") as output_tar:
-        for tar_info in input_tar:
-            if tar_info.name.endswith(".gz"):
+def write_paper_result(writer, stats, arxiv_id, result, metrics=None, item_log=None):
+    try:
+        members, paper_stats = result.get()
+    except Exception as e:
+        print(f"Failed processing paper {arxiv_id}, error message:")
+        print(e)
+        paper_stats = Counter({"failed_papers": 1})
+        if item_log is not None:
+            item_log.log("paper", arxiv_id, error=f"{type(e).__name__}: {e}")
+    else:
+        with timed(paper_stats, "write"):
+            for name, file_bytes, attributes in members:
+                writer.add(name, file_bytes, attributes)
+            writer.commit(arxiv_id)
+    stats.update(paper_stats)
+    if metrics is not None:
+        metrics.update(paper_stats)
+
+
+class PaperShardWriter:
+    # Writes the papers of an archive as img2dataset samples to a ShardWriter shared by all archives, with the interface
+    # of JournaledTarWriter. done are the papers journaled by the ShardWriter.
+    def __init__(self, shard_writer, done):
+        self.shard_writer = shard_writer
+        self.done = done
+        self.members = []
+
+    def add(self, name, file_bytes, attributes=None):
+        self.members.append((name, file_bytes, attributes))
+
+    def commit(self, item_id):
+        members, metadata = to_img2dataset_members(self.members)
+        self.shard_writer.write(item_id, members, metadata)
+        self.members = []
+
+    def finalize(self):
+        pass  # shards are finalized by the ShardWriter
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+def process_archive(archive_filepath, output_filepath, pool, paper_kwargs, max_in_flight=64, shard_writer=None, completed_papers=None, metrics=None):
+    # The calling thread is the only writer of the output tar. Results are written in archive order and at most
+    # max_in_flight papers are submitted but not yet written, which bounds the memory held per archive.
+    # Papers already journaled by a previous, interrupted run are skipped. If shard_writer is given, the papers are
+    # written to it instead of to an output tar per archive. The stats of every paper are also added to metrics.
+    item_log = paper_kwargs.get("item_log")
+    pending = deque()
+    stats = Counter()
+    writer = PaperShardWriter(shard_writer, completed_papers) if shard_writer is not None else JournaledTarWriter(output_filepath)
+    with tarfile.open(archive_filepath, mode="r") as input_tar, writer:
+        try:
+            for tar_info in input_tar:
+                if not tar_info.name.endswith(".gz"):
+                    continue
                 arxiv_id = splitext(basename(tar_info.name))[0]
-                paper_file = input_tar.extractfile(tar_info)
-                process_paper(arxiv_id, paper_file, output_tar, resize_images=resize_images, max_size=max_size)
+                if arxiv_id in writer.done:
+                    continue
+                read_stats = Counter()
+                with timed(read_stats, "archive_read"):
+                    paper_bytes = input_tar.extractfile(tar_info).read()
+                stats.update(read_stats)
+                if metrics is not None:
+                    metrics.update(read_stats)
+                while len(pending) >= max_in_flight or (pending and pending[0][1].ready()):
+                    write_paper_result(writer, stats, *pending.popleft(), metrics, item_log)
+                result = pool.apply_async(func=process_paper_bytes, args=(arxiv_id, paper_bytes), kwds=paper_kwargs)
+                pending.append((arxiv_id, result))
+        except (tarfile.ReadError, EOFError) as e:
+            # The papers read before the truncated or corrupt part of the archive are still written and the output is
+            # finalized, otherwise every run would resume the archive and fail at the same point
+            print(f"Archive {archive_filepath} is truncated or corrupt, error message:")
+            print(e)
+            stats["truncated_archives"] += 1
+            if metrics is not None:
+                metrics.update({"truncated_archives": 1})
+            if item_log is not None:
+                item_log.log("archive", archive_filepath, error=f"{type(e).__name__}: {e}")
+        while pending:
+            write_paper_result(writer, stats, *pending.popleft(), metrics, item_log)
+        writer.finalize()
+    return stats
 
 
-def main(input_dir, output_dir, resize_images=True, max_size=512):
+def process_archive_and_notify(archive_filepath, output_filepath, on_archive_done, *args):
+    try:
+        return process_archive(archive_filepath, output_filepath, *args)
+    finally:
+        on_archive_done(archive_filepath, output_filepath)
+
+
+def main(input_dir, output_dir, resize_images=True, max_size=512, num_readers=4, max_in_flight=None, parity_check=False, render_timeout=60, figure_cache_dir=None, figure_cache_size=None, encoding=DEFAULT_ENCODING, img2dataset_output=False, shard_size=512, metrics_path=None, metrics_interval=60, item_log_path=None, slow_item_seconds=None, slow_item_rss=None, limits=DEFAULT_LIMITS, num_workers=None, max_worker_rss=None, task_retries=1, num_partitions=1, partition_index=0, archives=None, on_archive_done=None):
+    # archives defaults to the archives in input_dir, but can be any iterable of archive paths, e.g. one yielding them as
+    # they are downloaded. on_archive_done(archive_filepath, output_filepath) is called after every archive, also
+    # if it failed or was processed by an earlier run. With img2dataset_output, the papers of all archives are written
+    # to sequentially numbered img2dataset shards of about shard_size MB instead of to an output tar per archive.
+    # The merged stats are written to metrics_path every metrics_interval seconds (see metrics.py). Failed papers and
+    # figures, and those that take longer than slow_item_seconds or raise the peak RSS of a worker above slow_item_rss
+    # MB, are logged to item_log_path (by default item_log.jsonl in output_dir). Workers whose RSS exceeds
+    # max_worker_rss MB are replaced, and papers whose worker died, e.g. because it ran out of memory, are retried
+    # task_retries times. With num_partitions > 1, only the archives of partition_index are processed, and the output is
+    # written to the directory of the partition in output_dir (see partitions.py).
+    output_dir = partition_dir(output_dir, num_partitions, partition_index)
     makedirs(output_dir, exist_ok=True)
-    pool = Pool(processes=round(1.5 * cpu_count()))
-    for archive_filepath in iglob(join(input_dir, "*.tar")):
-        output_filepath = join(output_dir, basename(archive_filepath))
-        if isfile(output_filepath) and tarfile.is_tarfile(output_filepath):
-            continue
-        pool.apply_async(func=process_archive, args=(archive_filepath, output_filepath, resize_images, max_size))
-    pool.close()
-    pool.join()
+    shard_writer = None
+    completed_papers = None
+    if img2dataset_output:
+        remove_partial_shards(output_dir, join(output_dir, JOURNAL_FILENAME))  # completes journaled shards, the papers of the others are processed again
+        completed_papers = read_completed_items(join(output_dir, JOURNAL_FILENAME))
+        shard_writer = ShardWriter(output_dir, shard_size * 1024 ** 2, Value("q", next_shard_index(output_dir)), join(output_dir, JOURNAL_FILENAME), on_finalize=write_shard_metadata)
+    else:
+        complete_partial_indexes(output_dir)  # indexes of output tars renamed right before a crash
+    figure_cache_bytes = figure_cache_size * 1024 ** 3 if figure_cache_size is not None else None
+    paper_kwargs = {"resize_images": resize_images, "max_size": max_size, "parity_check": parity_check, "render_timeout": render_timeout, "figure_cache_dir": figure_cache_dir, "figure_cache_size": figure_cache_bytes, "encoding": encoding}
+    paper_kwargs["limits"] = limits
+    paper_kwargs["item_log"] = ItemLog(item_log_path or join(output_dir, "item_log.jsonl"), slow_item_seconds, slow_item_rss)
+    metrics = MetricsWriter(metrics_path, metrics_interval, "arxiv").start()
+    processes = num_workers or round(1.5 * cpu_count())
+    if max_in_flight is None:
+        max_in_flight = 2 * processes  # enough to keep every worker busy from a single archive
+    if archives is None:
+        archives = sorted(iglob(join(input_dir, "*.tar")))
+    if on_archive_done is None:
+        on_archive_done = lambda archive_filepath, output_filepath: None
+    # Paper-level scheduling: reader threads stream papers out of the archives into a shared worker pool
+    with WorkerPool(processes, max_rss_mb=max_worker_rss, retries=task_retries) as pool, ThreadPoolExecutor(max_workers=num_readers) as readers:
+        futures = {}
+        for archive_filepath in archives:
+            if not in_partition(basename(archive_filepath), num_partitions, partition_index):
+                on_archive_done(archive_filepath, None)
+                continue
+            output_filepath = join(output_dir, basename(archive_filepath)) if shard_writer is None else None
+            if output_filepath is not None and isfile(output_filepath):
+                on_archive_done(archive_filepath, output_filepath)
+                continue  # output tars only appear once they are finalized
+            future = readers.submit(process_archive_and_notify, archive_filepath, output_filepath, on_archive_done, pool, paper_kwargs, max_in_flight, shard_writer, completed_papers, metrics)
+            futures[future] = archive_filepath
+        stats = Counter()
+        for future, archive_filepath in futures.items():
+            try:
+                stats.update(future.result())
+            except Exception as e:
+                print(f"Failed processing archive {archive_filepath}, error message:")
+                print(e)
+        stats.update(pool.stats)
+        metrics.update(pool.stats)
+    if shard_writer is not None:
+        shard_writer.close()
+    metrics.close()
+    if figure_cache_dir is not None:
+        FigureCache(figure_cache_dir, figure_cache_bytes).evict()
+    manifest = write_manifest(output_dir, num_partitions, partition_index)
+    print(f"Wrote {len(manifest['shards'])} shards with {manifest['num_samples']} samples")
+    for category in ("vector", "raster"):
+        print(f"Decoded {stats[category + '_figures']} {category} figures in {stats[category + '_seconds']:.1f} seconds")
+    print(f"Took {stats['cached_figures']} figures from the figure cache and passed {stats['passthrough_figures']} JPEGs through")
+    print(f"Processed {stats['papers']} papers with {stats['figures']} figures, skipped {stats['skipped_figures_too_large']} figures exceeding the limits")
+    print(f"Replaced {stats['died_workers']} workers that died and {stats['recycled_workers']} workers exceeding the RSS limit, retried {stats['retried_tasks']} papers")
+    if stats["failed_papers"]:
+        print(f"Failed processing {stats['failed_papers']} papers, see {paper_kwargs['item_log'].path}")
+    if stats["truncated_archives"]:
+        print(f"Processed {stats['truncated_archives']} truncated or corrupt archives only up to the first error, see {paper_kwargs['item_log'].path}")
     print("done")
 
 # fs = SSHFileSystem("127.0.0.1", username="user", client_keys=["~/.ssh/id_ed25519"], port=52223)  # not thread safe
@@ -153,6 +459,20 @@ if __name__ == "__main__":
     parser.add_argument("--output_dir", type=str, default="data/processed/arxiv", help="Output directory")
     parser.add_argument("--no_resize_images", action="store_true", help="Resize images")
     parser.add_argument("--max_size", type=int, default=512, help="Maximum size for mage resizing")
+    parser.add_argument("--num_readers", type=int, default=4, help="Number of archives read concurrently")
+    parser.add_argument("--max_in_flight", type=int, default=None, help="Maximum number of papers per archive submitted to the workers but not yet written (default: 2x the number of workers)")
+    parser.add_argument("--parity_check", action="store_true", help="Also parse every .tex file with TexSoup and report captions that differ from the fast scanner")
+    parser.add_argument("--render_timeout", type=float, default=60, help="Timeout in seconds for rendering a PDF/EPS figure in a separate renderer process. If 0, figures are rendered in the worker process without timeout")
+    parser.add_argument("--figure_cache_dir", type=str, default=None, help="Directory of a cache of processed figures, which is shared between runs")
+    parser.add_argument("--figure_cache_size", type=float, default=None, help="Maximum size of the figure cache in GB (default: unlimited)")
+    add_encoding_arguments(parser)
+    parser.add_argument("--img2dataset_output", action="store_true", help="Write sequentially numbered shards in img2dataset format instead of a tar file per archive")
+    parser.add_argument("--shard_size", type=int, default=512, help="Target size of the output shards in MB (only with --img2dataset_output)")
+    add_metrics_arguments(parser)
+    add_limit_arguments(parser)
+    add_worker_arguments(parser)
+    add_partition_arguments(parser)
     
     args = parser.parse_args()
-    main(args.input_dir, args.output_dir, not args.no_resize_images, args.max_size)
+    check_partition_arguments(parser, args)
+    main(args.input_dir, args.output_dir, not args.no_resize_images, args.max_size, args.num_readers, args.max_in_flight, args.parity_check, args.render_timeout, args.figure_cache_dir, args.figure_cache_size, encoding_from_args(args), args.img2dataset_output, args.shard_size, args.metrics_path, args.metrics_interval, args.item_log, args.slow_item_seconds, args.slow_item_rss, limits_from_args(args), args.num_workers, args.max_worker_rss, args.task_retries, args.num_partitions, args.partition_index)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+from argparse import ArgumentParser
+from os import remove
+from os.path import abspath, dirname, isfile
+from queue import Queue
+import sys
+from threading import Lock, Thread
+
+from arxiv import main as process_arxiv_archives
+from figures import add_encoding_arguments, add_limit_arguments, encoding_from_args, limits_from_args
+from metrics import add_metrics_arguments
+from partitions import add_partition_arguments, check_partition_arguments
+from worker_pool import add_worker_arguments
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+from download.arxiv import DiskBudget, download_arxiv_tars
+
+
+def iter_queue(queue):
+    while (item := queue.get()) is not None:
+        yield item
+
+
+def main(download_dir, output_dir, start_item, end_item, max_download_size=100, num_downloads=8, delete_sources=False, disk_budget=None, num_partitions=1, partition_index=0, **process_kwargs):
+    # Processes every archive as soon as it is downloaded and verified, instead of after all downloads are finished.
+    # With num_partitions > 1, only the archives of partition_index are downloaded and processed.
+    budget = DiskBudget(disk_budget * 1024 ** 3) if disk_budget is not None else None
+    archive_queue = Queue()
+    archive_sizes = {}
+    archive_sizes_lock = Lock()
+
+    def on_downloaded(file_path, size):
+        with archive_sizes_lock:
+            archive_sizes[file_path] = size
+        archive_queue.put(file_path)
+
+    def on_archive_done(archive_filepath, output_filepath):
+        if delete_sources and output_filepath is not None and isfile(output_filepath):
+            remove(archive_filepath)
+        if budget is not None:
+            # Also released if the archive failed, so that a failed archive can not stall the downloads
+            with archive_sizes_lock:
+                budget.release(archive_sizes.pop(archive_filepath, 0))
+
+    def download():
+        try:
+            download_arxiv_tars(start_item=start_item, end_item=end_item, max_size=max_download_size, output_dir=download_dir, num_workers=num_downloads, on_downloaded=on_downloaded, disk_budget=budget, num_partitions=num_partitions, partition_index=partition_index)
+        finally:
+            archive_queue.put(None)
+
+    downloader = Thread(target=download)
+    downloader.start()
+    process_arxiv_archives(None, output_dir, archives=iter_queue(archive_queue), on_archive_done=on_archive_done, num_partitions=num_partitions, partition_index=partition_index, **process_kwargs)
+    downloader.join()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Overlapped arXiv download and extraction script")
+    parser.add_argument("--download_dir", type=str, default="data/download/arxiv", help="Download directory")
+    parser.add_argument("--output_dir", type=str, default="data/processed/arxiv", help="Output directory")
+    parser.add_argument("-s", "--start_item", default="astro-ph0001001")
+    parser.add_argument("-e", "--end_item", default="2012.15864")
+    parser.add_argument("-m", "--max_download_size", type=int, default=100, help="Maximum total download size in GB")
+    parser.add_argument("--num_downloads", type=int, default=8, help="Number of concurrent downloads")
+    parser.add_argument("--delete_sources", action="store_true", help="Delete a downloaded archive once its output tar is finalized")
+    parser.add_argument("--disk_budget", type=float, default=None, help="Maximum size in GB of downloaded archives on disk at the same time. Downloads wait until processed archives are deleted (requires --delete_sources)")
+    parser.add_argument("--no_resize_images", action="store_true", help="Resize images")
+    parser.add_argument("--max_size", type=int, default=512, help="Maximum size for mage resizing")
+    parser.add_argument("--num_readers", type=int, default=4, help="Number of archives read concurrently")
+    parser.add_argument("--figure_cache_dir", type=str, default=None, help="Directory of a cache of processed figures, which is shared between runs")
+    parser.add_argument("--figure_cache_size", type=float, default=None, help="Maximum size of the figure cache in GB (default: unlimited)")
+    add_encoding_arguments(parser)
+    add_metrics_arguments(parser)
+    add_limit_arguments(parser)
+    add_worker_arguments(parser)
+    add_partition_arguments(parser)
+    parser.add_argument("--img2dataset_output", action="store_true", help="Write sequentially numbered shards in img2dataset format instead of a tar file per archive")
+    parser.add_argument("--shard_size", type=int, default=512, help="Target size of the output shards in MB (only with --img2dataset_output)")
+
+    args = parser.parse_args()
+    if args.disk_budget is not None and not args.delete_sources:
+        parser.error("--disk_budget requires --delete_sources")
+    if args.img2dataset_output and args.delete_sources:
+        parser.error("--delete_sources can not be used with --img2dataset_output, since the papers of an archive are only safe once their shards are finished")
+    check_partition_arguments(parser, args)
+    main(args.download_dir, args.output_dir, args.start_item, args.end_item, args.max_download_size, args.num_downloads, args.delete_sources, args.disk_budget, args.num_partitions, args.partition_index, resize_images=not args.no_resize_images, max_size=args.max_size, num_readers=args.num_readers, figure_cache_dir=args.figure_cache_dir, figure_cache_size=args.figure_cache_size, encoding=encoding_from_args(args), img2dataset_output=args.img2dataset_output, shard_size=args.shard_size, metrics_path=args.metrics_path, metrics_interval=args.metrics_interval, item_log_path=args.item_log, slow_item_seconds=args.slow_item_seconds, slow_item_rss=args.slow_item_rss, limits=limits_from_args(args), num_workers=args.num_workers, max_worker_rss=args.max_worker_rss, task_retries=args.task_retries)
@@ -0,0 +1,113 @@
+# On-disk cache of processed figures, addressed by the sha256 checksum of the source bytes of a figure together with
+# the processing parameters. An entry holds the encoded output image and its image attributes (see shard_index.py), so
+# figures that were already processed, e.g. by an earlier run or as part of another version of the same paper, are not
+# decoded again. Entries are written atomically, so the cache can be shared by processes. Once more than max_bytes are
+# stored, the least recently used entries are evicted.
+from hashlib import sha256
+from json import dumps, loads
+from os import getpid, makedirs, remove, replace, scandir, utime
+from os.path import join
+from struct import Struct
+from threading import get_ident
+
+
+ENTRY_HEADER = Struct("<I")  # length of the JSON encoded image attributes, which are followed by the image
+
+
+class FigureCache:
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.added_bytes = 0
+        makedirs(cache_dir, exist_ok=True)
+
+    def key(self, source_sha256, params):
+        return sha256(f"{source_sha256}:{params!r}".encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return join(self.cache_dir, key[:2], key)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "rb") as entry_file:
+                entry = entry_file.read()
+            utime(path)  # the modification time marks the last use
+        except FileNotFoundError:
+            return None  # also if the entry was evicted concurrently
+        attributes_length, = ENTRY_HEADER.unpack_from(entry)
+        attributes_end = ENTRY_HEADER.size + attributes_length
+        return entry[attributes_end:], loads(entry[ENTRY_HEADER.size:attributes_end])
+
+    def put(self, key, image_bytes, attributes):
+        path = self.path(key)
+        makedirs(join(self.cache_dir, key[:2]), exist_ok=True)
+        partial_path = f"{path}.{getpid()}-{get_ident()}.partial"
+        attributes_bytes = dumps(attributes).encode("utf-8")
+        with open(partial_path, "wb") as entry_file:
+            entry_file.write(ENTRY_HEADER.pack(len(attributes_bytes)))
+            entry_file.write(attributes_bytes)
+            entry_file.write(image_bytes)
+        replace(partial_path, path)
+        self.added_bytes += ENTRY_HEADER.size + len(attributes_bytes) + len(image_bytes)
+        if self.max_bytes is not None and self.added_bytes > self.max_bytes // 16:
+            self.evict()
+
+    def evict(self):
+        # Removes the least recently used entries until the cache is 10% below max_bytes
+        self.added_bytes = 0
+        if self.max_bytes is None:
+            return
+        entries = []
+        for directory in scandir(self.cache_dir):
+            if not directory.is_dir():
+                continue
+            for entry in scandir(directory.path):
+                if entry.name.endswith(".partial"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue  # evicted by another process
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_bytes = sum(size for _, size, _ in entries)
+        if total_bytes <= self.max_bytes:
+            return
+        for _, size, path in sorted(entries):
+            try:
+                remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+            if total_bytes <= 0.9 * self.max_bytes:
+                break
+
+
+figure_cache = None
+
+
+def get_figure_cache(cache_dir, max_bytes=None):
+    # Every worker process lazily opens the cache
+    global figure_cache
+    if figure_cache is None:
+        figure_cache = FigureCache(cache_dir, max_bytes)
+    return figure_cache
+
+
+def process_figure(image_bytes, params, process, cache=None, check=None):
+    # Returns the encoded image, the image attributes (see shard_index.py) of a figure and whether it was cached.
+    # process(image_bytes) needs to return the encoded image and its attributes, and is only called on cache misses.
+    # check(image_bytes) is called on cache hits, e.g. to reject figures that exceed the limits of the current run, which
+    # are not part of the key. It is up to process to check cache misses.
+    source_sha256 = sha256(image_bytes).hexdigest()
+    key = cache.key(source_sha256, params) if cache is not None else None
+    cached = cache.get(key) if cache is not None else None
+    if cached is not None:
+        if check is not None:
+            check(image_bytes)
+        output_bytes, attributes = cached
+    else:
+        output_bytes, attributes = process(image_bytes)
+        if cache is not None:
+            cache.put(key, output_bytes, attributes)
+    return output_bytes, {**attributes, "sha256": source_sha256}, cached is not None
@@ -0,0 +1,297 @@
+from io import BytesIO
+from math import ceil
+from os.path import basename, splitext
+import re
+from struct import unpack
+from time import perf_counter
+
+from PIL import Image
+import pypdfium2
+
+from metrics import timed
+from phash import perceptual_hash
+
+
+DEFAULT_PDF_DPI = 200  # default of pdf2image, which was used before
+EPS_DPI = 72  # Pillow rasterizes EPS files at their bounding box size in points
+EPS_BOUNDING_BOX_PATTERN = re.compile(rb"%%(?:HiRes)?BoundingBox:\s*([-\d.]+)\s+([-\d.]+)\s+([-\d.]+)\s+([-\d.]+)")
+DOS_EPS_MAGIC = b"\xc5\xd0\xd3\xc6"
+VECTOR_IMG_EXTENSIONS = (".pdf", ".eps", ".ps")
+IMAGE_CODECS = {"jpeg": ("JPEG", ".jpg"), "webp": ("WEBP", ".webp")}  # Pillow format and output extension
+JPEG_SUBSAMPLINGS = ("4:4:4", "4:2:2", "4:2:0")
+DEFAULT_ENCODING = {"codec": "jpeg", "quality": 75, "progressive": False, "subsampling": "4:2:0", "jpeg_passthrough": False}  # Pillow defaults
+DEFAULT_LIMITS = {"max_bytes": 64 * 1024 ** 2, "max_pixels": Image.MAX_IMAGE_PIXELS, "max_pages": 20}
+
+
+class FigureTooLargeError(OSError):
+    pass
+
+
+def parse_box(pattern, source_bytes):
+    match = pattern.search(source_bytes)
+    if match is None:
+        return None
+    try:
+        x0, y0, x1, y1 = (float(i) for i in match.groups())
+    except ValueError:
+        return None
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return x0, y0, x1, y1
+
+
+def target_dpi(width, height, max_size, max_dpi):
+    # Smallest DPI at which the longer side of a width x height points box is at least max_size pixels
+    return min(max_dpi, max_size * 72 / max(width, height))
+
+
+def render_pdf(pdf_bytes, max_size=None):
+    # Renders only the first page, in-process and from memory
+    try:
+        pdf = pypdfium2.PdfDocument(pdf_bytes)
+    except pypdfium2.PdfiumError as e:
+        raise OSError(str(e)) from e
+    try:
+        if len(pdf) < 1:
+            raise OSError("PDF has no pages")
+        page = pdf[0]
+        width, height = page.get_size()
+        dpi = DEFAULT_PDF_DPI if max_size is None else target_dpi(width, height, max_size, DEFAULT_PDF_DPI)
+        return page.render(scale=dpi / 72).to_pil()
+    finally:
+        pdf.close()
+
+
+def postscript_section(eps_bytes):
+    if eps_bytes.startswith(DOS_EPS_MAGIC):  # DOS EPS binary header with offset and length of the PostScript section
+        offset, length = unpack("<II", eps_bytes[4:12])
+        return eps_bytes[offset:offset + length]
+    return eps_bytes
+
+
+def import_ghostscript():
+    # Imported on first use, since importing it fails without the Ghostscript library, which only EPS figures need. The
+    # error is raised as OSError, so that the figure is skipped like any other figure that can not be loaded.
+    try:
+        import ghostscript
+    except (ImportError, RuntimeError) as e:
+        raise OSError(f"Ghostscript is not available: {e}") from e
+    return ghostscript
+
+
+def render_eps(eps_bytes, max_size=None):
+    # Rasterizes the bounding box like Pillow does, but at a resolution derived from max_size and in-process using
+    # the Ghostscript library, with the PostScript passed on stdin and the image read from stdout
+    ps_bytes = postscript_section(eps_bytes)
+    box = parse_box(EPS_BOUNDING_BOX_PATTERN, ps_bytes[:4096]) or parse_box(EPS_BOUNDING_BOX_PATTERN, ps_bytes[-4096:])
+    if box is None:
+        raise OSError("cannot determine EPS bounding box")
+    width, height = box[2] - box[0], box[3] - box[1]
+    dpi = EPS_DPI if max_size is None else target_dpi(width, height, max_size, EPS_DPI)
+    args = ["gs", "-q", "-dBATCH", "-dNOPAUSE", "-dSAFER", "-sDEVICE=ppmraw", f"-r{dpi}",
+            f"-g{max(1, ceil(width * dpi / 72))}x{max(1, ceil(height * dpi / 72))}", "-dTextAlphaBits=4",
+            "-dGraphicsAlphaBits=4", "-sOutputFile=%stdout", "-c", f"{-box[0]} {-box[1]} translate", "-f", "-",
+            "-c", "showpage"]
+    ghostscript = import_ghostscript()
+    image_file = BytesIO()
+    try:
+        with ghostscript.Ghostscript(*args, stdin=BytesIO(ps_bytes), stdout=image_file, stderr=BytesIO()):
+            pass
+    except ghostscript.GhostscriptError as e:
+        raise OSError(f"Ghostscript failed: {e}") from e
+    image_file.seek(0)
+    img = Image.open(image_file)
+    img.load()
+    return img
+
+
+def render(kind, source_bytes, max_size=None):
+    return render_pdf(source_bytes, max_size) if kind == "pdf" else render_eps(source_bytes, max_size)
+
+
+def fit_size(size, max_size):
+    scale = min(max_size / size[0], max_size / size[1], 1)
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+
+def load_image(image_bytes, image_path, resize_images=True, max_size=512, renderer=None, stats=None):
+    # Decodes a figure at the smallest resolution that still fills max_size (if resizing), then downscales it.
+    # Vector figures are rendered by the given renderer (see renderer.py) or in-process if it is None. Returns the image
+    # and the original size, which is the size of the rendered image for vector figures.
+    start_time = perf_counter()
+    max_size = max_size if resize_images else None
+    if image_path.endswith(VECTOR_IMG_EXTENSIONS):
+        kind = "pdf" if image_path.endswith(".pdf") else "eps"
+        img = renderer.render(kind, image_bytes, max_size) if renderer is not None else render(kind, image_bytes, max_size)
+        original_size = img.size
+        category = "vector"
+    else:
+        img = Image.open(BytesIO(image_bytes))
+        original_size = img.size
+        if max_size is not None and img.format == "JPEG":
+            img.draft(None, fit_size(img.size, max_size))  # DCT scaling while decoding
+        category = "raster"
+    if max_size is not None:
+        img.thumbnail((max_size, max_size))
+    if stats is not None:
+        stats[f"{category}_figures"] += 1
+        stats[f"{category}_seconds"] += perf_counter() - start_time
+    return img, original_size
+
+
+def probe_pdf(pdf_bytes, max_size=None):
+    # Returns the number of pixels the first page is rendered at and the number of pages
+    try:
+        pdf = pypdfium2.PdfDocument(pdf_bytes)
+    except pypdfium2.PdfiumError as e:
+        raise OSError(str(e)) from e
+    try:
+        if len(pdf) < 1:
+            raise OSError("PDF has no pages")
+        width, height = pdf[0].get_size()
+        num_pages = len(pdf)
+    finally:
+        pdf.close()
+    dpi = DEFAULT_PDF_DPI if max_size is None else target_dpi(width, height, max_size, DEFAULT_PDF_DPI)
+    return ceil(width * dpi / 72) * ceil(height * dpi / 72), num_pages
+
+
+def probe_eps(eps_bytes, max_size=None):
+    # Returns the number of pixels the bounding box is rasterized at and the number of pages, read from the header
+    ps_bytes = postscript_section(eps_bytes)
+    box = parse_box(EPS_BOUNDING_BOX_PATTERN, ps_bytes[:4096]) or parse_box(EPS_BOUNDING_BOX_PATTERN, ps_bytes[-4096:])
+    if box is None:
+        raise OSError("cannot determine EPS bounding box")
+    width, height = box[2] - box[0], box[3] - box[1]
+    dpi = EPS_DPI if max_size is None else target_dpi(width, height, max_size, EPS_DPI)
+    return ceil(width * dpi / 72) * ceil(height * dpi / 72), 1
+
+
+def probe(kind, source_bytes, max_size=None):
+    return probe_pdf(source_bytes, max_size) if kind == "pdf" else probe_eps(source_bytes, max_size)
+
+
+def count_frames(img, max_frames):
+    # Counts the frames of an animated or multi-page image up to max_frames + 1, since seeking through the frames
+    # decodes them (GIF) or parses their headers (TIFF)
+    num_frames = 1
+    while num_frames <= max_frames:
+        try:
+            img.seek(num_frames)
+        except EOFError:
+            break
+        num_frames += 1
+    return num_frames
+
+
+def check_limit(value, limit, unit):
+    if limit is not None and value > limit:
+        raise FigureTooLargeError(f"Figure has {value} {unit}, more than {limit}")
+
+
+def check_figure_limits(image_bytes, image_path, resize_images=True, max_size=512, limits=DEFAULT_LIMITS, renderer=None):
+    # Raises FigureTooLargeError for figures exceeding the byte, pixel or page budget of limits (None for no budget),
+    # reading them from the header of the figure without decoding it. PDFs are parsed by the given renderer (see
+    # renderer.py), i.e. under its timeout, or in-process if it is None.
+    check_limit(len(image_bytes), limits["max_bytes"], "bytes")
+    if image_path.endswith(VECTOR_IMG_EXTENSIONS):
+        kind = "pdf" if image_path.endswith(".pdf") else "eps"
+        max_size = max_size if resize_images else None
+        num_pixels, num_pages = renderer.probe(kind, image_bytes, max_size) if renderer is not None and kind == "pdf" else probe(kind, image_bytes, max_size)
+        check_limit(num_pixels, limits["max_pixels"], "pixels")
+        check_limit(num_pages, limits["max_pages"], "pages")
+    else:
+        with Image.open(BytesIO(image_bytes)) as img:
+            check_limit(img.width * img.height, limits["max_pixels"], "pixels")
+            if limits["max_pages"] is not None:
+                check_limit(count_frames(img, limits["max_pages"]), limits["max_pages"], "pages")
+
+
+def add_limit_arguments(parser):
+    parser.add_argument("--max_figure_size", type=float, default=DEFAULT_LIMITS["max_bytes"] / 1024 ** 2, help="Figures larger than this many MB are skipped without being read")
+    parser.add_argument("--max_figure_pixels", type=float, default=DEFAULT_LIMITS["max_pixels"] / 1e6, help="Figures that would be decoded or rendered at more than this many megapixels are skipped")
+    parser.add_argument("--max_figure_pages", type=int, default=DEFAULT_LIMITS["max_pages"], help="Figures with more pages or frames are skipped")
+
+
+def limits_from_args(args):
+    return {"max_bytes": round(args.max_figure_size * 1024 ** 2), "max_pixels": round(args.max_figure_pixels * 1e6), "max_pages": args.max_figure_pages}
+
+
+def add_encoding_arguments(parser):
+    parser.add_argument("--image_format", choices=list(IMAGE_CODECS), default=DEFAULT_ENCODING["codec"], help="Format of the output images")
+    parser.add_argument("--quality", type=int, default=DEFAULT_ENCODING["quality"], help="Quality of the output images")
+    parser.add_argument("--progressive", action="store_true", help="Write progressive JPEGs")
+    parser.add_argument("--subsampling", choices=JPEG_SUBSAMPLINGS, default=DEFAULT_ENCODING["subsampling"], help="Chroma subsampling of the output JPEGs")
+    parser.add_argument("--jpeg_passthrough", action="store_true", help="Copy JPEG figures that do not need to be resized unchanged instead of encoding them again (only if --image_format is jpeg)")
+
+
+def encoding_from_args(args):
+    return {"codec": args.image_format, "quality": args.quality, "progressive": args.progressive, "subsampling": args.subsampling, "jpeg_passthrough": args.jpeg_passthrough}
+
+
+def image_extension(encoding):
+    return IMAGE_CODECS[encoding["codec"]][1]
+
+
+def unique_stems(image_paths):
+    # Maps the paths of the figures of a paper or package to the stems of their output names. Figures whose basenames
+    # only differ in their directory or extension get a counter suffix in the order of the paper, since they would
+    # overwrite each other's samples and have the same uid otherwise.
+    stems = {}
+    used = set()
+    for image_path in image_paths:
+        stem = splitext(basename(image_path))[0]
+        n = 1
+        while stem in used:
+            stem = f"{splitext(basename(image_path))[0]}_{n}"
+            n += 1
+        used.add(stem)
+        stems[image_path] = stem
+    return stems
+
+
+def encoding_name(encoding):
+    # Recorded in the image attributes of every figure
+    if encoding["codec"] == "webp":
+        return f"webp quality={encoding['quality']}"
+    return f"jpeg quality={encoding['quality']} progressive={int(encoding['progressive'])} subsampling={encoding['subsampling']}"
+
+
+def encode_image(img, encoding):
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    image_file_out = BytesIO()
+    if encoding["codec"] == "webp":
+        img.save(image_file_out, format="WEBP", quality=encoding["quality"])
+    else:
+        img.save(image_file_out, format="JPEG", quality=encoding["quality"], progressive=encoding["progressive"], subsampling=encoding["subsampling"])
+    return image_file_out.getvalue()
+
+
+def can_pass_through(img, resize_images, max_size, encoding):
+    # JPEGs that already fit max_size are copied unchanged, which avoids the quality loss of encoding them again
+    return encoding["jpeg_passthrough"] and encoding["codec"] == "jpeg" and img.format == "JPEG" and img.mode in ("RGB", "L") and (not resize_images or max(img.size) <= max_size)
+
+
+def process_image(image_bytes, image_path, resize_images=True, max_size=512, encoding=DEFAULT_ENCODING, renderer=None, stats=None, limits=DEFAULT_LIMITS):
+    # Returns the output image bytes of a figure and its image attributes except for the checksum (see figure_cache.py).
+    # Figures exceeding limits are rejected from their header, before they are decoded.
+    with timed(stats, "probe"):
+        check_figure_limits(image_bytes, image_path, resize_images, max_size, limits, renderer)
+    if not image_path.endswith(VECTOR_IMG_EXTENSIONS):
+        with Image.open(BytesIO(image_bytes)) as img:
+            if can_pass_through(img, resize_images, max_size, encoding):
+                if stats is not None:
+                    stats["passthrough_figures"] += 1
+                return image_bytes, {"phash": perceptual_hash(img), "original_width": img.width, "original_height": img.height, "encoding": "passthrough"}
+    img, original_size = load_image(image_bytes, image_path, resize_images, max_size, renderer, stats)
+    with timed(stats, "encode"):
+        output_bytes = encode_image(img, encoding)
+    with timed(stats, "phash"):
+        phash = perceptual_hash(img)
+    return output_bytes, {"phash": phash, "original_width": original_size[0], "original_height": original_size[1], "encoding": encoding_name(encoding)}
+
+
+def figure_params(resize_images, max_size, encoding):
+    # Parameters that determine the output of process_image, used as part of the figure cache key
+    return resize_images, max_size if resize_images else None, sorted(encoding.items())
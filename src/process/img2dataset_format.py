@@ -0,0 +1,79 @@
+# Samples and metadata files in the format of img2dataset (https://github.com/rom1504/img2dataset): every sample
+# consists of an image, a .txt caption and a .json member with its metadata, and every shard <n>.tar is accompanied by
+# <n>.parquet with the metadata of all its samples and <n>_stats.json.
+from hashlib import sha256
+from json import dump, dumps
+from os.path import basename, splitext
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from shard_index import IMAGE_ATTRIBUTE_TYPES
+
+
+METADATA_COLUMNS = ("uid", "key", "text", "paper_id", "original_image_filename", *IMAGE_ATTRIBUTE_TYPES)
+
+
+def sample_uid(sample_name):
+    # Deterministic uid of a sample, derived from its name before conversion, e.g. 2001.00001-fig1
+    return sha256(sample_name.encode("utf-8")).hexdigest()[:32]
+
+
+def sample_metadata(uid, key, image_name, text, attributes=None):
+    attributes = attributes or {}
+    return {
+        "uid": uid,
+        "key": key,
+        "text": text,
+        "paper_id": splitext(basename(image_name))[0].split("-")[0],
+        "original_image_filename": "-".join(basename(image_name).split("-")[1:]),
+        **{column: attributes.get(column) for column in IMAGE_ATTRIBUTE_TYPES},
+    }
+
+
+def to_img2dataset_members(members):
+    # Converts the (name, bytes, image attributes) members of the images and captions of a paper into img2dataset
+    # samples keyed by their uid. Returns the new members and the metadata of the samples.
+    images = {}
+    captions = {}
+    for name, file_bytes, attributes in members:
+        stem, ext = splitext(name)
+        samples = captions if ext == ".txt" else images
+        if stem in samples:
+            # process_paper and extract_figures_and_captions give every figure a unique name, see unique_stems
+            print(f"Dropping duplicate member {name}")
+            continue
+        samples[stem] = file_bytes if ext == ".txt" else (ext, file_bytes, attributes)
+    new_members = []
+    metadata = []
+    for stem, (ext, image_bytes, attributes) in images.items():
+        if stem not in captions:
+            continue
+        uid = sample_uid(stem)
+        sample = sample_metadata(uid, uid, stem + ext, captions[stem].decode("utf-8"), attributes)
+        new_members.append((uid + ext, image_bytes, attributes))
+        new_members.append((uid + ".txt", captions[stem], None))
+        new_members.append((uid + ".json", dumps(sample).encode("utf-8"), None))
+        metadata.append(sample)
+    return new_members, metadata
+
+
+def save_metadata_to_parquet(tar_filename, metadata):
+    base_name = splitext(tar_filename)[0]
+    parquet_filename = base_name + ".parquet"
+    columns = {column: pa.array(values, type=IMAGE_ATTRIBUTE_TYPES[column]) if column in IMAGE_ATTRIBUTE_TYPES else values for column, values in metadata.items()}
+    table = pa.Table.from_pydict(columns)
+    pq.write_table(table, parquet_filename)
+
+
+def save_stats_json(tar_filename, count):
+    stats_json_filename = splitext(tar_filename)[0] + "_stats.json"
+    stats_json = {"count": count, "successes": count}
+    with open(stats_json_filename, "w") as stats_json_file:
+        dump(stats_json, stats_json_file)
+
+
+def write_shard_metadata(shard_path, metadata):
+    # Writes the metadata files of a shard from the metadata of its samples, e.g. as on_finalize of a ShardWriter
+    save_metadata_to_parquet(shard_path, {column: [sample.get(column) for sample in metadata] for column in METADATA_COLUMNS})
+    save_stats_json(shard_path, len(metadata))
@@ -0,0 +1,153 @@
+# Counters and stage timers of the extraction scripts. Workers collect them per item in a Counter, where a stage is
+# recorded as <stage>_seconds (and <stage>_calls if timed with timed()), and return it with their result. The parent
+# merges them into a MetricsWriter, which periodically writes the totals as JSON or in the Prometheus text format.
+# Items that take longer than a time threshold or raise the peak RSS of their worker above a memory threshold, as well as
+# failed items, are appended to an item log (JSON lines), which is shared by all processes.
+from collections import Counter
+from contextlib import contextmanager
+from json import dump, dumps
+from os import O_APPEND, O_CREAT, O_WRONLY, close, getpid, open as os_open, replace, write
+from resource import RUSAGE_SELF, getrusage
+from threading import Event, Lock, Thread
+from time import perf_counter, time
+
+
+@contextmanager
+def timed(stats, stage):
+    start_time = perf_counter()
+    try:
+        yield
+    finally:
+        if stats is not None:
+            stats[f"{stage}_seconds"] += perf_counter() - start_time
+            stats[f"{stage}_calls"] += 1
+
+
+def peak_rss_mb():
+    return getrusage(RUSAGE_SELF).ru_maxrss / 1024  # in KB on Linux
+
+
+class ItemLog:
+    # Picklable, so it can be passed to worker processes. Every entry is written with a single append, so the lines of
+    # different processes do not interleave.
+    def __init__(self, path, max_seconds=None, max_rss_mb=None):
+        self.path = path
+        self.max_seconds = max_seconds
+        self.max_rss_mb = max_rss_mb
+
+    def log(self, kind, item_id, **fields):
+        entry = dumps({"time": time(), "pid": getpid(), "kind": kind, "id": item_id, **fields}) + "\n"
+        fd = os_open(self.path, O_WRONLY | O_CREAT | O_APPEND, 0o644)
+        try:
+            write(fd, entry.encode("utf-8"))
+        finally:
+            close(fd)
+
+    def start(self):
+        return perf_counter(), peak_rss_mb()
+
+    def finish(self, kind, item_id, start):
+        # Logs the item if it exceeded a threshold, start is the result of start() before processing the item
+        start_time, start_rss_mb = start
+        seconds = perf_counter() - start_time
+        rss_mb = peak_rss_mb()
+        slow = self.max_seconds is not None and seconds > self.max_seconds
+        # The peak RSS only grows, so an item is only blamed for it if the peak grew while processing it
+        large = self.max_rss_mb is not None and rss_mb > self.max_rss_mb and rss_mb > start_rss_mb
+        if slow or large:
+            self.log(kind, item_id, seconds=round(seconds, 3), peak_rss_mb=round(rss_mb, 1))
+
+
+@contextmanager
+def logged_item(item_log, kind, item_id):
+    start = item_log.start() if item_log is not None else None
+    yield
+    if item_log is not None:
+        item_log.finish(kind, item_id, start)
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument("--metrics_path", type=str, default=None, help="File the counters and stage timers are periodically written to, in the Prometheus text format if it ends with .prom and as JSON otherwise")
+    parser.add_argument("--metrics_interval", type=float, default=60, help="Interval in seconds at which the metrics are written")
+    parser.add_argument("--item_log", type=str, default=None, help="JSON lines file that failed and slow items are logged to (default: item_log.jsonl in the output directory)")
+    parser.add_argument("--slow_item_seconds", type=float, default=None, help="Log items that take longer than this many seconds")
+    parser.add_argument("--slow_item_rss", type=float, default=None, help="Log items that raise the peak RSS of a worker above this many MB")
+
+
+def prometheus_text(stats, prefix):
+    lines = []
+    stages = sorted(key[:-len("_seconds")] for key in stats if key.endswith("_seconds"))
+    calls = [stage for stage in stages if f"{stage}_calls" in stats]
+    for metric, stage_names, suffix in (("stage_seconds_total", stages, "_seconds"), ("stage_calls_total", calls, "_calls")):
+        if stage_names:
+            lines.append(f"# TYPE {prefix}_{metric} counter")
+            lines += [f'{prefix}_{metric}{{stage="{stage}"}} {stats[stage + suffix]}' for stage in stage_names]
+    stage_keys = {stage + "_seconds" for stage in stages} | {stage + "_calls" for stage in calls}
+    for key in sorted(stats.keys() - stage_keys):
+        lines.append(f"# TYPE {prefix}_{key}_total counter")
+        lines.append(f"{prefix}_{key}_total {stats[key]}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsWriter:
+    # Thread-safe sum of the stats of all items, written to path every interval seconds and on close. The format is
+    # the Prometheus text format if path ends with .prom, and JSON otherwise. If path is None, the stats are only summed.
+    def __init__(self, path, interval=60, prefix="extraction"):
+        self.path = path
+        self.interval = interval
+        self.prefix = prefix
+        self.stats = Counter()
+        self.lock = Lock()
+        self.start_time = perf_counter()
+        self.closed = Event()
+        self.thread = None
+
+    def update(self, stats):
+        with self.lock:
+            self.stats.update(stats)
+
+    def snapshot(self):
+        with self.lock:
+            return Counter(self.stats)
+
+    def write(self):
+        if self.path is None:
+            return
+        stats = self.snapshot()
+        elapsed_seconds = perf_counter() - self.start_time
+        partial_path = self.path + ".partial"
+        with open(partial_path, "w") as metrics_file:
+            if self.path.endswith(".prom"):
+                metrics_file.write(prometheus_text(stats, self.prefix))
+                metrics_file.write(f"# TYPE {self.prefix}_elapsed_seconds gauge\n{self.prefix}_elapsed_seconds {elapsed_seconds}\n")
+                metrics_file.write(f"# TYPE {self.prefix}_parent_peak_rss_megabytes gauge\n{self.prefix}_parent_peak_rss_megabytes {peak_rss_mb()}\n")
+            else:
+                dump({"elapsed_seconds": elapsed_seconds, "parent_peak_rss_mb": peak_rss_mb(), "stats": dict(sorted(stats.items()))}, metrics_file, indent=2)
+        replace(partial_path, self.path)  # readers never see a partially written file
+
+    def run(self):
+        while not self.closed.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                print(f"Failed writing metrics to {self.path}, error message:")
+                print(e)
+
+    def start(self):
+        if self.path is None:
+            return self
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.closed.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.write()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,68 @@
+# Deterministic partitioning of the inputs (arXiv archives, PMC packages) between nodes that process them independently,
+# e.g. as the array jobs of a batch cluster. Every input is assigned to one of num_partitions partitions by a stable hash
+# of its name, so all nodes agree on the assignment without coordination. Every node writes to its own output directory
+# (namespace) in the shared output directory, and a manifest of its shards and their number of samples once it is done.
+# src/postprocess/merge_partitions.py then renames the shards of all partitions into one sequentially numbered dataset.
+from glob import glob
+from hashlib import sha256
+from json import dump, load
+from os import replace
+from os.path import basename, isfile, join
+import tarfile
+
+from shard_index import IMAGE_EXTENSIONS, StaleIndexError, read_index
+
+
+MANIFEST_FILENAME = "manifest.json"
+
+
+def partition_of(key, num_partitions):
+    return int.from_bytes(sha256(key.encode("utf-8")).digest()[:8], "big") % num_partitions
+
+
+def in_partition(key, num_partitions=1, partition_index=0):
+    return num_partitions == 1 or partition_of(key, num_partitions) == partition_index
+
+
+def partition_dir(output_dir, num_partitions=1, partition_index=0):
+    if num_partitions == 1:
+        return output_dir
+    return join(output_dir, f"partition-{partition_index:05d}-of-{num_partitions:05d}")
+
+
+def add_partition_arguments(parser):
+    parser.add_argument("--num_partitions", type=int, default=1, help="Number of nodes the inputs are partitioned between")
+    parser.add_argument("--partition_index", type=int, default=0, help="Partition processed by this node, from 0 to num_partitions - 1. Its output is written to partition-<index>-of-<num_partitions> in the output directory")
+
+
+def check_partition_arguments(parser, args):
+    if not 0 <= args.partition_index < args.num_partitions:
+        parser.error("--partition_index must be at least 0 and less than --num_partitions")
+
+
+def count_samples(tar_path):
+    # Number of images of a shard, read from its member index if it has one that matches it
+    try:
+        names = read_index(tar_path, ["name"]).column("name").to_pylist()
+    except (FileNotFoundError, StaleIndexError):
+        with tarfile.open(tar_path) as tar:
+            names = tar.getnames()
+    return sum(1 for name in names if name.endswith(IMAGE_EXTENSIONS))
+
+
+def write_manifest(output_dir, num_partitions=1, partition_index=0):
+    shards = [{"name": basename(tar_path), "samples": count_samples(tar_path)} for tar_path in sorted(glob(join(output_dir, "*.tar")))]
+    manifest = {"num_partitions": num_partitions, "partition_index": partition_index, "num_samples": sum(shard["samples"] for shard in shards), "shards": shards}
+    manifest_path = join(output_dir, MANIFEST_FILENAME)
+    with open(manifest_path + ".partial", "w") as manifest_file:
+        dump(manifest, manifest_file, indent=2)
+    replace(manifest_path + ".partial", manifest_path)
+    return manifest
+
+
+def read_manifest(output_dir):
+    manifest_path = join(output_dir, MANIFEST_FILENAME)
+    if not isfile(manifest_path):
+        return None
+    with open(manifest_path) as manifest_file:
+        return load(manifest_file)
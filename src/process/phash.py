@@ -0,0 +1,31 @@
+# 64 bit perceptual hash (pHash) of images: the bits are the signs of the 8x8 lowest frequency DCT coefficients of the
+# 32x32 grayscale image, relative to their median. Similar images have hashes with a small Hamming distance.
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+
+HASH_SIZE = 8
+IMAGE_SIZE = 32
+DCT_MATRIX = np.sqrt(2 / IMAGE_SIZE) * np.cos(np.pi * np.outer(np.arange(IMAGE_SIZE), 2 * np.arange(IMAGE_SIZE) + 1) / (2 * IMAGE_SIZE))
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def perceptual_hash(image):
+    pixels = np.asarray(image.convert("L").resize((IMAGE_SIZE, IMAGE_SIZE), Image.LANCZOS), dtype=np.float64)
+    coefficients = (DCT_MATRIX @ pixels @ DCT_MATRIX.T)[:HASH_SIZE, :HASH_SIZE].ravel()
+    bits = coefficients > np.median(coefficients)
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hash_image_bytes(image_bytes):
+    with Image.open(BytesIO(image_bytes)) as image:
+        image.draft("L", (2 * IMAGE_SIZE, 2 * IMAGE_SIZE))  # JPEGs are only decoded at the needed resolution
+        return perceptual_hash(image)
+
+
+def hamming_distances(hashes, other_hashes):
+    # Element-wise Hamming distances of two uint64 arrays
+    differences = np.ascontiguousarray(np.bitwise_xor(hashes, other_hashes), dtype=np.uint64)
+    return POPCOUNT[differences.view(np.uint8)].reshape(-1, 8).sum(axis=1)
@@ -1,24 +1,39 @@
 #!/usr/bin/env python
 from argparse import ArgumentParser
-from ftplib import FTP
-from io import BytesIO
-from multiprocessing import Process, Pool
-from os import cpu_count, makedirs
-from os.path import basename, isdir, join, splitext
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+import csv
+from functools import partial
+from http.client import HTTPConnection, HTTPException, HTTPSConnection
+from io import BytesIO, TextIOWrapper
+from multiprocessing import get_context
+from multiprocessing.util import Finalize
+from os import cpu_count, getpid, makedirs, replace
+from os.path import basename, dirname, isfile, join, splitext
 from pathlib import Path
+from socket import gethostname
 import tarfile
+from threading import local
+from time import sleep
 from typing import Optional, Tuple
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlsplit
 from urllib.request import urlopen
+import zlib
 
 from lxml import etree
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
 
+from figure_cache import FigureCache, process_figure
+from figures import DEFAULT_ENCODING, DEFAULT_LIMITS, FigureTooLargeError, add_encoding_arguments, add_limit_arguments, check_figure_limits, encoding_from_args, figure_params, image_extension, limits_from_args, process_image, unique_stems
+from img2dataset_format import to_img2dataset_members, write_shard_metadata
+from partitions import add_partition_arguments, check_partition_arguments, in_partition, partition_dir, write_manifest
+from metrics import ItemLog, MetricsWriter, add_metrics_arguments, logged_item, timed
+from shards import ShardWriter, next_shard_index, read_completed_items, remove_partial_shards
+from worker_pool import WorkerPool, add_worker_arguments
 
-def add_bytes_to_tar(tar_file, name, file_bytes):
-    info = tarfile.TarInfo(name)
-    info.size = len(file_bytes)
-    tar.addfile(info, fileobj=BytesIO(file_bytes))
+
+JOURNAL_FILENAME = "completed_packages.txt"
 
 
 def extract_caption_per_figure_from_xml(xml_file, image_filenames=None):
@@ -55,63 +70,275 @@ def extract_caption(figure: etree.Element) -> Optional[Tuple[str, str]]:
     return caption, href
 
 
-def extract_figures_and_captions_from_archive(archive_fileobj, output_dir, resize_images=True, max_size=512):
-    with tarfile.open(fileobj=archive_fileobj, mode="r:gz") as input_tar:
-        image_filenames = []
-        image_members = []
-        xml_file = None
+def read_package(archive_fileobj, max_image_bytes=None, stats=None):
+    # Reads the archive as a stream (so it also works on an HTTP response), keeping only the .nxml and .jpg members.
+    # Images larger than max_image_bytes are skipped without being read.
+    image_files = {}
+    xml_bytes = None
+    with tarfile.open(fileobj=archive_fileobj, mode="r|gz") as input_tar:
         for tar_info in input_tar:
             if tar_info.name.endswith(".nxml"):
-                xml_file = input_tar.extractfile(tar_info)
-                # xml_filepath = join(temp_dir, tar_info.name)
+                xml_bytes = input_tar.extractfile(tar_info).read()
             if tar_info.name.endswith(".jpg"):
-                image_members.append(tar_info)
-                image_filenames.append(tar_info.name)
-        if xml_file is None:
-            return
-        captions = extract_caption_per_figure_from_xml(xml_file, image_filenames)
-        if len(captions) == 0:
-            return
-        makedirs(output_dir, exist_ok=True)
-        for tar_info in image_members:
-            figure_id = splitext(basename(tar_info.name))[0]
-            caption = captions.get(figure_id)
-            if caption is None:
-                continue
-            image_file = input_tar.extractfile(tar_info)
-            img = Image.open(image_file)
-            if resize_images:
-                img.thumbnail((max_size, max_size))
-            img.save(join(output_dir, figure_id + ".jpg"), format="JPEG")
-            with open(join(output_dir, figure_id + ".txt"), "w", encoding="utf-8") as caption_file:
-                caption_file.write(caption)
-
-
-def process_ftp_subdir(paper_filenames, https_url, output_dir, resize_images=True, max_size=512, temp_dir=None):
-    if temp_dir is not None:
-        makedirs(temp_dir, exist_ok=True)
-    for paper_filename in paper_filenames:
-        paper_output_dir = join(output_dir, basename(paper_filename)[:-len(".tar.gz")])
-        if isdir(paper_output_dir):
+                if max_image_bytes is not None and tar_info.size > max_image_bytes:
+                    if stats is not None:
+                        stats["skipped_figures_too_large"] += 1
+                    continue
+                image_files[tar_info.name] = input_tar.extractfile(tar_info).read()
+    return xml_bytes, image_files
+
+
+def extract_figures_and_captions_from_archive(archive_fileobj, paper_id, resize_images=True, max_size=512, cache=None, encoding=DEFAULT_ENCODING, limits=DEFAULT_LIMITS, item_log=None, stats=None):
+    with timed(stats, "package_read"):
+        xml_bytes, image_files = read_package(archive_fileobj, limits["max_bytes"], stats)
+    return extract_figures_and_captions(xml_bytes, image_files, paper_id, resize_images, max_size, cache, encoding, limits, item_log, stats)
+
+
+def extract_figures_and_captions(xml_bytes, image_files, paper_id, resize_images=True, max_size=512, cache=None, encoding=DEFAULT_ENCODING, limits=DEFAULT_LIMITS, item_log=None, stats=None):
+    # Figures exceeding limits and figures that can not be loaded are skipped. stats counts the figures and skipped
+    # figures and times the stages (see metrics.py). Skipped figures and figures that exceed the thresholds of item_log
+    # are logged.
+    stats = stats if stats is not None else Counter()
+    members = []  # (name, bytes, image attributes) tuples of the output shard members
+    if xml_bytes is None:
+        stats["skipped_packages_no_xml"] += 1
+        return members
+    with timed(stats, "xml_parse"):
+        captions = extract_caption_per_figure_from_xml(BytesIO(xml_bytes), image_files.keys())
+    out_stems = unique_stems(image_files)
+    for image_filename, image_bytes in image_files.items():
+        figure_id = splitext(basename(image_filename))[0]
+        caption = captions.get(figure_id)
+        if caption is None:
+            stats["skipped_figures_no_caption"] += 1
+            continue
+        try:
+            with logged_item(item_log, "figure", f"{paper_id}/{image_filename}"):
+                image_out_bytes, attributes, cached = process_figure(image_bytes, figure_params(resize_images, max_size, encoding), lambda image_bytes: process_image(image_bytes, image_filename, resize_images, max_size, encoding, stats=stats, limits=limits), cache, lambda image_bytes: check_figure_limits(image_bytes, image_filename, resize_images, max_size, limits))
+        except FigureTooLargeError as e:
+            stats["skipped_figures_too_large"] += 1
+            if item_log is not None:
+                item_log.log("figure", f"{paper_id}/{image_filename}", error=f"{type(e).__name__}: {e}")
             continue
-        paper_url = urljoin(https_url, paper_filename)
-        paper_fileobj = BytesIO(urlopen(paper_url).read())  # download using TLS 
-        extract_figures_and_captions_from_archive(paper_fileobj, paper_output_dir, resize_images, max_size)
-
-
-def main(output_dir, ftp_root_dir, ftp_domain, https_url, resize_images=True, max_size=512):
-    ftp = FTP(ftp_domain)
-    ftp.login()
-    ftp.cwd(ftp_root_dir)
-    pool = Pool(processes=round(1.5 * cpu_count()))
-    for level_1_dir in ftp.nlst():
-        for level_2_dir in ftp.nlst(level_1_dir):
-            tar_output_dir = join(output_dir, level_2_dir)
-            paper_filenames = [join(ftp_root_dir, i) for i in ftp.nlst(level_2_dir) if i.endswith(".tar.gz")]
-            makedirs(tar_output_dir, exist_ok=True)
-            pool.apply_async(func=process_ftp_subdir, args=(paper_filenames, https_url, tar_output_dir, resize_images, max_size))
+        except (Image.DecompressionBombError, OSError, UnidentifiedImageError) as e:
+            print(f"Could not load image {image_filename} of {paper_id}, error message:")
+            print(e)
+            stats["skipped_figures_load_error"] += 1
+            if item_log is not None:
+                item_log.log("figure", f"{paper_id}/{image_filename}", error=f"{type(e).__name__}: {e}")
+            continue
+        if cached:
+            stats["cached_figures"] += 1
+        stats["figures"] += 1
+        stats["bytes_out"] += len(image_out_bytes)
+        members.append((f"{paper_id}-{out_stems[image_filename]}{image_extension(encoding)}", image_out_bytes, attributes))
+        members.append((f"{paper_id}-{out_stems[image_filename]}.txt", caption.encode("utf-8"), None))
+    return members
+
+
+class DownloadError(Exception):
+    def __init__(self, url, status):
+        super().__init__(f"Downloading {url} failed with HTTP status {status}")
+        self.status = status
+
+
+class PackageDownloader:
+    # Streams HTTP(S) responses to a consumer over keep-alive connections, one per thread and host. The number of
+    # concurrent requests to the package host is limited by connection_limit, which can be shared between processes.
+    # Requests that fail because of the network or the server (HTTP 5xx or 429) are retried with exponential backoff.
+    # Errors of consume reading a corrupt package are raised right away, since downloading it again does not help.
+    def __init__(self, connection_limit=None, retries=5, backoff=1, timeout=60):
+        self.connection_limit = connection_limit
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.local = local()
+
+    def connection(self, scheme, netloc):
+        connections = self.local.__dict__.setdefault("connections", {})
+        if (scheme, netloc) not in connections:
+            connection_class = HTTPSConnection if scheme == "https" else HTTPConnection
+            connections[scheme, netloc] = connection_class(netloc, timeout=self.timeout)
+        return connections[scheme, netloc]
+
+    def close_connection(self, scheme, netloc):
+        connection = self.local.__dict__.get("connections", {}).pop((scheme, netloc), None)
+        if connection is not None:
+            connection.close()
+
+    def fetch(self, url, consume):
+        parsed_url = urlsplit(url)
+        path = parsed_url.path + ("?" + parsed_url.query if parsed_url.query else "")
+        for attempt in range(self.retries + 1):
+            try:
+                with self.connection_limit or nullcontext():
+                    connection = self.connection(parsed_url.scheme, parsed_url.netloc)
+                    connection.request("GET", path)
+                    response = connection.getresponse()
+                    if response.status != 200:
+                        response.read()
+                        raise DownloadError(url, response.status)
+                    result = consume(response)
+                    while response.read(1 << 16):  # drain the rest, e.g. tar padding, to reuse the connection
+                        pass
+                    return result
+            except (EOFError, tarfile.TarError, zlib.error):
+                self.close_connection(parsed_url.scheme, parsed_url.netloc)  # the rest of the response was not read
+                raise
+            except (DownloadError, HTTPException, OSError) as e:
+                self.close_connection(parsed_url.scheme, parsed_url.netloc)
+                retryable = not isinstance(e, DownloadError) or e.status == 429 or e.status >= 500
+                if not retryable or attempt == self.retries:
+                    raise
+                sleep(self.backoff * 2 ** attempt)
+
+
+downloader = None
+download_executor = None
+shard_writer = None
+figure_cache = None
+item_log = None
+
+
+def init_worker(connection_limit, num_threads, retries, output_dir, shard_size, shard_counter, figure_cache_dir=None, figure_cache_size=None, img2dataset_output=False, worker_item_log=None):
+    global downloader, download_executor, shard_writer, figure_cache, item_log
+    downloader = PackageDownloader(connection_limit, retries=retries)
+    download_executor = ThreadPoolExecutor(max_workers=num_threads)
+    on_finalize = write_shard_metadata if img2dataset_output else None
+    shard_writer = ShardWriter(output_dir, shard_size, shard_counter, join(output_dir, JOURNAL_FILENAME), on_finalize)
+    Finalize(shard_writer, shard_writer.close, exitpriority=10)  # finalize the shard of an interrupted batch when the worker exits
+    if figure_cache_dir is not None:
+        figure_cache = FigureCache(figure_cache_dir, figure_cache_size)
+    item_log = worker_item_log
+
+
+def process_package(package_path, last_updated, package_root_url, resize_images=True, max_size=512, encoding=DEFAULT_ENCODING, img2dataset_output=False, limits=DEFAULT_LIMITS):
+    paper_url = urljoin(package_root_url, package_path)
+    paper_id = basename(package_path)[:-len(".tar.gz")]
+    stats = Counter({"packages": 1})
+    try:
+        with logged_item(item_log, "package", package_path):
+            with timed(stats, "package_read"):  # includes the download, since the package is read as a stream
+                size, (xml_bytes, image_files) = downloader.fetch(paper_url, lambda response: (response.getheader("Content-Length", ""), read_package(response, limits["max_bytes"], stats)))
+            stats["bytes_in"] += int(size) if size.isdigit() else 0
+            members = extract_figures_and_captions(xml_bytes, image_files, paper_id, resize_images, max_size, figure_cache, encoding, limits, item_log, stats)
+    except Exception as e:
+        print(f"Failed processing package {paper_url}, error message:")
+        print(e)
+        if item_log is not None:
+            item_log.log("package", package_path, error=f"{type(e).__name__}: {e}")
+        return Counter({"packages": 1, "failed_packages": 1})
+    metadata = None
+    if img2dataset_output:
+        members, metadata = to_img2dataset_members(members)
+    with timed(stats, "write"):
+        shard_writer.write(f"{package_path}\t{last_updated}\t{size}", members, metadata)
+    return stats
+
+
+def process_packages(packages, package_root_url, resize_images=True, max_size=512, encoding=DEFAULT_ENCODING, img2dataset_output=False, limits=DEFAULT_LIMITS, skip_completed=False):
+    # Returns the merged stats of the packages. If the batch is retried after its worker died, the packages that were
+    # journaled in the meantime are skipped with skip_completed. The open shard is finalized at the end of the batch,
+    # so that the packages whose stats are returned are journaled, even if the worker is killed later. A shard holds
+    # the packages of at most one batch.
+    if skip_completed:
+        completed_packages = read_completed_packages(shard_writer.journal_path)
+        packages = [(package_path, last_updated) for package_path, last_updated in packages if completed_packages.get(package_path) != last_updated]
+    futures = [download_executor.submit(process_package, package_path, last_updated, package_root_url, resize_images, max_size, encoding, img2dataset_output, limits) for package_path, last_updated in packages]
+    stats = Counter()
+    for future in futures:
+        stats.update(future.result())
+    with timed(stats, "write"):
+        shard_writer.close()
+    return stats
+
+
+def open_file_list(file_list):
+    if urlsplit(file_list).scheme in ("http", "https", "ftp"):
+        return TextIOWrapper(urlopen(file_list), encoding="utf-8", newline="")
+    return open(file_list, encoding="utf-8", newline="")
+
+
+def build_package_index(file_list, index_path):
+    # Persists the package paths and last update dates of a PMC file list CSV (oa_file_list.csv) as a sorted TSV file
+    with open_file_list(file_list) as file_list_file:
+        reader = csv.reader(file_list_file)
+        header = next(reader)
+        path_column = header.index("File")
+        last_updated_column = next(i for i, column in enumerate(header) if column.startswith("Last Updated"))
+        packages = sorted((row[path_column], row[last_updated_column]) for row in reader if row[path_column].endswith(".tar.gz"))
+    makedirs(dirname(index_path) or ".", exist_ok=True)
+    # The index may be shared by the nodes of a partitioned run, which could rebuild it at the same time
+    partial_path = f"{index_path}.{gethostname()}-{getpid()}.partial"
+    with open(partial_path, "w", encoding="utf-8") as index_file:
+        index_file.writelines(f"{package_path}\t{last_updated}\n" for package_path, last_updated in packages)
+    replace(partial_path, index_path)
+
+
+def load_package_index(index_path):
+    with open(index_path, encoding="utf-8") as index_file:
+        return [tuple(line.rstrip("\n").split("\t")) for line in index_file]
+
+
+def read_completed_packages(journal_path):
+    # Maps the path of every processed package to the last update date it was processed at. Updated packages are
+    # journaled again, so the latest of their dates is used.
+    completed_packages = {}
+    for item in read_completed_items(journal_path):
+        package_path, last_updated = item.split("\t")[:2]
+        completed_packages[package_path] = max(last_updated, completed_packages.get(package_path, last_updated))
+    return completed_packages
+
+
+def main(output_dir, file_list, index_path, package_root_url, refresh_index=False, resize_images=True, max_size=512, num_threads=8, max_connections=32, retries=5, shard_size=512, batch_size=256, figure_cache_dir=None, figure_cache_size=None, encoding=DEFAULT_ENCODING, img2dataset_output=False, metrics_path=None, metrics_interval=60, item_log_path=None, slow_item_seconds=None, slow_item_rss=None, limits=DEFAULT_LIMITS, num_workers=None, max_worker_rss=None, task_retries=1, num_partitions=1, partition_index=0):
+    # With num_partitions > 1, only the packages of partition_index are processed, and the output is written to the
+    # directory of the partition in output_dir (see partitions.py)
+    output_dir = partition_dir(output_dir, num_partitions, partition_index)
+    makedirs(output_dir, exist_ok=True)
+    remove_partial_shards(output_dir, join(output_dir, JOURNAL_FILENAME))  # completes journaled shards, the packages of the others are processed again
+    if refresh_index or not isfile(index_path):
+        build_package_index(file_list, index_path)
+    completed_packages = read_completed_packages(join(output_dir, JOURNAL_FILENAME))
+    # Only new packages and packages updated since they were processed
+    packages = [(package_path, last_updated) for package_path, last_updated in load_package_index(index_path) if in_partition(package_path, num_partitions, partition_index) and completed_packages.get(package_path) != last_updated]
+    print(f"Processing {len(packages)} new or updated packages")
+    context = get_context("forkserver")  # the context of the worker pool, see worker_pool.py
+    shard_counter = context.Value("q", next_shard_index(output_dir))
+    # Downloads are network bound, so every worker process downloads and extracts num_threads packages concurrently.
+    # Every worker writes its own shards.
+    connection_limit = context.BoundedSemaphore(max_connections)
+    figure_cache_bytes = figure_cache_size * 1024 ** 3 if figure_cache_size is not None else None
+    worker_item_log = ItemLog(item_log_path or join(output_dir, "item_log.jsonl"), slow_item_seconds, slow_item_rss)
+    metrics = MetricsWriter(metrics_path, metrics_interval, "pmc").start()  # merges the stats returned by every batch
+    failed_batches = []
+
+    def report_failed_batch(batch, e):
+        print(f"Failed processing a batch of {len(batch)} packages starting with {batch[0][0]}, error message:")
+        print(e)
+        failed_batches.append(batch)
+        metrics.update({"failed_batches": 1})
+
+    # Workers that die (and whose open shard of the current batch is lost) are replaced, and their batch is retried
+    # without the packages that were journaled in the meantime
+    pool = WorkerPool(num_workers or round(1.5 * cpu_count()), init_worker, (connection_limit, num_threads, retries, output_dir, shard_size * 1024 ** 2, shard_counter, figure_cache_dir, figure_cache_bytes, img2dataset_output, worker_item_log), max_worker_rss, task_retries, context)
+    for i in range(0, len(packages), batch_size):
+        batch = packages[i:i + batch_size]
+        pool.apply_async(func=process_packages, args=(batch, package_root_url, resize_images, max_size, encoding, img2dataset_output, limits), callback=metrics.update, error_callback=partial(report_failed_batch, batch), retry_kwds={"skip_completed": True})
     pool.close()
     pool.join()
+    metrics.update(pool.stats)
+    metrics.close()
+    stats = metrics.snapshot()
+    print(f"Processed {stats['packages']} packages ({stats['failed_packages']} failed) with {stats['figures']} figures, skipped {stats['skipped_figures_too_large']} figures exceeding the limits and {stats['skipped_figures_load_error']} figures that could not be loaded")
+    print(f"Replaced {stats['died_workers']} workers that died and {stats['recycled_workers']} workers exceeding the RSS limit, retried {stats['retried_tasks']} batches")
+    if failed_batches:
+        print(f"Failed processing {len(failed_batches)} batches ({sum(len(batch) for batch in failed_batches)} packages), which are processed again by the next run")
+    if stats["failed_packages"]:
+        print(f"Failed packages are logged to {worker_item_log.path}, and processed again by the next run")
+    if figure_cache_dir is not None:
+        FigureCache(figure_cache_dir, figure_cache_bytes).evict()
+    manifest = write_manifest(output_dir, num_partitions, partition_index)
+    print(f"Wrote {len(manifest['shards'])} shards with {manifest['num_samples']} samples")
     print("done")
 
 
@@ -120,9 +347,24 @@ if __name__ == "__main__":
     parser.add_argument("--no_resize_images", action="store_true", help="Resize images")
     parser.add_argument("--max_size", type=int, default=512, help="Maximum size for mage resizing")
     parser.add_argument("--output_dir", type=str, default="data/processed/pmc", help="Output directory")
-    parser.add_argument("--ftp_root_dir", type=str, default="pub/pmc/oa_package", help="PubMed FTP service root directory")
-    parser.add_argument("--ftp_domain", type=str, default="ftp.ncbi.nlm.nih.gov", help="PubMed FTP service domain")
-    parser.add_argument("--https_url", type=str, default="https://ftp.ncbi.nlm.nih.gov", help="PubMed FTP service HTTPS URL")
+    parser.add_argument("--file_list", type=str, default="https://ftp.ncbi.nlm.nih.gov/pub/pmc/oa_file_list.csv", help="URL or local path of the PMC file list CSV")
+    parser.add_argument("--index_path", type=str, default="data/download/pmc/package_index.tsv", help="Path of the persisted package index built from the file list")
+    parser.add_argument("--refresh_index", action="store_true", help="Rebuild the package index from the file list, e.g. to process packages that are new or were updated since the last run")
+    parser.add_argument("--package_root_url", type=str, default="https://ftp.ncbi.nlm.nih.gov/pub/pmc/", help="URL the package paths of the file list are relative to")
+    parser.add_argument("--num_threads", type=int, default=8, help="Number of concurrent downloads per worker process")
+    parser.add_argument("--max_connections", type=int, default=32, help="Maximum number of concurrent connections to the package host")
+    parser.add_argument("--retries", type=int, default=5, help="Number of retries of a failed download")
+    parser.add_argument("--shard_size", type=int, default=512, help="Target size of the output shards in MB")
+    parser.add_argument("--batch_size", type=int, default=256, help="Number of packages per task. Every worker finalizes its shard at the end of a task, so shards hold the packages of at most one task")
+    parser.add_argument("--figure_cache_dir", type=str, default=None, help="Directory of a cache of processed figures, which is shared between runs")
+    parser.add_argument("--figure_cache_size", type=float, default=None, help="Maximum size of the figure cache in GB (default: unlimited)")
+    add_encoding_arguments(parser)
+    parser.add_argument("--img2dataset_output", action="store_true", help="Write the shards in img2dataset format, with a .json member per sample and .parquet and _stats.json files per shard")
+    add_metrics_arguments(parser)
+    add_limit_arguments(parser)
+    add_worker_arguments(parser)
+    add_partition_arguments(parser)
     
     args = parser.parse_args()
-    main(args.output_dir, args.ftp_root_dir, args.ftp_domain, args.https_url, not args.no_resize_images, args.max_size)
+    check_partition_arguments(parser, args)
+    main(args.output_dir, args.file_list, args.index_path, args.package_root_url, args.refresh_index, not args.no_resize_images, args.max_size, args.num_threads, args.max_connections, args.retries, args.shard_size, args.batch_size, args.figure_cache_dir, args.figure_cache_size, encoding_from_args(args), args.img2dataset_output, args.metrics_path, args.metrics_interval, args.item_log, args.slow_item_seconds, args.slow_item_rss, limits_from_args(args), args.num_workers, args.max_worker_rss, args.task_retries, args.num_partitions, args.partition_index)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# Renders vector figures in a long-lived child process that is fed over its stdin/stdout pipes. Rendering thereby
+# neither spawns a process nor writes a temporary file per figure, and a renderer that hangs or crashes only costs
+# the figure it was rendering: it is killed after a timeout and restarted for the next figure. PDFs are also probed for
+# their size and number of pages in the renderer, since parsing them is as likely to hang or crash as rendering them.
+from os import dup, dup2, fdopen, read
+from select import select
+from struct import Struct
+from subprocess import PIPE, Popen
+import sys
+from time import monotonic
+
+from PIL import Image
+
+from figures import probe, render
+
+
+REQUEST_HEADER = Struct("<3s?IQ")  # kind (b"pdf" or b"eps"), whether to probe instead of render, max size (0 if not resizing), length of the figure bytes
+RESPONSE_HEADER = Struct("<B8sIIQ")  # status (0 on success), image mode, width, height, length of the payload
+PROBE_RESULT = Struct("<QI")  # payload of a probe: number of pixels, number of pages
+
+
+class Renderer:
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self.process = None
+
+    def start(self):
+        self.process = Popen([sys.executable, __file__], stdin=PIPE, stdout=PIPE, bufsize=0)
+
+    def stop(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    def read(self, length, deadline):
+        chunks = []
+        while length > 0:
+            remaining_time = deadline - monotonic()
+            if remaining_time <= 0 or not select([self.process.stdout], [], [], remaining_time)[0]:
+                raise TimeoutError(f"Rendering took longer than {self.timeout} seconds")
+            chunk = read(self.process.stdout.fileno(), min(length, 1 << 20))
+            if not chunk:
+                raise EOFError("Renderer exited")
+            chunks.append(chunk)
+            length -= len(chunk)
+        return b"".join(chunks)
+
+    def request(self, kind, is_probe, source_bytes, max_size):
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+        deadline = monotonic() + self.timeout
+        try:
+            self.process.stdin.write(REQUEST_HEADER.pack(kind.encode("ascii"), is_probe, max_size or 0, len(source_bytes)))
+            self.process.stdin.write(source_bytes)
+            status, mode, width, height, length = RESPONSE_HEADER.unpack(self.read(RESPONSE_HEADER.size, deadline))
+            payload = self.read(length, deadline)
+        except (BrokenPipeError, EOFError, TimeoutError) as e:
+            self.stop()
+            raise OSError(str(e)) from e
+        if status != 0:
+            raise OSError(payload.decode("utf-8", errors="replace"))
+        return mode, width, height, payload
+
+    def render(self, kind, source_bytes, max_size=None):
+        mode, width, height, payload = self.request(kind, False, source_bytes, max_size)
+        return Image.frombytes(mode.rstrip(b"\0").decode("ascii"), (width, height), payload)
+
+    def probe(self, kind, source_bytes, max_size=None):
+        # Returns the number of pixels and pages of a figure (see figures.probe)
+        return PROBE_RESULT.unpack(self.request(kind, True, source_bytes, max_size)[3])
+
+
+renderer = None
+
+
+def get_renderer(timeout=60):
+    # Every worker process lazily starts its own renderer
+    global renderer
+    if renderer is None:
+        renderer = Renderer(timeout)
+    return renderer
+
+
+def read_exact(fileobj, length):
+    data = fileobj.read(length)
+    if len(data) != length:
+        raise EOFError
+    return data
+
+
+def serve(input_file, output_file):
+    while True:
+        try:
+            kind, is_probe, max_size, length = REQUEST_HEADER.unpack(read_exact(input_file, REQUEST_HEADER.size))
+            source_bytes = read_exact(input_file, length)
+        except EOFError:
+            return  # the worker closed the pipe
+        try:
+            if is_probe:
+                payload = PROBE_RESULT.pack(*probe(kind.decode("ascii"), source_bytes, max_size or None))
+                header = RESPONSE_HEADER.pack(0, b"", 0, 0, len(payload))
+            else:
+                img = render(kind.decode("ascii"), source_bytes, max_size or None)
+                if img.mode not in ("RGB", "L"):
+                    img = img.convert("RGB")
+                payload = img.tobytes()
+                header = RESPONSE_HEADER.pack(0, img.mode.encode("ascii"), img.width, img.height, len(payload))
+        except Exception as e:
+            payload = str(e).encode("utf-8")
+            header = RESPONSE_HEADER.pack(1, b"", 0, 0, len(payload))
+        output_file.write(header)
+        output_file.write(payload)
+        output_file.flush()
+
+
+if __name__ == "__main__":
+    output_file = fdopen(dup(sys.stdout.fileno()), "wb")
+    dup2(sys.stderr.fileno(), sys.stdout.fileno())  # keep stray library output out of the protocol
+    serve(sys.stdin.buffer, output_file)
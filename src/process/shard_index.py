@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# Sidecar index of the members of a tar shard, stored in Parquet format next to it as <shard>.tar.idx, with the sample
+# key, name, data offset and size of every member. Members that are images additionally have the attributes in
+# IMAGE_ATTRIBUTE_TYPES: their perceptual hash (see phash.py), the sha256 checksum and size of the source figure and
+# the encoder settings (see figures.py).
+# ShardReader uses the index for random access to the samples of a shard by key or position without scanning it.
+# The index records the size of its tar file, and indexes that do not match their tar file, e.g. because a crash
+# happened between renaming a rewritten tar and its index, are rejected by read_index.
+from argparse import ArgumentParser
+from glob import glob
+from mmap import ACCESS_READ, mmap
+from os import remove, replace
+from os.path import getsize, isfile, join, splitext
+import tarfile
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from phash import hash_image_bytes
+
+
+INDEX_SUFFIX = ".idx"
+TAR_SIZE_KEY = b"tar_size"  # key of the size of the tar file in the metadata of the index
+IMAGE_EXTENSIONS = (".jpg", ".webp")
+IMAGE_ATTRIBUTE_TYPES = {"phash": pa.uint64(), "sha256": pa.string(), "original_width": pa.int32(), "original_height": pa.int32(), "encoding": pa.string()}
+
+
+def index_path(tar_path):
+    return tar_path + INDEX_SUFFIX
+
+
+class StaleIndexError(ValueError):
+    pass
+
+
+class ShardIndexBuilder:
+    def __init__(self):
+        self.columns = {"key": [], "name": [], "offset": [], "size": [], **{column: [] for column in IMAGE_ATTRIBUTE_TYPES}}
+
+    def add(self, name, offset, size, attributes=None):
+        attributes = attributes or {}
+        self.columns["key"].append(splitext(name)[0])
+        self.columns["name"].append(name)
+        self.columns["offset"].append(offset)
+        self.columns["size"].append(size)
+        for column in IMAGE_ATTRIBUTE_TYPES:
+            self.columns[column].append(attributes.get(column))
+
+    def write(self, tar_path, partial_tar_path=None):
+        # If the tar file is still at partial_tar_path, the index is only written to <index path>.partial, and
+        # replace_shard renames both
+        tar_size = getsize(partial_tar_path or tar_path)
+        schema = pa.schema([("key", pa.string()), ("name", pa.string()), ("offset", pa.int64()), ("size", pa.int64()), *IMAGE_ATTRIBUTE_TYPES.items()], metadata={TAR_SIZE_KEY: str(tar_size)})
+        table = pa.table(self.columns, schema=schema)
+        pq.write_table(table, index_path(tar_path) + ".partial")
+        if partial_tar_path is None:
+            replace(index_path(tar_path) + ".partial", index_path(tar_path))
+
+
+def replace_shard(partial_tar_path, tar_path):
+    # The tar file is renamed before its index, so an index is never newer than its tar file
+    replace(partial_tar_path, tar_path)
+    replace(index_path(tar_path) + ".partial", index_path(tar_path))
+
+
+def index_matches(index, tar_path):
+    tar_size = getsize(tar_path)
+    metadata = index.schema.metadata or {}
+    if TAR_SIZE_KEY in metadata:
+        return int(metadata[TAR_SIZE_KEY]) == tar_size
+    # Indexes written before the tar size was recorded are only checked against the end of their last member
+    ends = [offset + size for offset, size in zip(index.column("offset").to_pylist(), index.column("size").to_pylist())]
+    return max(ends, default=0) <= tar_size
+
+
+def read_index(tar_path, columns=None):
+    # Reads the index of a tar file, raising StaleIndexError if it does not match the tar file
+    index = pq.read_table(index_path(tar_path), columns=columns if columns is None else sorted({*columns, "offset", "size"}))
+    if not index_matches(index, tar_path):
+        raise StaleIndexError(f"The index of {tar_path} does not match it, build it again using shard_index.py")
+    return index if columns is None else index.select(columns)
+
+
+def complete_partial_indexes(directory):
+    # Renames the partial indexes of tar files that were renamed right before a crash, and removes all others
+    for partial_path in glob(join(directory, "*.tar" + INDEX_SUFFIX + ".partial")):
+        tar_path = partial_path[:-len(INDEX_SUFFIX + ".partial")]
+        if isfile(tar_path) and index_matches(pq.read_table(partial_path, columns=["offset", "size"]), tar_path):
+            replace(partial_path, index_path(tar_path))
+        else:
+            remove(partial_path)
+
+
+def read_tar_members(tar_path, index=None):
+    # Adds the members of an existing tar file to an index by scanning it. Of the image attributes, only the perceptual
+    # hashes can be recovered, from the bytes of the images.
+    index = index if index is not None else ShardIndexBuilder()
+    with tarfile.open(tar_path, mode="r") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            attributes = None
+            if member.name.endswith(IMAGE_EXTENSIONS):
+                try:
+                    attributes = {"phash": hash_image_bytes(tar.extractfile(member).read())}
+                except Exception as e:
+                    print(f"Could not hash image {member.name}, error message:")
+                    print(e)
+            index.add(member.name, member.offset_data, member.size, attributes)
+    return index
+
+
+def build_shard_index(tar_path):
+    read_tar_members(tar_path).write(tar_path)
+
+
+class ShardReader:
+    def __init__(self, tar_path):
+        table = read_index(tar_path)
+        self.members = {}
+        for key, name, offset, size in zip(*(table.column(c).to_pylist() for c in ("key", "name", "offset", "size"))):
+            self.members.setdefault(key, []).append((name, offset, size))
+        self.keys = list(self.members)  # in shard order
+        self.file = open(tar_path, "rb")
+        self.mmap = mmap(self.file.fileno(), 0, access=ACCESS_READ)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, key_or_position):
+        # Returns a dict mapping the extensions of the members of a sample (e.g. ".jpg") to their bytes
+        key = self.keys[key_or_position] if isinstance(key_or_position, int) else key_or_position
+        return {splitext(name)[1]: self.mmap[offset:offset + size] for name, offset, size in self.members[key]}
+
+    def close(self):
+        self.mmap.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Build the sidecar index of existing tar shards")
+    parser.add_argument("directory", help="Directory containing .tar files")
+    args = parser.parse_args()
+    for tar_path in sorted(glob(join(args.directory, "*.tar"))):
+        build_shard_index(tar_path)
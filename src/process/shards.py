@@ -0,0 +1,201 @@
+from glob import glob
+from io import BytesIO
+from os import O_APPEND, O_CREAT, O_WRONLY, close, fsync, getpid, open as os_open, remove, replace, write
+from os.path import basename, isfile, join
+import re
+from secrets import token_hex
+import tarfile
+from threading import Lock
+
+from shard_index import ShardIndexBuilder, complete_partial_indexes, read_tar_members, replace_shard
+
+
+def add_bytes_to_tar(tar_file, name, file_bytes):
+    # Returns the offset of the member data in the tar file
+    info = tarfile.TarInfo(name)
+    info.size = len(file_bytes)
+    tar_file.addfile(info, fileobj=BytesIO(file_bytes))
+    return tar_file.offset - -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+
+def read_journal(journal_path):
+    # Returns the committed item ids, the tar offset after the last committed item and the byte length of the valid
+    # journal prefix (a torn last line of a crashed writer is ignored)
+    done = set()
+    offset = 0
+    valid_length = 0
+    with open(journal_path, "rb") as journal_file:
+        for line in journal_file:
+            fields = line.decode("utf-8").split("\t")
+            if not line.endswith(b"\n") or len(fields) != 2:
+                break
+            done.add(fields[0])
+            offset = int(fields[1])
+            valid_length += len(line)
+    return done, offset, valid_length
+
+
+class JournaledTarWriter:
+    # Writes a tar file to <path>.partial and appends every committed item together with the tar offset after its
+    # members to <path>.journal. Reopening the writer after a crash truncates the partial tar to the last committed
+    # offset and continues from there. finalize() writes the member index, terminates the tar and atomically renames it
+    # to <path>.
+    def __init__(self, path):
+        self.path = path
+        self.partial_path = path + ".partial"
+        self.journal_path = path + ".journal"
+        self.done = set()
+        self.index = ShardIndexBuilder()
+        offset = 0
+        journal_length = 0
+        if isfile(self.partial_path) and isfile(self.journal_path):
+            self.done, offset, journal_length = read_journal(self.journal_path)
+            self.fileobj = open(self.partial_path, "r+b")
+        else:
+            self.fileobj = open(self.partial_path, "wb")
+        self.fileobj.truncate(offset)
+        self.fileobj.seek(offset)
+        if offset > 0:
+            read_tar_members(self.partial_path, self.index)
+        self.journal = open(self.journal_path, "r+b" if journal_length > 0 else "wb")
+        self.journal.truncate(journal_length)
+        self.journal.seek(journal_length)
+        self.tar = tarfile.open(fileobj=self.fileobj, mode="w")  # starts writing at the current position
+
+    def add(self, name, file_bytes, attributes=None):
+        self.index.add(name, add_bytes_to_tar(self.tar, name, file_bytes), len(file_bytes), attributes)
+
+    def commit(self, item_id):
+        self.fileobj.flush()  # members need to be written before they are journaled
+        self.journal.write(f"{item_id}\t{self.tar.offset}\n".encode("utf-8"))
+        self.journal.flush()
+        self.done.add(item_id)
+
+    def finalize(self):
+        self.tar.close()
+        self.fileobj.close()
+        self.journal.close()
+        self.index.write(self.path, self.partial_path)
+        replace_shard(self.partial_path, self.path)
+        remove(self.journal_path)
+
+    def close(self):
+        # Closes the writer without finalizing, so that it can be resumed
+        self.fileobj.close()
+        self.journal.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.fileobj.closed:
+            self.close()
+
+
+SHARD_NAME_PATTERN = re.compile(r"^(\d{8})\.tar$")
+JOURNAL_SHARD_PREFIX = "#shard\t"  # journal lines recording the final and partial name of a shard, before its items
+
+
+def next_shard_index(output_dir):
+    indices = [int(m.group(1)) for m in (SHARD_NAME_PATTERN.match(basename(p)) for p in glob(join(output_dir, "*.tar"))) if m]
+    return max(indices, default=-1) + 1
+
+
+def journaled_shards(journal_path):
+    # Maps the partial file names of the shards recorded in a ShardWriter journal to their final names
+    shards = {}
+    if journal_path is None or not isfile(journal_path):
+        return shards
+    with open(journal_path, encoding="utf-8") as journal_file:
+        for line in journal_file:
+            if line.startswith(JOURNAL_SHARD_PREFIX) and line.endswith("\n"):
+                final_name, partial_name = line[len(JOURNAL_SHARD_PREFIX):-1].split("\t")
+                shards[partial_name] = final_name
+    return shards
+
+
+def remove_partial_shards(output_dir, journal_path=None):
+    # Partial shards whose items were journaled were finished by a writer that crashed right before renaming them, and
+    # are renamed to their final name. All other partial shards are removed, and so are their partial indexes.
+    shards = journaled_shards(journal_path)
+    for partial_path in glob(join(output_dir, "*.tar.partial")):
+        final_name = shards.get(basename(partial_path))
+        if final_name is not None and not isfile(join(output_dir, final_name)):
+            replace(partial_path, join(output_dir, final_name))
+        else:
+            remove(partial_path)
+    complete_partial_indexes(output_dir)
+
+
+def read_completed_items(journal_path):
+    if not isfile(journal_path):
+        return set()
+    with open(journal_path, encoding="utf-8") as journal_file:
+        return {line.rstrip("\n") for line in journal_file if line.endswith("\n") and not line.startswith(JOURNAL_SHARD_PREFIX)}
+
+
+class ShardWriter:
+    # Writes the members of items to tar shards of about shard_size bytes. A shard is written to a temporary file and
+    # only renamed to the next sequential shard name (taken from shard_counter, a multiprocessing.Value shared by all
+    # writer processes) once it is full, so that the finalized shards are always numbered contiguously. Its member
+    # index is written right before the rename, and renamed after it. The ids of the items of the shard are appended to the journal at
+    # journal_path (and synced) before the rename, after a line with the final and partial name of the shard, so that
+    # remove_partial_shards can complete the rename after a crash. Items of shards that were not finished, e.g. because
+    # of a crash, are not journaled and need to be processed again. If given, on_finalize(shard_path, metadata) is called before the rename with the
+    # concatenated metadata lists passed along with the items of the shard, e.g. to write metadata files next to it.
+    def __init__(self, output_dir, shard_size, shard_counter, journal_path, on_finalize=None):
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.shard_counter = shard_counter
+        self.journal_path = journal_path
+        self.on_finalize = on_finalize
+        self.lock = Lock()  # items may be written from several threads
+        self.num_shards = 0
+        self.tar = None
+
+    def open(self):
+        # The random part keeps the names unique across runs, so that a journaled name never refers to a later shard
+        self.partial_path = join(self.output_dir, f"{getpid()}-{self.num_shards}-{token_hex(4)}.tar.partial")
+        self.num_shards += 1
+        self.tar = tarfile.open(self.partial_path, mode="w")
+        self.index = ShardIndexBuilder()
+        self.item_ids = []
+        self.metadata = []
+
+    def write(self, item_id, members, metadata=None):
+        # members are (name, bytes, image attributes or None) tuples, see shard_index.py
+        with self.lock:
+            if self.tar is None:
+                self.open()
+            for name, file_bytes, attributes in members:
+                self.index.add(name, add_bytes_to_tar(self.tar, name, file_bytes), len(file_bytes), attributes)
+            self.item_ids.append(item_id)
+            if metadata is not None:
+                self.metadata.extend(metadata)
+            if self.tar.offset >= self.shard_size:
+                self.finalize()
+
+    def finalize(self):
+        self.tar.close()
+        self.tar = None
+        with self.shard_counter.get_lock():
+            shard_index = self.shard_counter.value
+            self.shard_counter.value += 1
+            shard_path = join(self.output_dir, f"{shard_index:08d}.tar")
+            self.index.write(shard_path, self.partial_path)
+            if self.on_finalize is not None:
+                self.on_finalize(shard_path, self.metadata)
+            # Written with a single append, so a crashed writer can not leave the shard line without its items
+            entry = f"{JOURNAL_SHARD_PREFIX}{basename(shard_path)}\t{basename(self.partial_path)}\n" + "".join(f"{item_id}\n" for item_id in self.item_ids)
+            fd = os_open(self.journal_path, O_WRONLY | O_CREAT | O_APPEND, 0o644)
+            try:
+                write(fd, entry.encode("utf-8"))
+                fsync(fd)
+            finally:
+                close(fd)
+            replace_shard(self.partial_path, shard_path)
+
+    def close(self):
+        with self.lock:
+            if self.tar is not None:
+                self.finalize()
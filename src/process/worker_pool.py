@@ -0,0 +1,275 @@
+# Process pool for tasks that may exhaust the memory of their worker, with the apply_async interface of
+# multiprocessing.Pool. The results of multiprocessing.Pool never arrive if a worker is killed while running a task
+# (e.g. by the OOM killer). This pool notices workers that die, replaces them and retries their task up to retries
+# times (with retry_kwds added to its keyword arguments) before failing it with WorkerDiedError. Workers whose RSS
+# exceeds max_rss_mb after a task are replaced as well, which returns memory held by fragmentation or leaks to the
+# system. Tasks are assigned to idle workers, and results and callbacks are handled, by a manager thread in the parent.
+# Since replacement workers are started from that thread while other threads of the parent are running (e.g. readers),
+# workers are started from a fork server by default instead of forking the parent, which could leave locks held by
+# other threads locked in the child. Synchronization objects passed to the initializer need to be created in the
+# context of the pool.
+from collections import Counter, deque
+from itertools import count
+import multiprocessing
+from multiprocessing.connection import wait
+from os import cpu_count, sysconf
+from threading import Event, Lock, Thread
+
+
+class WorkerDiedError(Exception):
+    pass
+
+
+def add_worker_arguments(parser):
+    parser.add_argument("--num_workers", type=int, default=None, help="Number of worker processes (default: 1.5x the number of CPUs)")
+    parser.add_argument("--max_worker_rss", type=float, default=None, help="Replace workers whose RSS exceeds this many MB after a task")
+    parser.add_argument("--task_retries", type=int, default=1, help="Number of times a task is retried if its worker dies, e.g. because it ran out of memory")
+
+
+def current_rss_mb():
+    with open("/proc/self/statm") as statm_file:
+        return int(statm_file.read().split()[1]) * sysconf("SC_PAGE_SIZE") / 1024 ** 2
+
+
+def worker_main(connection, initializer, initargs):
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:
+            break  # the parent exited
+        if task is None:
+            break
+        task_id, func, args, kwds = task
+        try:
+            result = (True, func(*args, **kwds))
+        except Exception as e:
+            result = (False, e)
+        task = func = args = kwds = None
+        try:
+            connection.send((task_id, *result, current_rss_mb()))
+        except Exception as e:  # the result can not be pickled, which happens before anything is sent
+            connection.send((task_id, False, RuntimeError(f"Could not send the result of the task: {e}"), current_rss_mb()))
+        result = None
+
+
+class TaskResult:
+    def __init__(self, func, args, kwds, callback=None, error_callback=None, retry_kwds=None):
+        self.func = func
+        self.args = args
+        self.kwds = kwds
+        self.callback = callback
+        self.error_callback = error_callback
+        self.retry_kwds = retry_kwds
+        self.attempts = 0
+        self.event = Event()
+        self.success = None
+        self.value = None
+
+    def ready(self):
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        self.event.wait(timeout)
+
+    def get(self, timeout=None):
+        if not self.event.wait(timeout):
+            raise TimeoutError
+        if self.success:
+            return self.value
+        raise self.value
+
+    def set(self, success, value):
+        self.success = success
+        self.value = value
+        self.func = self.args = self.kwds = None
+        try:
+            if success and self.callback is not None:
+                self.callback(value)
+            if not success and self.error_callback is not None:
+                self.error_callback(value)
+        finally:
+            self.event.set()
+
+
+class Worker:
+    def __init__(self, context, initializer, initargs):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=worker_main, args=(child_connection, initializer, initargs), daemon=True)
+        self.process.start()
+        child_connection.close()
+        self.task_id = None
+
+
+class WorkerPool:
+    def __init__(self, processes=None, initializer=None, initargs=(), max_rss_mb=None, retries=1, context=None):
+        self.context = context or multiprocessing.get_context("forkserver")
+        self.initializer = initializer
+        self.initargs = initargs
+        self.max_rss_mb = max_rss_mb
+        self.retries = retries
+        self.stats = Counter()  # retried tasks, died and recycled workers
+        self.task_ids = count()
+        self.tasks = {}  # task id -> TaskResult of the unfinished tasks
+        self.queue = deque()  # ids of the tasks waiting for a worker
+        self.lock = Lock()
+        self.closed = False
+        self.stopping = False
+        self.terminating = False
+        self.wakeup_reader, self.wakeup_writer = self.context.Pipe(duplex=False)
+        self.wakeup_pending = False
+        self.workers = [Worker(self.context, initializer, initargs) for _ in range(processes or cpu_count())]
+        self.retiring = []  # workers that were asked to exit
+        self.manager = Thread(target=self.manage, daemon=True)
+        self.manager.start()
+
+    def wake_up(self):
+        # Called with the lock held. At most one wakeup is pending, so the pipe never fills up.
+        if not self.wakeup_pending:
+            self.wakeup_pending = True
+            self.wakeup_writer.send_bytes(b"")
+
+    def apply_async(self, func, args=(), kwds={}, callback=None, error_callback=None, retry_kwds=None):
+        result = TaskResult(func, args, kwds, callback, error_callback, retry_kwds)
+        with self.lock:
+            if self.closed:
+                raise ValueError("Pool not running")
+            task_id = next(self.task_ids)
+            self.tasks[task_id] = result
+            self.queue.append(task_id)
+            self.wake_up()
+        return result
+
+    def assign_tasks(self):
+        failed = []  # tasks that can not be sent, whose callbacks are called without the lock held
+        with self.lock:
+            for worker in self.workers:
+                if not self.queue:
+                    break
+                if worker.task_id is not None:
+                    continue
+                task_id = self.queue.popleft()
+                result = self.tasks[task_id]
+                try:
+                    worker.connection.send((task_id, result.func, result.args, result.kwds))
+                except (BrokenPipeError, ConnectionResetError):
+                    self.queue.appendleft(task_id)  # the worker died, which is handled by its sentinel
+                    continue
+                except Exception as e:  # the task can not be pickled
+                    del self.tasks[task_id]
+                    failed.append((result, e))
+                    continue
+                worker.task_id = task_id
+                result.attempts += 1
+        for result, e in failed:
+            result.set(False, e)
+
+    def finish_task(self, worker, recycle=True):
+        task_id, success, value, rss_mb = worker.connection.recv()
+        worker.task_id = None
+        with self.lock:
+            result = self.tasks.pop(task_id)
+        result.set(success, value)
+        if recycle and self.max_rss_mb is not None and rss_mb > self.max_rss_mb:
+            self.stats["recycled_workers"] += 1
+            self.retire(worker)
+
+    def retire(self, worker):
+        try:
+            worker.connection.send(None)
+        except OSError:
+            pass
+        self.workers.remove(worker)
+        self.retiring.append(worker)
+        if not self.terminating:
+            self.workers.append(Worker(self.context, self.initializer, self.initargs))
+
+    def handle_exit(self, worker):
+        # The worker exited without being asked to, e.g. because it was killed
+        if worker.task_id is not None and worker.connection.poll():
+            try:
+                self.finish_task(worker, recycle=False)  # it died after sending its result
+            except EOFError:
+                pass
+        worker.process.join()
+        worker.connection.close()
+        self.workers.remove(worker)
+        self.stats["died_workers"] += 1
+        if worker.task_id is not None:
+            with self.lock:
+                result = self.tasks[worker.task_id]
+                retry = result.attempts <= self.retries
+                if retry:
+                    self.stats["retried_tasks"] += 1
+                    if result.retry_kwds is not None:
+                        result.kwds = {**result.kwds, **result.retry_kwds}
+                    self.queue.appendleft(worker.task_id)
+                else:
+                    del self.tasks[worker.task_id]
+            if not retry:
+                result.set(False, WorkerDiedError(f"Worker died with exit code {worker.process.exitcode} while running the task ({result.attempts} attempts)"))
+        if not self.terminating:
+            self.workers.append(Worker(self.context, self.initializer, self.initargs))
+
+    def manage(self):
+        while not self.terminating:
+            self.assign_tasks()
+            with self.lock:
+                if self.stopping and not self.tasks:
+                    break
+            busy_workers = {worker.connection: worker for worker in self.workers if worker.task_id is not None}
+            sentinels = {worker.process.sentinel: worker for worker in self.workers + self.retiring}
+            ready = wait([self.wakeup_reader, *busy_workers, *sentinels])
+            if self.wakeup_reader in ready:
+                with self.lock:
+                    self.wakeup_reader.recv_bytes()
+                    self.wakeup_pending = False
+            for connection in ready:
+                if connection in busy_workers:
+                    try:
+                        self.finish_task(busy_workers[connection])
+                    except EOFError:
+                        pass  # the worker died, which is handled by its sentinel
+            for sentinel in ready:
+                worker = sentinels.get(sentinel)
+                if worker in self.retiring:
+                    worker.process.join()
+                    worker.connection.close()
+                    self.retiring.remove(worker)
+                elif worker in self.workers:
+                    self.handle_exit(worker)
+        for worker in self.workers:
+            try:
+                worker.connection.send(None)
+            except OSError:
+                pass
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+
+    def join(self):
+        # Waits for all tasks to finish and all workers to exit, after close()
+        with self.lock:
+            self.stopping = True
+            self.wake_up()
+        self.manager.join()
+        for worker in self.workers + self.retiring:
+            worker.process.join()
+
+    def terminate(self):
+        with self.lock:
+            self.closed = True
+            self.terminating = True
+            self.wake_up()
+        self.manager.join()
+        for worker in self.workers + self.retiring:
+            worker.process.terminate()
+            worker.process.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.terminate()
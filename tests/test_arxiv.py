@@ -0,0 +1,69 @@
+from glob import glob
+import gzip
+from json import loads
+from os.path import abspath, basename, dirname, join
+from random import Random
+import sys
+import tarfile
+
+import pytest
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.append(join(ROOT_DIR, "scripts"))
+sys.path.append(join(ROOT_DIR, "src", "process"))
+import arxiv
+from benchmark import encode_raster_figure, paper_bytes, tar_bytes, tex_caption, tex_source
+from img2dataset_format import to_img2dataset_members
+
+TEX_FIXTURES = sorted(glob(join(ROOT_DIR, "tests", "fixtures", "tex", "*.tex")))
+
+
+@pytest.mark.parametrize("tex_path", TEX_FIXTURES, ids=[basename(path) for path in TEX_FIXTURES])
+def test_scanner_matches_texsoup(tex_path):
+    # Sources the scanner can not resolve (named ambiguous_*) fall back to TexSoup
+    with open(tex_path, encoding="utf-8") as tex_file:
+        tex_source = tex_file.read()
+    figures = arxiv.scan_includegraphics_with_captions(tex_source)
+    reference_figures = arxiv.parse_includegraphics_with_captions(tex_source)
+    if basename(tex_path).startswith("ambiguous_"):
+        assert figures is None
+    else:
+        assert figures == reference_figures
+    graphics = [graphic for graphic, _ in reference_figures]
+    assert arxiv.extract_includegraphics_with_captions(tex_source, graphics) == arxiv.match_captions_to_graphics(reference_figures, graphics)
+
+
+def test_scanner_matches_texsoup_on_generated_sources():
+    rng = Random(0)
+    for _ in range(30):
+        figures = [([f"figures/fig{i}{'ab'[j]}.png" for j in range(rng.choice((1, 1, 2)))], tex_caption(rng) if rng.random() < 0.8 else None) for i in range(rng.randint(1, 5))]
+        source = tex_source(rng, figures).decode("utf-8")
+        assert arxiv.scan_includegraphics_with_captions(source) == arxiv.parse_includegraphics_with_captions(source)
+
+
+def test_truncated_archive_is_finalized(tmp_path):
+    rng = Random(0)
+    archive = tar_bytes([(f"2001/2001.{i:05d}.gz", paper_bytes(rng)) for i in range(8)])
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    (input_dir / "arXiv_src_2001_001.tar").write_bytes(archive[:len(archive) * 3 // 4])  # cut inside a paper
+    output_dir = tmp_path / "output"
+    arxiv.main(str(input_dir), str(output_dir), num_workers=2, render_timeout=0)
+    assert not glob(str(output_dir / "*.partial")) and not glob(str(output_dir / "*.journal"))
+    with tarfile.open(output_dir / "arXiv_src_2001_001.tar") as output_tar:
+        assert output_tar.getnames()
+    log = [loads(line) for line in (output_dir / "item_log.jsonl").read_text().splitlines()]
+    assert [entry["error"] for entry in log if entry["kind"] == "archive"] == ["ReadError: unexpected end of data"]
+
+
+def test_figures_with_the_same_basename_are_distinct_samples():
+    rng = Random(0)
+    paths = ["a/plot.jpg", "b/plot.jpg", "plot.png", "plot_1.jpg"]
+    figures = [([path], tex_caption(rng)) for path in paths]
+    source = tar_bytes([("main.tex", tex_source(rng, figures)), *((path, encode_raster_figure(rng, "jpg")) for path in paths)])
+    members, stats = arxiv.process_paper_bytes("2001.00001", gzip.compress(source), render_timeout=0)
+    assert stats["figures"] == len(paths)
+    assert [name for name, _, _ in members if name.endswith(".txt")] == ["2001.00001-plot.txt", "2001.00001-plot_1.txt", "2001.00001-plot_2.txt", "2001.00001-plot_1_1.txt"]
+    samples, metadata = to_img2dataset_members(members)
+    assert len({sample["uid"] for sample in metadata}) == len(paths)
+    assert len({sample["original_image_filename"] for sample in metadata}) == len(paths)
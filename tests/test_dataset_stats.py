@@ -0,0 +1,42 @@
+from io import BytesIO
+from os.path import abspath, dirname, join
+import sys
+import tarfile
+
+from PIL import Image
+import pytest
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.append(join(ROOT_DIR, "scripts"))
+sys.path.append(join(ROOT_DIR, "src", "process"))
+sys.path.append(join(ROOT_DIR, "src", "postprocess"))
+from convert_to_img2dataset import convert_shard
+from dataset_stats import shard_stats, summarize
+
+
+def write_shard(tar_path, sizes, extension=".jpg", alpha=False, **save_kwargs):
+    with tarfile.open(tar_path, "w") as tar:
+        for i, size in enumerate(sizes):
+            image_file = BytesIO()
+            Image.new("RGBA" if alpha else "RGB", size, (i * 40, 0, 0)).save(image_file, format="JPEG" if extension == ".jpg" else "WEBP", **save_kwargs)
+            for name, data in ((f"2001.0000{i}-fig{i}{extension}", image_file.getvalue()), (f"2001.0000{i}-fig{i}.txt", f"Caption {i}".encode("utf-8"))):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, BytesIO(data))
+
+
+# The headers of indexed shards are read from a bounded prefix, WebP headers are parsed without Pillow, and JPEG
+# headers after large metadata segments are read from the whole image
+@pytest.mark.parametrize("extension, save_kwargs", [(".jpg", {}), (".jpg", {"icc_profile": bytes(100000)}), (".webp", {}), (".webp", {"lossless": True}), (".webp", {"alpha": True})])
+def test_image_dimensions_from_metadata(tmp_path, extension, save_kwargs):
+    tar_path = str(tmp_path / "00000000.tar")
+    write_shard(tar_path, [(64, 32), (100, 50), (20, 80)], extension, **save_kwargs)
+    convert_shard(tar_path)
+    summary = summarize(shard_stats(tar_path, use_metadata=True))
+    assert summary["counts"]["samples"] == 3 and not summary["counts"].get("unreadable_images")
+    assert summary["image_width_percentiles"]
+    assert summary["image_height_percentiles"]
+    # The same as when reading the shard sequentially
+    assert summary["image_width_percentiles"] == summarize(shard_stats(tar_path, use_metadata=False))["image_width_percentiles"]
+    assert summary["image_width_percentiles"]["p50"] == 64
+    assert summary["image_height_percentiles"]["p99"] == 80
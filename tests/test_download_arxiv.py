@@ -0,0 +1,93 @@
+from hashlib import md5
+from os.path import abspath, dirname, join
+import sys
+from threading import Thread
+from time import sleep
+
+import pytest
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.append(join(ROOT_DIR, "src"))
+boto3 = pytest.importorskip("boto3")
+moto_server = pytest.importorskip("moto.server")
+from download.arxiv import LEDGER_FILENAME, DiskBudget, download_arxiv_tars
+
+BUCKET_NAME = "arxiv"
+
+
+def manifest_xml(files):
+    entries = "".join(f"<file><filename>{filename}</filename><size>{len(data)}</size><md5sum>{md5_sum}</md5sum><first_item>{first_item}</first_item><last_item>{first_item}</last_item></file>" for filename, data, md5_sum, first_item in files)
+    return f"<arXiv_src>{entries}</arXiv_src>".encode("utf-8")
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    # A local S3 stand-in, which the downloader reaches through its endpoint URL like the real one
+    for name, value in (("AWS_ACCESS_KEY_ID", "testing"), ("AWS_SECRET_ACCESS_KEY", "testing"), ("AWS_DEFAULT_REGION", "us-east-1")):
+        monkeypatch.setenv(name, value)
+    server = moto_server.ThreadedMotoServer(ip_address="127.0.0.1", port=0, verbose=False)
+    server.start()
+    host, port = server.get_host_and_port()
+    endpoint_url = f"http://{host}:{port}"
+    s3 = boto3.client("s3", endpoint_url=endpoint_url)
+    s3.create_bucket(Bucket=BUCKET_NAME)
+    yield s3, endpoint_url
+    server.stop()
+
+
+def upload_archives(s3, archives, corrupt=()):
+    # Uploads the archives and a manifest listing them, with wrong MD5 sums for the corrupt ones
+    files = []
+    for i, data in enumerate(archives):
+        filename = f"src/arXiv_src_2001_{i + 1:03d}.tar"
+        s3.put_object(Bucket=BUCKET_NAME, Key=filename, Body=data)
+        files.append((filename, data, "0" * 32 if i in corrupt else md5(data).hexdigest(), f"2001.{i:05d}"))
+    s3.put_object(Bucket=BUCKET_NAME, Key="src/arXiv_src_manifest.xml", Body=manifest_xml(files))
+
+
+def download(endpoint_url, output_dir, max_bytes=1024 ** 3, **kwargs):
+    downloaded = []
+    download_arxiv_tars(start_item="2001.00000", end_item="none", max_size=max_bytes / 1024 ** 3, output_dir=str(output_dir), num_workers=2, endpoint_url=endpoint_url, on_downloaded=lambda file_path, size: downloaded.append(file_path), **kwargs)
+    return sorted(downloaded)
+
+
+def test_download_and_resume(s3, tmp_path, capsys):
+    s3, endpoint_url = s3
+    archives = [bytes([i]) * (1000 + i) for i in range(3)]
+    upload_archives(s3, archives)
+    downloaded = download(endpoint_url, tmp_path)
+    assert [open(file_path, "rb").read() for file_path in downloaded] == archives
+    assert len((tmp_path / LEDGER_FILENAME).read_text().splitlines()) == 3
+    assert "Downloading src/" in capsys.readouterr().out
+    # Resuming takes the verified files from the ledger without downloading or hashing them again
+    assert download(endpoint_url, tmp_path) == downloaded
+    assert "Downloading src/" not in capsys.readouterr().out
+    assert len((tmp_path / LEDGER_FILENAME).read_text().splitlines()) == 3
+
+
+def test_md5_mismatch(s3, tmp_path):
+    s3, endpoint_url = s3
+    archives = [bytes([i]) * 1000 for i in range(3)]
+    upload_archives(s3, archives, corrupt=[0])
+    disk_budget = DiskBudget(10 ** 6)
+    # The size of the failed download is released, so the maximum size still allows the other two archives
+    downloaded = download(endpoint_url, tmp_path, max_bytes=2500, disk_budget=disk_budget)
+    assert [file_path.rsplit("_", 1)[1] for file_path in downloaded] == ["002.tar", "003.tar"]
+    assert sorted(path.name for path in (tmp_path / "src").iterdir()) == ["arXiv_src_2001_002.tar", "arXiv_src_2001_003.tar", "arXiv_src_manifest.xml"]
+    assert "arXiv_src_2001_001" not in (tmp_path / LEDGER_FILENAME).read_text()
+    assert disk_budget.used == 2000  # the consumer releases the downloaded files
+
+
+def test_disk_budget_blocks_until_released():
+    disk_budget = DiskBudget(1000)
+    disk_budget.acquire(600)
+    acquired = []
+    thread = Thread(target=lambda: acquired.append(disk_budget.acquire(600)))
+    thread.start()
+    sleep(0.1)
+    assert not acquired
+    disk_budget.release(600)
+    thread.join(5)
+    assert acquired and disk_budget.used == 600
+    disk_budget.acquire(2000, block=False)  # files already on disk are not waited for
+    assert disk_budget.used == 2600
@@ -0,0 +1,52 @@
+from io import BytesIO
+from os.path import abspath, dirname, join
+import sys
+
+from PIL import Image
+import pytest
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.append(join(ROOT_DIR, "src", "process"))
+import figures
+from figures import DEFAULT_LIMITS, FigureTooLargeError, check_figure_limits, count_frames, probe
+from renderer import Renderer
+
+
+def gif_bytes(num_frames):
+    frames = [Image.new("L", (4, 4), 255 * (i % 2)) for i in range(num_frames)]
+    image_file = BytesIO()
+    frames[0].save(image_file, format="GIF", save_all=True, append_images=frames[1:])
+    return image_file.getvalue()
+
+
+def pdf_bytes(num_pages):
+    pages = [Image.new("RGB", (144, 72), "white") for _ in range(num_pages)]
+    image_file = BytesIO()
+    pages[0].save(image_file, format="PDF", save_all=True, append_images=pages[1:], resolution=72)
+    return image_file.getvalue()
+
+
+def test_frames_are_counted_up_to_the_limit():
+    with Image.open(BytesIO(gif_bytes(1000))) as img:
+        assert count_frames(img, 20) == 21
+        assert img.tell() == 20
+    with Image.open(BytesIO(gif_bytes(3))) as img:
+        assert count_frames(img, 20) == 3
+    with pytest.raises(FigureTooLargeError):
+        check_figure_limits(gif_bytes(1000), "fig.gif", limits=DEFAULT_LIMITS)
+    check_figure_limits(gif_bytes(3), "fig.gif", limits=DEFAULT_LIMITS)
+
+
+def test_pdfs_are_probed_in_the_renderer(monkeypatch):
+    renderer = Renderer(timeout=60)
+    try:
+        assert renderer.probe("pdf", pdf_bytes(3), 512) == probe("pdf", pdf_bytes(3), 512)
+        # The worker does not parse the PDF itself
+        monkeypatch.setattr(figures, "probe_pdf", None)
+        with pytest.raises(FigureTooLargeError):
+            check_figure_limits(pdf_bytes(3), "fig.pdf", limits={**DEFAULT_LIMITS, "max_pages": 2}, renderer=renderer)
+        check_figure_limits(pdf_bytes(3), "fig.pdf", limits=DEFAULT_LIMITS, renderer=renderer)
+        with pytest.raises(OSError):
+            renderer.probe("pdf", b"%PDF-1.4 broken")
+    finally:
+        renderer.stop()
@@ -0,0 +1,45 @@
+from os.path import abspath, dirname, join
+import sys
+
+import numpy as np
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.append(join(ROOT_DIR, "src", "process"))
+sys.path.append(join(ROOT_DIR, "src", "postprocess"))
+from find_near_duplicates import cluster_pairs, find_near_duplicate_pairs
+from phash import hamming_distances
+
+
+def clustered_hashes(rng, num_hashes, num_flipped_bits):
+    # Hashes that differ from a random base hash in num_flipped_bits random bits each
+    hashes = np.full(num_hashes, rng.integers(0, 2**63, dtype=np.uint64), dtype=np.uint64)
+    for i in range(num_hashes):
+        for bit in rng.choice(64, num_flipped_bits, replace=False):
+            hashes[i] ^= np.uint64(1) << np.uint64(bit)
+    return hashes
+
+
+def brute_force_clusters(hashes, max_distance):
+    firsts, seconds = np.triu_indices(len(hashes), 1)
+    close = hamming_distances(hashes[firsts], hashes[seconds]) <= max_distance
+    return cluster_pairs(len(hashes), firsts[close], seconds[close])
+
+
+def test_clusters_match_brute_force():
+    rng = np.random.default_rng(0)
+    for _ in range(100):
+        hashes = np.concatenate([clustered_hashes(rng, int(rng.integers(1, 40)), int(rng.integers(0, 5))) for _ in range(rng.integers(1, 6))])
+        max_distance = int(rng.integers(1, 7))
+        firsts, seconds = find_near_duplicate_pairs(hashes, max_distance, max_bucket_size=int(rng.integers(2, 10)))
+        assert np.all(hamming_distances(hashes[firsts], hashes[seconds]) <= max_distance)
+        assert np.array_equal(cluster_pairs(len(hashes), firsts, seconds), brute_force_clusters(hashes, max_distance))
+
+
+def test_pairs_grow_linearly_with_cluster_size():
+    rng = np.random.default_rng(0)
+    for num_hashes in (500, 2000, 8000):
+        hashes = clustered_hashes(rng, num_hashes, 3)
+        firsts, seconds = find_near_duplicate_pairs(hashes)
+        # All hashes are within 4 bits of another one, and every kept pair merges two clusters
+        assert len(np.unique(cluster_pairs(num_hashes, firsts, seconds))) == 1
+        assert len(firsts) == num_hashes - 1
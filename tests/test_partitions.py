@@ -0,0 +1,71 @@
+from glob import glob
+from os.path import abspath, basename, dirname, isfile, join, splitext
+from random import Random
+import sys
+import tarfile
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.append(join(ROOT_DIR, "scripts"))
+sys.path.append(join(ROOT_DIR, "src", "process"))
+sys.path.append(join(ROOT_DIR, "src", "postprocess"))
+import arxiv
+from benchmark import paper_bytes, tar_bytes
+from merge_partitions import merge_partitions
+from partitions import in_partition, partition_dir, read_manifest
+from shards import read_completed_items
+
+NUM_PARTITIONS = 3
+
+
+def test_every_input_is_in_exactly_one_partition():
+    keys = [f"src/arXiv_src_{2000 + i // 100}_{i % 100:03d}.tar" for i in range(300)] + [f"oa_package/{i % 100:02d}/{i // 100:02d}/PMC{i:07d}.tar.gz" for i in range(3000)]
+    for num_partitions in (1, 2, 3, 16):
+        counts = [sum(in_partition(key, num_partitions, partition_index) for partition_index in range(num_partitions)) for key in keys]
+        assert set(counts) == {1}
+    # Every partition gets inputs
+    assert all(any(in_partition(key, 16, partition_index) for key in keys) for partition_index in range(16))
+
+
+def test_partitions_are_merged(tmp_path):
+    rng = Random(0)
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    papers = {}
+    for archive_index in range(6):
+        archive_papers = [(f"2001.{archive_index:02d}{i:03d}", paper_bytes(rng)) for i in range(4)]
+        papers.update(archive_papers)
+        (input_dir / f"arXiv_src_2001_{archive_index + 1:03d}.tar").write_bytes(tar_bytes([(f"2001/{arxiv_id}.gz", paper) for arxiv_id, paper in archive_papers]))
+    output_dir = str(tmp_path / "output")
+    for partition_index in range(NUM_PARTITIONS):
+        arxiv.main(str(input_dir), output_dir, num_workers=2, render_timeout=0, img2dataset_output=True, shard_size=0.02, num_partitions=NUM_PARTITIONS, partition_index=partition_index)
+
+    # The papers of every archive are processed by exactly one partition
+    journals = [read_completed_items(join(partition_dir(output_dir, NUM_PARTITIONS, i), arxiv.JOURNAL_FILENAME)) for i in range(NUM_PARTITIONS)]
+    assert sum(len(journal) for journal in journals) == len(set().union(*journals))
+    assert set().union(*journals) <= papers.keys()
+    manifests = [read_manifest(partition_dir(output_dir, NUM_PARTITIONS, i)) for i in range(NUM_PARTITIONS)]
+    partition_shards = [shard for manifest in manifests for shard in manifest["shards"]]
+    assert len(partition_shards) > NUM_PARTITIONS  # several shards per partition, with colliding names
+
+    merge_partitions(output_dir)
+    manifest = read_manifest(output_dir)
+    assert [shard["name"] for shard in manifest["shards"]] == [f"{i:08d}.tar" for i in range(len(partition_shards))]
+    assert manifest["num_samples"] == sum(shard["samples"] for shard in partition_shards)
+    for shard in manifest["shards"]:
+        tar_path = join(output_dir, shard["name"])
+        assert isfile(tar_path + ".idx") and isfile(splitext(tar_path)[0] + ".parquet")
+        with tarfile.open(tar_path) as tar:
+            assert sum(1 for name in tar.getnames() if name.endswith(".jpg")) == shard["samples"]
+    assert not glob(join(output_dir, "partition-*", "*.tar"))
+    assert read_completed_items(join(output_dir, arxiv.JOURNAL_FILENAME)) == set().union(*journals)
+
+    # A later run of a partition is merged after the shards that were already merged
+    (input_dir / "arXiv_src_2001_007.tar").write_bytes(tar_bytes([("2001/2001.06000.gz", paper_bytes(rng))]))
+    partition_index = next(i for i in range(NUM_PARTITIONS) if in_partition("arXiv_src_2001_007.tar", NUM_PARTITIONS, i))
+    arxiv.main(str(input_dir), output_dir, num_workers=2, render_timeout=0, img2dataset_output=True, shard_size=0.02, num_partitions=NUM_PARTITIONS, partition_index=partition_index)
+    num_shards = len(manifest["shards"])
+    merge_partitions(output_dir)
+    names = [shard["name"] for shard in read_manifest(output_dir)["shards"]]
+    assert names[:num_shards] == [shard["name"] for shard in manifest["shards"]]
+    assert names == [f"{i:08d}.tar" for i in range(len(names))] and len(names) > num_shards
+    assert "2001.06000" in read_completed_items(join(output_dir, arxiv.JOURNAL_FILENAME))
@@ -0,0 +1,209 @@
+from collections import Counter
+import csv
+from functools import partial
+from http.server import BaseHTTPRequestHandler, SimpleHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Value
+from os import makedirs
+from os.path import abspath, dirname, join
+from random import Random
+import socket
+from struct import pack
+import sys
+import tarfile
+from threading import Thread
+import zlib
+
+import pytest
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.append(join(ROOT_DIR, "scripts"))
+sys.path.append(join(ROOT_DIR, "src", "process"))
+from benchmark import package_bytes
+import pmc
+from pmc import DownloadError, PackageDownloader, build_package_index, load_package_index, read_completed_packages, read_package
+
+
+class PackageServer:
+    # Serves packages over keep-alive connections. The first failures[path] requests of a path fail with the given HTTP
+    # status, or by resetting the connection if it is "reset".
+    def __init__(self, packages, failures=None):
+        self.packages = packages
+        self.failures = Counter()
+        self.failure_kinds = failures or {}
+        self.requests = Counter()
+        self.connections = set()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server.requests[self.path] += 1
+                server.connections.add(self.client_address)
+                kind, count = server.failure_kinds.get(self.path, (None, 0))
+                if server.failures[self.path] < count:
+                    server.failures[self.path] += 1
+                    if kind == "reset":
+                        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, pack("ii", 1, 0))
+                        self.close_connection = True
+                        return
+                    self.send_response(kind)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = server.packages.get(self.path)
+                self.send_response(200 if body is not None else 404)
+                self.send_header("Content-Length", str(len(body or b"")))
+                self.end_headers()
+                self.wfile.write(body or b"")
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def package():
+    return package_bytes(Random(0), "PMC0000001")
+
+
+def test_server_errors_and_resets_are_retried(package):
+    server = PackageServer({"/a.tar.gz": package, "/b.tar.gz": package}, {"/a.tar.gz": (503, 2), "/b.tar.gz": ("reset", 1)})
+    try:
+        downloader = PackageDownloader(retries=2, backoff=0)
+        for path in ("/a.tar.gz", "/b.tar.gz"):
+            xml_bytes, image_files = downloader.fetch(server.url + path, read_package)
+            assert xml_bytes is not None and image_files
+        assert server.requests == {"/a.tar.gz": 3, "/b.tar.gz": 2}
+    finally:
+        server.close()
+
+
+def test_client_errors_and_exhausted_retries_fail(package):
+    server = PackageServer({"/a.tar.gz": package}, {"/a.tar.gz": (503, 5)})
+    try:
+        downloader = PackageDownloader(retries=2, backoff=0)
+        with pytest.raises(DownloadError) as e:
+            downloader.fetch(server.url + "/a.tar.gz", read_package)
+        assert e.value.status == 503
+        with pytest.raises(DownloadError) as e:
+            downloader.fetch(server.url + "/missing.tar.gz", read_package)
+        assert e.value.status == 404
+        assert server.requests == {"/a.tar.gz": 3, "/missing.tar.gz": 1}
+    finally:
+        server.close()
+
+
+def test_corrupt_packages_are_not_retried(package):
+    server = PackageServer({"/truncated.tar.gz": package[:len(package) // 2], "/garbage.tar.gz": b"not a gzip file" * 100})
+    try:
+        downloader = PackageDownloader(retries=3, backoff=0)
+        for path in ("/truncated.tar.gz", "/garbage.tar.gz"):
+            with pytest.raises((EOFError, tarfile.TarError, zlib.error)):
+                downloader.fetch(server.url + path, read_package)
+            assert server.requests[path] == 1
+    finally:
+        server.close()
+
+
+def test_connections_are_reused(package):
+    server = PackageServer({f"/{i}.tar.gz": package for i in range(5)})
+    try:
+        downloader = PackageDownloader(backoff=0)
+        for i in range(5):
+            downloader.fetch(f"{server.url}/{i}.tar.gz", read_package)
+        assert len(server.connections) == 1
+    finally:
+        server.close()
+
+
+def write_file_list(pmc_dir, packages):
+    # packages are (paper id, last updated) tuples. The file list also contains a PDF, which is not a package.
+    rows = [(f"oa_package/00/{i:02d}/{paper_id}.tar.gz", last_updated) for i, (paper_id, last_updated) in enumerate(packages)]
+    rows.append(("oa_pdf/00/00/main.pdf", "2023-01-01 00:00:00"))
+    with open(join(pmc_dir, "oa_file_list.csv"), "w", encoding="utf-8", newline="") as file_list_file:
+        writer = csv.writer(file_list_file)
+        writer.writerow(["File", "Article Citation", "Accession ID", "Last Updated (YYYY-MM-DD HH:MM:SS)", "PMID", "License"])
+        writer.writerows([package_path, "Citation", package_path.split("/")[-1].split(".")[0], last_updated, "0", "CC BY"] for package_path, last_updated in reversed(rows))
+    return sorted(rows[:-1])
+
+
+class CountingHTTPRequestHandler(SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    requests = Counter()
+
+    def do_GET(self):
+        self.requests[self.path] += 1
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def pmc_server(tmp_path):
+    # Serves a directory of PMC packages generated by the benchmark
+    pmc_dir = str(tmp_path / "pmc")
+    rng = Random(0)
+    for i in range(6):
+        makedirs(join(pmc_dir, "oa_package", "00", f"{i:02d}"))
+        with open(join(pmc_dir, "oa_package", "00", f"{i:02d}", f"PMC{i:07d}.tar.gz"), "wb") as package_file:
+            package_file.write(package_bytes(rng, f"PMC{i:07d}"))
+    CountingHTTPRequestHandler.requests = Counter()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(CountingHTTPRequestHandler, directory=pmc_dir))
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield pmc_dir, f"http://127.0.0.1:{server.server_address[1]}/", CountingHTTPRequestHandler.requests
+    server.shutdown()
+    server.server_close()
+
+
+def test_package_index(tmp_path):
+    pmc_dir = str(tmp_path)
+    packages = write_file_list(pmc_dir, [(f"PMC{i:07d}", f"2023-01-0{i + 1} 00:00:00") for i in range(3)])
+    index_path = join(pmc_dir, "index", "package_index.tsv")
+    build_package_index(join(pmc_dir, "oa_file_list.csv"), index_path)
+    assert load_package_index(index_path) == packages
+
+
+def test_only_new_and_updated_packages_are_processed(pmc_server, tmp_path):
+    pmc_dir, url, requests = pmc_server
+    file_list = join(pmc_dir, "oa_file_list.csv")
+    index_path = str(tmp_path / "package_index.tsv")
+    output_dir = str(tmp_path / "output")
+    packages = write_file_list(pmc_dir, [(f"PMC{i:07d}", "2023-01-01 00:00:00") for i in range(6)])
+    pmc.main(output_dir, file_list, index_path, url, num_workers=2, batch_size=2)
+    assert sorted(read_completed_packages(join(output_dir, pmc.JOURNAL_FILENAME)).items()) == packages
+    assert sum(requests.values()) == 6
+    # Nothing is downloaded again, unless a package was updated
+    pmc.main(output_dir, file_list, index_path, url, num_workers=2, batch_size=2)
+    assert sum(requests.values()) == 6
+    packages = write_file_list(pmc_dir, [(f"PMC{i:07d}", "2023-01-01 00:00:00" if i != 3 else "2024-01-01 00:00:00") for i in range(6)])
+    pmc.main(output_dir, file_list, index_path, url, refresh_index=True, num_workers=2, batch_size=2)
+    assert requests["/oa_package/00/03/PMC0000003.tar.gz"] == 2 and sum(requests.values()) == 7
+    assert sorted(read_completed_packages(join(output_dir, pmc.JOURNAL_FILENAME)).items()) == packages
+
+
+def test_retried_batch_skips_completed_packages(pmc_server, tmp_path):
+    pmc_dir, url, requests = pmc_server
+    output_dir = str(tmp_path / "output")
+    makedirs(output_dir)
+    packages = write_file_list(pmc_dir, [(f"PMC{i:07d}", "2023-01-01 00:00:00") for i in range(6)])
+    # Packages journaled by the worker that died, and one that was updated since
+    with open(join(output_dir, pmc.JOURNAL_FILENAME), "w", encoding="utf-8") as journal_file:
+        journal_file.writelines(f"{package_path}\t{'2022-01-01 00:00:00' if i == 2 else last_updated}\t0\n" for i, (package_path, last_updated) in enumerate(packages[:3]))
+    pmc.init_worker(None, 2, 0, output_dir, 1024 ** 3, Value("q", 0))
+    try:
+        stats = pmc.process_packages(packages, url, skip_completed=True)
+        # The batch is journaled before its stats are returned, without waiting for the worker to exit
+        assert sorted(read_completed_packages(join(output_dir, pmc.JOURNAL_FILENAME)).items()) == packages
+    finally:
+        pmc.shard_writer.close()
+    assert stats["packages"] == 4 and not stats["failed_packages"]
+    assert sorted(requests) == [f"/{package_path}" for package_path, _ in packages[2:]]
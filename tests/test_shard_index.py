@@ -0,0 +1,42 @@
+from os import replace
+from os.path import abspath, dirname, join
+import sys
+import tarfile
+
+import pytest
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.append(join(ROOT_DIR, "src", "process"))
+from shard_index import ShardIndexBuilder, ShardReader, StaleIndexError, build_shard_index, complete_partial_indexes
+from shards import add_bytes_to_tar
+
+
+def write_tar(tar_path, samples):
+    index = ShardIndexBuilder()
+    with tarfile.open(tar_path, "w") as tar:
+        for key, text in samples:
+            index.add(f"{key}.txt", add_bytes_to_tar(tar, f"{key}.txt", text), len(text))
+    return index
+
+
+def test_index_renamed_after_tar(tmp_path):
+    tar_path = str(tmp_path / "00000000.tar")
+    write_tar(tar_path, [("a", b"first"), ("b", b"second")])
+    build_shard_index(tar_path)
+    # A rewritten tar renamed right before a crash, whose index is still partial
+    index = write_tar(tar_path + ".partial", [("c", b"third sample" * 1000)])
+    index.write(tar_path, tar_path + ".partial")
+    replace(tar_path + ".partial", tar_path)
+    with pytest.raises(StaleIndexError):
+        ShardReader(tar_path)
+    complete_partial_indexes(str(tmp_path))
+    with ShardReader(tar_path) as reader:
+        assert reader[0] == {".txt": b"third sample" * 1000}
+
+
+def test_partial_index_of_unfinished_tar_is_removed(tmp_path):
+    tar_path = str(tmp_path / "00000000.tar")
+    index = write_tar(tar_path + ".partial", [("a", b"first")])
+    index.write(tar_path, tar_path + ".partial")
+    complete_partial_indexes(str(tmp_path))
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["00000000.tar.partial"]